@@ -0,0 +1,347 @@
+# A computer opponent.
+#
+# The computer looks ahead with negamax, which is minimax written so that both
+# players try to maximise their own score (a position worth +5 to one player
+# is worth -5 to the other). Alpha-beta pruning skips moves that can't change
+# the result, and trying the most promising moves first (the middle columns,
+# then the best move from the last search) makes that pruning work much
+# better.
+#
+# The search is "iterative deepening": look 1 move ahead, then 2, then 3...
+# until the time is up, and use the answer from the deepest search that
+# finished. Positions that have been searched before are remembered in a
+# transposition table, which has a fixed number of slots so it can't eat all
+# of the Pi's memory.
+
+import time
+from collections import namedtuple
+
+# A win is worth this much, minus the number of moves it took to get there,
+# so that the computer prefers winning sooner and losing later.
+WIN_SCORE = 100000
+# Scores further from 0 than this mean someone can force a win.
+WIN_THRESHOLD = WIN_SCORE - 1000
+
+# How many entries the transposition table holds.
+TABLE_SIZE = 1 << 18
+
+# How many nodes to search between checks of the clock.
+CLOCK_CHECK_NODES = 256
+
+# Kinds of transposition table entry: the score is exact, or only a lower or
+# upper bound because alpha-beta cut the search short.
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+
+# What best_move() returns. nodes_per_sec is how fast the search ran.
+SearchResult = namedtuple("SearchResult", ["column", "score", "depth", "nodes", "nodes_per_sec"])
+# What score_columns() returns. scores[col] is how good playing col is for
+# the player about to move, or None if col is full.
+ColumnScores = namedtuple("ColumnScores", ["scores", "depth", "nodes"])
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class TranspositionTable:
+
+    __slots__ = ("size", "keys", "entries")
+
+    def __init__(self, size=TABLE_SIZE):
+        self.size = size
+        # Slot i holds the key of the position stored there, and a tuple of
+        # (depth, kind, score, best column). A new position that lands in a
+        # used slot simply replaces the old one.
+        self.keys = [None] * size
+        self.entries = [None] * size
+
+    def get(self, key):
+        slot = key % self.size
+        if self.keys[slot] == key:
+            return self.entries[slot]
+        return None
+
+    def put(self, key, depth, kind, score, column):
+        slot = key % self.size
+        self.keys[slot] = key
+        self.entries[slot] = (depth, kind, score, column)
+
+
+# How many bits of x are set. (int.bit_count() needs a newer Python than the
+# Pi comes with.)
+def popcount(x):
+    return bin(x).count("1")
+
+
+# The spaces where a player with the pieces in bits would complete a line of
+# connect, whether or not those spaces can be played yet. Works on the
+# bitboard layout described in bitboard.py. empty is a mask of the empty
+# spaces.
+def winning_spaces(bits, column_bits, empty, connect=4):
+    if connect == 4:
+        return winning_spaces_4(bits, column_bits, empty)
+
+    # Vertical: connect - 1 on top of each other, with the space above.
+    spaces = bits << 1
+    for i in range(2, connect):
+        spaces &= bits << i
+
+    # Horizontal and the two diagonals.
+    for shift in (column_bits, column_bits - 1, column_bits + 1):
+        # below[n] is set where the n spaces to one side are all ours, and
+        # above[n] where the n spaces to the other side are.
+        below = [-1]
+        above = [-1]
+        for i in range(1, connect):
+            below.append(below[-1] & (bits << (i * shift)))
+            above.append(above[-1] & (bits >> (i * shift)))
+        # The space completes a line if it has n of ours on one side and
+        # the rest on the other.
+        for n in range(connect):
+            spaces |= below[n] & above[connect - 1 - n]
+
+    return spaces & empty
+
+
+# winning_spaces() for the usual line of four, written out in full. The
+# search spends most of its time here, and this is much faster than the
+# loops above.
+def winning_spaces_4(bits, column_bits, empty):
+    # Vertical: three on top of each other, with the space above.
+    spaces = (bits << 1) & (bits << 2) & (bits << 3)
+
+    # Horizontal and the two diagonals.
+    for shift in (column_bits, column_bits - 1, column_bits + 1):
+        # Two in a row to one side of the space...
+        pair = (bits << shift) & (bits << (2 * shift))
+        spaces |= pair & (bits << (3 * shift))  # ...and a third beyond them
+        spaces |= pair & (bits >> shift)        # ...and one on the other side
+        # Two in a row to the other side of the space...
+        pair = (bits >> shift) & (bits >> (2 * shift))
+        spaces |= pair & (bits << shift)
+        spaces |= pair & (bits >> (3 * shift))
+
+    return spaces & empty
+
+
+class Searcher:
+
+    def __init__(self, board, table, deadline):
+        self.board = board
+        self.table = table
+        self.deadline = deadline
+        self.nodes = 0
+        self.column_bits = board.column_bits
+        self.connect = board.connect
+        # Every real space on the board (the sentinel row left out).
+        self.full_mask = board.bottom * ((1 << board.rows) - 1)
+        # The middle column, and the order to try columns in: the middle
+        # first, then working outwards, since those are usually better.
+        middle = board.columns // 2
+        self.order = sorted(range(board.columns), key=lambda col: abs(col - middle))
+        self.middle_mask = ((1 << board.rows) - 1) << (middle * self.column_bits)
+
+    # How good the position is for piece, without looking ahead. Having
+    # spaces that would complete a line is good, and so are chips in the
+    # middle column.
+    def evaluate(self, piece):
+        board = self.board
+        mine = board.pieces[piece - 1]
+        theirs = board.pieces[2 - piece]
+        empty = self.full_mask & ~(mine | theirs)
+        score = 4 * (popcount(winning_spaces(mine, self.column_bits, empty, self.connect))
+                     - popcount(winning_spaces(theirs, self.column_bits, empty, self.connect)))
+        score += popcount(mine & self.middle_mask) - popcount(theirs & self.middle_mask)
+        return score
+
+    # The negamax search. Returns the score of the position for piece, who is
+    # about to move, looking depth moves ahead.
+    def negamax(self, depth, alpha, beta, piece):
+        board = self.board
+        self.nodes += 1
+        if self.nodes % CLOCK_CHECK_NODES == 0 and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+
+        moves_played = len(board.moves)
+        if moves_played == board.rows * board.columns:
+            return 0
+
+        # Can we win right now? The spaces that can be played this turn are
+        # the ones just above the top chip of each column.
+        occupied = board.pieces[0] | board.pieces[1]
+        playable = (occupied + board.bottom) & self.full_mask
+        if winning_spaces(board.pieces[piece - 1], self.column_bits, playable, self.connect):
+            return WIN_SCORE - (moves_played + 1)
+
+        if depth == 0:
+            return self.evaluate(piece)
+
+        # Have we been here before?
+        original_alpha = alpha
+        key = board.key()
+        entry = self.table.get(key)
+        best_col = None
+        if entry is not None:
+            entry_depth, kind, score, best_col = entry
+            if entry_depth >= depth:
+                if kind == EXACT:
+                    return score
+                if kind == LOWER_BOUND:
+                    alpha = max(alpha, score)
+                elif kind == UPPER_BOUND:
+                    beta = min(beta, score)
+                if alpha >= beta:
+                    return score
+
+        # Try the move that was best last time first.
+        if best_col is not None:
+            order = [best_col] + [col for col in self.order if col != best_col]
+        else:
+            order = self.order
+
+        best_score = -WIN_SCORE
+        for col in order:
+            if not board.can_play(col):
+                continue
+            board.play(col, piece)
+            score = -self.negamax(depth - 1, -beta, -alpha, 3 - piece)
+            board.undo()
+            if score > best_score:
+                best_score = score
+                best_col = col
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                break
+
+        if best_score <= original_alpha:
+            kind = UPPER_BOUND
+        elif best_score >= beta:
+            kind = LOWER_BOUND
+        else:
+            kind = EXACT
+        self.table.put(key, depth, kind, best_score, best_col)
+        return best_score
+
+    # Search every move at the root to the given depth. order is the order to
+    # try them in. Returns (best column, score).
+    def search_root(self, depth, order, piece):
+        board = self.board
+        alpha = -WIN_SCORE
+        best_col = order[0]
+        for col in order:
+            board.play(col, piece)
+            # A move that wins on the spot doesn't need searching.
+            if board.is_win(piece):
+                score = WIN_SCORE - len(board.moves)
+            else:
+                score = -self.negamax(depth - 1, -WIN_SCORE, -alpha, 3 - piece)
+            board.undo()
+            if score > alpha:
+                alpha = score
+                best_col = col
+        return best_col, alpha
+
+    # Search every move at the root to the given depth, each with the full
+    # window, so every move gets its exact score and not just "worse than
+    # the best". Returns a list of (column, score).
+    def score_root(self, depth, order, piece):
+        board = self.board
+        found = []
+        for col in order:
+            board.play(col, piece)
+            if board.is_win(piece):
+                score = WIN_SCORE - len(board.moves)
+            else:
+                score = -self.negamax(depth - 1, -WIN_SCORE, WIN_SCORE, 3 - piece)
+            board.undo()
+            found.append((col, score))
+        return found
+
+
+# The table used by best_move() when it isn't given one. Keeping it between
+# moves means the next search starts with what this one learned.
+shared_table = None
+
+
+# Pick a column for piece to play on board, taking at most time_budget_ms
+# milliseconds. The board is left as it was. If an OpeningBook is given and
+# the position is in it, the book's answer is used without searching.
+# Returns a SearchResult.
+def best_move(board, piece, time_budget_ms, max_depth=None, table=None, book=None):
+    global shared_table
+    if book is not None:
+        found = book.lookup(board)
+        if found is not None:
+            return SearchResult(found[0], found[1], book.depth, 0, 0)
+
+    if table is None:
+        if shared_table is None:
+            shared_table = TranspositionTable()
+        table = shared_table
+
+    start = time.perf_counter()
+    searcher = Searcher(board.copy(), table, start + time_budget_ms / 1000)
+    moves_left = board.rows * board.columns - len(board.moves)
+    if max_depth is None or max_depth > moves_left:
+        max_depth = moves_left
+
+    order = [col for col in searcher.order if board.can_play(col)]
+    best_col = order[0]
+    score = 0
+    depth_done = 0
+    for depth in range(1, max_depth + 1):
+        try:
+            best_col, score = searcher.search_root(depth, order, piece)
+        except SearchTimeout:
+            break
+        depth_done = depth
+        # Search the best move first next time round.
+        order.remove(best_col)
+        order.insert(0, best_col)
+        # Someone can force a win. Looking deeper won't change that.
+        if abs(score) >= WIN_THRESHOLD:
+            break
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    return SearchResult(best_col, score, depth_done, searcher.nodes, int(searcher.nodes / elapsed))
+
+
+# Score every column piece could play on board, taking at most
+# time_budget_ms milliseconds. best_move() only needs to know which move is
+# best, so it cuts the search of the others short. This searches each of
+# them in full, which is slower but says how good every one is (for hints,
+# see analysis.py). The board is left as it was. Returns a ColumnScores.
+def score_columns(board, piece, time_budget_ms, max_depth=None, table=None):
+    global shared_table
+    if table is None:
+        if shared_table is None:
+            shared_table = TranspositionTable()
+        table = shared_table
+
+    start = time.perf_counter()
+    # The first depth always finishes, so there's always an answer.
+    searcher = Searcher(board.copy(), table, float("inf"))
+    moves_left = board.rows * board.columns - len(board.moves)
+    if max_depth is None or max_depth > moves_left:
+        max_depth = moves_left
+
+    order = [col for col in searcher.order if board.can_play(col)]
+    scores = [None] * board.columns
+    depth_done = 0
+    for depth in range(1, max_depth + 1):
+        try:
+            found = searcher.score_root(depth, order, piece)
+        except SearchTimeout:
+            break
+        for col, score in found:
+            scores[col] = score
+        depth_done = depth
+        searcher.deadline = start + time_budget_ms / 1000
+        # Every move is a forced win or loss. Looking deeper won't change that.
+        if all(abs(scores[col]) >= WIN_THRESHOLD for col in order):
+            break
+
+    return ColumnScores(scores, depth_done, searcher.nodes)
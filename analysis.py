@@ -0,0 +1,177 @@
+# Hints: how good every move is, worked out by the server.
+#
+# A kiosk can send "analyze" with every column played so far, and gets back
+# the score of every column it could play next and which one is best (see
+# dispatch.py). Working that out is a search by the computer opponent (see
+# ai.py), which takes up to ANALYSIS_TIME_MS of solid CPU. Done on the
+# server's own threads (or event loop) that would hold up every other game,
+# so an Analyzer hands the searches to a pool of worker processes and sends
+# each answer when it comes back, the way "subscribe" replies are sent.
+#
+# Most games start the same few ways, so the same early positions get asked
+# about over and over. Every answer goes into one cache shared by every game
+# on the server, holding the CACHE_SIZE positions used most recently. A
+# position and its mirror image play the same (see
+# Bitboard.canonical_key()), so they share one entry, and a position that is
+# already being searched for someone else isn't searched twice: everyone who
+# asked gets the same answer.
+
+import multiprocessing
+import os
+import signal
+import threading
+from collections import OrderedDict
+
+import ai
+import wire
+from bitboard import Bitboard
+
+# How long each position is searched for (ms).
+ANALYSIS_TIME_MS = 1000
+# How many positions the cache holds.
+CACHE_SIZE = 50000
+
+
+# The scores of every column in a position, searched in a worker process.
+# job is (moves, rows, columns, connect, time budget in ms). Each worker
+# keeps ai.py's transposition table from one position to the next, since
+# nearby positions share a lot of their search.
+def analyze_position(job):
+    moves, rows, columns, connect, time_budget_ms = job
+    board = Bitboard(rows, columns, connect)
+    piece = 1
+    for col in moves:
+        board.play(col, piece)
+        piece = 3 - piece
+    return tuple(ai.score_columns(board, piece, time_budget_ms).scores)
+
+
+# Run in each worker process as it starts. The server handles Ctrl+C and
+# SIGUSR1 itself.
+def start_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+
+class Analyzer:
+
+    # rows, columns and connect are the game being played on the server.
+    # workers is how many processes search positions (one per CPU if None).
+    def __init__(self, rows, columns, connect, workers=None, cache_size=CACHE_SIZE, time_budget_ms=ANALYSIS_TIME_MS):
+        self.rows = rows
+        self.columns = columns
+        self.connect = connect
+        self.cache_size = cache_size
+        self.time_budget_ms = time_budget_ms
+        # The pool is forked from the server, so it has to start before the
+        # server opens its sockets and starts its threads. Otherwise every
+        # worker would hold copies of them.
+        self.pool = multiprocessing.get_context("fork").Pool(workers or os.cpu_count(), start_worker)
+        # Canonical key -> the score of every column in the canonical
+        # orientation, least recently used first.
+        self.cache = OrderedDict()
+        # Canonical key -> everyone waiting for that position's search, as
+        # (mirrored, reply) pairs.
+        self.pending = {}
+        # Answers arrive on the pool's result thread, and in the threaded
+        # core questions come from every connection's thread.
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # How answers are handed to the core. The threaded core's send()
+        # works from any thread. The asyncio cores have to be called on their
+        # loop (see start_on_loop()).
+        self.call_soon = lambda function, *args: function(*args)
+
+    # Send answers from an asyncio event loop, for the asyncio cores.
+    def start_on_loop(self, loop):
+        self.call_soon = loop.call_soon_threadsafe
+
+    # Analyze the position after moves (the columns played, in order). If
+    # it's in the cache (or can't be analyzed), the ANALYSIS reply is
+    # returned straight away. Otherwise this returns None, and reply (a
+    # function that sends a reply tuple, like Client.send) is called with
+    # it once the search is done.
+    def analyze(self, moves, reply):
+        board = self.replay(moves)
+        if board is None:
+            return wire.REPLY_NO_ANALYSIS
+        key, mirrored = board.canonical_key()
+        with self.lock:
+            scores = self.cache.get(key)
+            if scores is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.result(scores, mirrored)
+            self.misses += 1
+            waiting = self.pending.get(key)
+            if waiting is not None:
+                waiting.append((mirrored, reply))
+                return None
+            self.pending[key] = [(mirrored, reply)]
+        job = (bytes(moves), self.rows, self.columns, self.connect, self.time_budget_ms)
+        self.pool.apply_async(analyze_position, (job,),
+                              callback=lambda scores: self.finished(key, mirrored, scores),
+                              error_callback=lambda error: self.failed(key, error))
+        return None
+
+    # The board after moves, or None if they aren't a game that still has a
+    # move to make: a column that doesn't exist or is full, a move after
+    # someone has already won, or a full board.
+    def replay(self, moves):
+        board = Bitboard(self.rows, self.columns, self.connect)
+        piece = 1
+        for col in moves:
+            if col >= self.columns or not board.can_play(col):
+                return None
+            row = board.play(col, piece)
+            if board.winning_cells(row, col):
+                return None
+            piece = 3 - piece
+        if board.is_full():
+            return None
+        return board
+
+    # The ANALYSIS reply for a position whose canonical scores are scores,
+    # seen the other way round if mirrored. The best column is the highest
+    # scoring, and the one nearest the middle if there's a tie.
+    def result(self, scores, mirrored):
+        if mirrored:
+            scores = scores[::-1]
+        middle = self.columns // 2
+        playable = [col for col in range(self.columns) if scores[col] is not None]
+        best = max(playable, key=lambda col: (scores[col], -abs(col - middle)))
+        return (wire.ANALYSIS, best, scores)
+
+    # A search is done. Called on the pool's result thread. scores are for
+    # the position as it was asked about, which is mirrored if its key
+    # isn't the canonical one.
+    def finished(self, key, mirrored, scores):
+        if mirrored:
+            scores = scores[::-1]
+        with self.lock:
+            self.cache[key] = scores
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            waiting = self.pending.pop(key, [])
+        for waiter_mirrored, reply in waiting:
+            self.call_soon(reply, self.result(scores, waiter_mirrored))
+
+    def failed(self, key, error):
+        print("Couldn't analyze a position: {}".format(error))
+        with self.lock:
+            waiting = self.pending.pop(key, [])
+        for waiter_mirrored, reply in waiting:
+            self.call_soon(reply, wire.REPLY_NO_ANALYSIS)
+
+    # How the cache is doing, as extra metrics for ServerMetrics.render().
+    def stats(self):
+        with self.lock:
+            hits, misses, entries = self.hits, self.misses, len(self.cache)
+        return [("analysis_cache_hits_total", "counter", "Hints answered from the cache.", hits),
+                ("analysis_cache_misses_total", "counter", "Hints that weren't in the cache.", misses),
+                ("analysis_cache_entries", "gauge", "Positions in the hint cache.", entries)]
+
+    def close(self):
+        self.pool.terminate()
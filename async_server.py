@@ -0,0 +1,119 @@
+# An asyncio version of the server.
+#
+# server.py normally starts a new thread for every connection. Each of those
+# threads has its own stack and spends nearly all of its life blocked in
+# recv(), which adds up quickly when lots of kiosks are connected. This core
+# serves every connection from a single thread with an asyncio event loop
+# instead. It speaks exactly the same protocol (see dispatch.py).
+#
+# Run it with "python3 server.py async".
+
+import asyncio
+import time
+
+import wire
+from dispatch import BACKLOG, GREETING, SPECTATOR_BUFFER_LIMIT, Client, client_disconnected, handle_message
+from lifecycle import enable_keepalive
+
+
+# Talks to one client. A BufferedProtocol lets asyncio receive straight into
+# the connection's MessageReader buffer, so nothing is copied on the way in.
+class ClientProtocol(asyncio.BufferedProtocol):
+
+    # reaper is the Reaper (see lifecycle.py) that keeps an eye on idle
+    # connections, and analyzer the Analyzer (see analysis.py) that works out
+    # hints.
+    def __init__(self, sessions, metrics, reaper, analyzer):
+        self.sessions = sessions
+        self.metrics = metrics
+        self.reaper = reaper
+        self.analyzer = analyzer
+        self.reader = wire.MessageReader()
+        self.transport = None
+        self.client = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.client = Client(self.sessions, self.send, self.push, self.analyzer)
+        self.metrics.connection_opened()
+        enable_keepalive(transport.get_extra_info("socket"))
+        self.reaper.watch(self.client, transport.abort)
+        # send the initial greeting
+        transport.write(GREETING)
+        self.metrics.sent(len(GREETING))
+
+    # Send a reply tuple, in whichever protocol this client speaks.
+    def send(self, reply):
+        data = wire.encode_reply(reply, self.reader.framed)
+        if data:
+            self.transport.write(data)
+            self.metrics.sent(len(data))
+
+    # Push something to this client as a spectator, unless it has fallen too
+    # far behind, in which case it's dropped.
+    def push(self, encodings):
+        if self.transport.is_closing():
+            return False
+        if self.transport.get_write_buffer_size() > SPECTATOR_BUFFER_LIMIT:
+            self.transport.abort()
+            return False
+        data = encodings[1 if self.reader.framed else 0]
+        self.transport.write(data)
+        self.metrics.sent(len(data))
+        return True
+
+    def get_buffer(self, sizehint):
+        return self.reader.free_space()
+
+    def buffer_updated(self, nbytes):
+        self.metrics.received(nbytes)
+        try:
+            messages = self.reader.received(nbytes)
+        except ValueError:
+            # Not something we can understand. Hang up.
+            self.transport.close()
+            return
+        self.dispatch(messages)
+
+    # Handle messages from the client and send the replies.
+    def dispatch(self, messages):
+        for message in messages:
+            start = time.perf_counter()
+            reply = handle_message(self.client, message)
+            self.metrics.message_handled(message[0], reply, time.perf_counter() - start)
+            if reply is not None:
+                self.send(reply)
+
+    # Don't let a client that isn't reading its replies make us buffer them
+    # forever. Stop reading its messages until it catches up.
+    def pause_writing(self):
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        session = self.client.session
+        client_disconnected(self.client)
+        self.reaper.forget(self.client, session)
+        self.metrics.connection_closed()
+
+
+# Accept connections forever.
+async def serve(sessions, port, metrics, reaper, analyzer):
+    loop = asyncio.get_running_loop()
+    reaper.start_on_loop(loop)
+    analyzer.start_on_loop(loop)
+    server = await loop.create_server(lambda: ClientProtocol(sessions, metrics, reaper, analyzer), '', port,
+                                      backlog=BACKLOG)
+    print("Waiting for a connection...")
+    async with server:
+        await server.serve_forever()
+
+
+# Start the event loop. Doesn't return until the loop is stopped.
+# metrics is the ServerMetrics to record what happens in, reaper the Reaper
+# that closes idle connections, and analyzer the Analyzer that works out
+# hints.
+def run_async_server(sessions, port, metrics, reaper, analyzer):
+    asyncio.run(serve(sessions, port, metrics, reaper, analyzer))
@@ -0,0 +1,144 @@
+# Playing lots of games at once, for self-play, testing and tuning.
+#
+# Bitboard plays one game at a time, and every move is a few lines of Python.
+# That's plenty for the kiosk, but too slow for playing millions of games to
+# test the rules or tune the computer opponent. BatchGames holds a whole batch
+# of games in numpy arrays instead, and every operation (working out the
+# legal moves, playing a move, checking for wins and draws) is done for every
+# game in the batch at once, with no Python loop over the games.
+#
+# Each game's board uses the same layout as bitboard.py, stored in a uint64,
+# so a board can be at most 64 bits: (rows + 1) * columns <= 64. The normal
+# 6x7 board takes 49.
+#
+# Play a batch of random games: python3 batch_sim.py [games]
+
+import sys
+import time
+
+import numpy as np
+
+from bitboard import Bitboard, ROW_COUNT, COLUMN_COUNT, CONNECT, run_steps
+
+# How many games simulate_random() plays by default.
+GAMES = 100000
+
+
+class BatchGames:
+
+    def __init__(self, count, rows=ROW_COUNT, columns=COLUMN_COUNT, connect=CONNECT):
+        self.count = count
+        self.rows = rows
+        self.columns = columns
+        self.connect = connect
+        self.column_bits = rows + 1
+        if self.column_bits * columns > 64:
+            raise ValueError("a {}x{} board doesn't fit in 64 bits".format(rows, columns))
+        # pieces[0] holds player 1's bitboard for every game, pieces[1]
+        # player 2's.
+        self.pieces = np.zeros((2, count), dtype=np.uint64)
+        # How many chips are in each column of each game.
+        self.heights = np.zeros((count, columns), dtype=np.int8)
+        # How many moves each game has had. Player 1 moves when it's even.
+        self.moves_played = np.zeros(count, dtype=np.int16)
+        # Every column played in each game, in order. -1 past the last move.
+        self.history = np.full((count, rows * columns), -1, dtype=np.int8)
+        # The piece that won each game, or 0 for none (yet).
+        self.winner = np.zeros(count, dtype=np.int8)
+        # Whether each game is over, by a win or a draw.
+        self.finished = np.zeros(count, dtype=bool)
+        # The bit number of the bottom space of every column.
+        self.column_shifts = np.arange(columns, dtype=np.uint64) * np.uint64(self.column_bits)
+        # The four directions a line can go in, as the shifts that find a
+        # line of connect in each (see bitboard.line_starts()).
+        self.line_shifts = [[np.uint64(step * shift) for step in run_steps(connect)] for shift in
+                            (1, self.column_bits, self.column_bits - 1, self.column_bits + 1)]
+
+    # Which columns can be played in each game, as a (count, columns) array
+    # of bools. Nothing can be played in a game that's over.
+    def legal_moves(self):
+        return (self.heights < self.rows) & ~self.finished[:, np.newaxis]
+
+    # The games that are drawn: over, with nobody winning.
+    def draws(self):
+        return self.finished & (self.winner == 0)
+
+    # Whether every game in the batch is over.
+    def all_finished(self):
+        return bool(self.finished.all())
+
+    # Which of bitboards (an array of them) have connect in a row.
+    def has_line(self, bitboards):
+        won = np.zeros(len(bitboards), dtype=bool)
+        for shifts in self.line_shifts:
+            runs = bitboards
+            for shift in shifts:
+                runs = runs & (runs >> shift)
+            won |= runs != 0
+        return won
+
+    # Play one move in every game that isn't over: columns[i] in game i, for
+    # whoever's turn it is there. Moves for finished games are ignored.
+    # Raises ValueError if a move can't be played.
+    def play(self, columns):
+        columns = np.asarray(columns, dtype=np.int64)
+        games = np.flatnonzero(~self.finished)
+        if len(games) == 0:
+            return
+        cols = columns[games]
+        if ((cols < 0) | (cols >= self.columns)).any():
+            raise ValueError("column out of range")
+        rows = self.heights[games, cols]
+        if (rows >= self.rows).any():
+            raise ValueError("column is full")
+
+        players = self.moves_played[games] % 2
+        bits = np.uint64(1) << (self.column_shifts[cols] + rows.astype(np.uint64))
+        self.pieces[players, games] |= bits
+        self.heights[games, cols] += 1
+        self.history[games, self.moves_played[games]] = cols
+        self.moves_played[games] += 1
+
+        # Only the player who just moved can have won.
+        won = self.has_line(self.pieces[players, games])
+        self.winner[games[won]] = players[won] + 1
+        self.finished[games] = won | (self.moves_played[games] == self.rows * self.columns)
+
+    # A random legal column for every game (0 for the games that are over).
+    # rng is a numpy Generator.
+    def random_moves(self, rng):
+        legal = self.legal_moves()
+        # Give every legal column a random number and the others -1, and take
+        # the biggest.
+        choices = np.where(legal, rng.random(legal.shape), -1.0)
+        return choices.argmax(axis=1)
+
+    # Game i as a Bitboard, for looking at one game more closely.
+    def to_bitboard(self, i):
+        board = Bitboard(self.rows, self.columns, self.connect)
+        piece = 1
+        for col in self.history[i, :self.moves_played[i]]:
+            board.play(int(col), piece)
+            piece = 3 - piece
+        return board
+
+
+# Play count random games to the end. Returns the finished BatchGames.
+def simulate_random(count=GAMES, rows=ROW_COUNT, columns=COLUMN_COUNT, seed=None, connect=CONNECT):
+    rng = np.random.default_rng(seed)
+    games = BatchGames(count, rows, columns, connect)
+    while not games.all_finished():
+        games.play(games.random_moves(rng))
+    return games
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) >= 2 else GAMES
+    start = time.perf_counter()
+    games = simulate_random(count)
+    elapsed = time.perf_counter() - start
+    print("Played {} random games in {:.2f} seconds ({:.0f} games/sec).".format(
+        count, elapsed, count / elapsed))
+    print("Red won {}, yellow won {}, {} draws. Games took {:.1f} moves on average.".format(
+        int((games.winner == 1).sum()), int((games.winner == 2).sum()),
+        int(games.draws().sum()), games.moves_played.mean()))
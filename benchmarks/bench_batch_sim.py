@@ -0,0 +1,121 @@
+# Compare how many random games per second can be played with BatchGames
+# from batch_sim.py, and by looping the one-game-at-a-time rule functions.
+#
+# "legacy" is the original numpy-matrix code from connect-4.py, before the
+# bitboard: get_next_open_row(), drop_piece() and a whole-board
+# winning_move() after every move. "bitboard" is the same loop with the
+# functions connect-4.py has now, which are thin wrappers around Bitboard.
+# "batch" plays every game at once with BatchGames, at a few batch sizes.
+#
+# Usage: python3 benchmarks/bench_batch_sim.py [games]
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from batch_sim import simulate_random
+from bitboard import Bitboard
+
+# The same settings as connect-4.py.
+ROW_COUNT = 6
+COLUMN_COUNT = 7
+
+# How many games the one-at-a-time loops play. BatchGames plays many more.
+GAMES = 2000
+BATCH_SIZES = (1000, 10000, 100000)
+
+
+# The original rule functions from connect-4.py, before the bitboard.
+def legacy_create_board():
+    return np.zeros((ROW_COUNT, COLUMN_COUNT))
+
+
+def legacy_drop_piece(board, row, col, piece):
+    board[row][col] = piece
+
+
+def legacy_is_valid_location(board, col):
+    return board[ROW_COUNT - 1][col] == 0
+
+
+def legacy_get_next_open_row(board, col):
+    for row in range(ROW_COUNT):
+        if board[row][col] == 0:
+            return row
+
+
+def legacy_winning_move(board, piece):
+    for c in range(COLUMN_COUNT - 3):
+        for r in range(ROW_COUNT):
+            if board[r][c] == piece and board[r][c+1] == piece and board[r][c+2] == piece and board[r][c+3] == piece:
+                return True
+    for c in range(COLUMN_COUNT):
+        for r in range(ROW_COUNT - 3):
+            if board[r][c] == piece and board[r+1][c] == piece and board[r+2][c] == piece and board[r+3][c] == piece:
+                return True
+    for c in range(COLUMN_COUNT - 3):
+        for r in range(ROW_COUNT - 3):
+            if board[r][c] == piece and board[r+1][c+1] == piece and board[r+2][c+2] == piece and board[r+3][c+3] == piece:
+                return True
+    for c in range(COLUMN_COUNT - 3):
+        for r in range(3, ROW_COUNT):
+            if board[r][c] == piece and board[r-1][c+1] == piece and board[r-2][c+2] == piece and board[r-3][c+3] == piece:
+                return True
+    return False
+
+
+def legacy_game():
+    board = legacy_create_board()
+    piece = 1
+    for turn in range(ROW_COUNT * COLUMN_COUNT):
+        col = random.choice([c for c in range(COLUMN_COUNT) if legacy_is_valid_location(board, c)])
+        legacy_drop_piece(board, legacy_get_next_open_row(board, col), col, piece)
+        if legacy_winning_move(board, piece):
+            return piece
+        piece = 3 - piece
+    return 0
+
+
+# The same game with the functions connect-4.py uses now.
+def bitboard_game():
+    board = Bitboard(ROW_COUNT, COLUMN_COUNT)
+    piece = 1
+    for turn in range(ROW_COUNT * COLUMN_COUNT):
+        col = random.choice(board.valid_columns())
+        row = board.play(col, piece)
+        if board.winning_cells(row, col):
+            return piece
+        piece = 3 - piece
+    return 0
+
+
+# Play games with game_func, one after another. Returns games/sec.
+def time_loop(game_func, games):
+    random.seed(1)
+    start = time.perf_counter()
+    for game in range(games):
+        game_func()
+    return games / (time.perf_counter() - start)
+
+
+def time_batch(games):
+    start = time.perf_counter()
+    simulate_random(games, ROW_COUNT, COLUMN_COUNT, seed=1)
+    return games / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else GAMES
+
+    legacy = time_loop(legacy_game, games)
+    print("{:>14}: {:9.0f} games/sec".format("legacy", legacy))
+    print("{:>14}: {:9.0f} games/sec".format("bitboard", time_loop(bitboard_game, games)))
+    for size in BATCH_SIZES:
+        rate = time_batch(size)
+        print("{:>14}: {:9.0f} games/sec  ({:.0f}x legacy)".format(
+            "batch {}".format(size), rate, rate / legacy))
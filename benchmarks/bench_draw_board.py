@@ -0,0 +1,123 @@
+# Compare how long a frame takes to draw with the original draw_board() and
+# with the BoardRenderer from renderer.py.
+#
+# A "frame" is what happens on every step of a turn: the hovering piece moves
+# one column, and (on every seventh frame, about how often someone actually
+# drops a piece) a piece is dropped. The original code redrew the whole board
+# and updated the whole screen for both of those. The renderer only redraws
+# and updates the squares that changed.
+#
+# Runs without a window by using SDL's dummy video driver, so the numbers are
+# mostly drawing cost. On a Pi with a real display, full-screen updates cost
+# a lot more, so the gap is bigger there.
+#
+# Usage: python3 benchmarks/bench_draw_board.py [frames]
+
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pygame
+
+from bitboard import Bitboard
+from renderer import BoardRenderer
+
+# The same settings as connect-4.py.
+ROW_COUNT = 6
+COLUMN_COUNT = 7
+SQUARE_SIZE = 68
+CIRCLE_RADIUS = (SQUARE_SIZE // 2) - 4
+BLUE = (0,0,255)
+BLACK = (0,0,0)
+RED = (255,0,0)
+YELLOW = (255,255,0)
+
+FRAMES = 5000
+
+
+# The original draw_board() from connect-4.py, before the renderer.
+def legacy_draw_board(screen, board):
+    for c in range(COLUMN_COUNT):
+        for r in range(ROW_COUNT):
+            rect = (c*SQUARE_SIZE, (r+1)*SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE)
+            pygame.draw.rect(screen, BLUE, rect)
+            circle_position = ((c*SQUARE_SIZE) + (SQUARE_SIZE // 2), ((r+1)*SQUARE_SIZE) + (SQUARE_SIZE // 2))
+            circle_color = BLACK
+            piece = board.piece_at(ROW_COUNT - 1 - r, c)
+            if piece == 1:
+                circle_color = RED
+            elif piece == 2:
+                circle_color = YELLOW
+            pygame.draw.circle(screen, circle_color, circle_position, CIRCLE_RADIUS)
+    pygame.display.update()
+
+
+# One frame the old way: clear the top row, draw the hovering piece, update
+# the screen, and redraw the whole board if a piece was dropped.
+def legacy_frame(screen, board, col, dropped):
+    pygame.draw.rect(screen, BLACK, (0, 0, COLUMN_COUNT * SQUARE_SIZE, SQUARE_SIZE))
+    circle_pos = ((col * SQUARE_SIZE) + (SQUARE_SIZE // 2), SQUARE_SIZE // 2)
+    pygame.draw.circle(screen, RED, circle_pos, CIRCLE_RADIUS)
+    pygame.display.update()
+    if dropped is not None:
+        legacy_draw_board(screen, board)
+
+
+# One frame with the renderer: move the hovering piece, draw the dropped
+# piece's square, and update only those squares.
+def renderer_frame(renderer, board, col, dropped):
+    dirty = renderer.draw_hover(col, RED)
+    if dropped is not None:
+        dirty.append(renderer.draw_cell(board, dropped, col))
+    pygame.display.update(dirty)
+
+
+# Time frame_func over the same random game for every frame. Returns the
+# frame times in seconds.
+def time_frames(frame_func, frames):
+    random.seed(1)
+    board = Bitboard(ROW_COUNT, COLUMN_COUNT)
+    piece = 1
+    times = []
+    for frame in range(frames):
+        col = frame % COLUMN_COUNT
+        dropped = None
+        if frame % 7 == 6:
+            if board.is_full():
+                board = Bitboard(ROW_COUNT, COLUMN_COUNT)
+            col = random.choice(board.valid_columns())
+            dropped = board.play(col, piece)
+            piece = 3 - piece
+        start = time.perf_counter()
+        frame_func(board, col, dropped)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def report(name, times):
+    times.sort()
+    mean = sum(times) / len(times)
+    print("{:>9}: mean {:7.3f} ms   p50 {:7.3f} ms   p99 {:7.3f} ms".format(
+        name, mean * 1000, times[len(times) // 2] * 1000, times[int(len(times) * 0.99)] * 1000))
+    return mean
+
+
+if __name__ == "__main__":
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else FRAMES
+
+    pygame.init()
+    screen = pygame.display.set_mode((COLUMN_COUNT * SQUARE_SIZE, (ROW_COUNT + 1) * SQUARE_SIZE))
+    renderer = BoardRenderer(screen, ROW_COUNT, COLUMN_COUNT, SQUARE_SIZE, CIRCLE_RADIUS,
+                             BLUE, BLACK, {1: RED, 2: YELLOW})
+
+    legacy = report("legacy", time_frames(
+        lambda board, col, dropped: legacy_frame(screen, board, col, dropped), frames))
+    renderer.draw_board(Bitboard(ROW_COUNT, COLUMN_COUNT))
+    new = report("renderer", time_frames(
+        lambda board, col, dropped: renderer_frame(renderer, board, col, dropped), frames))
+    print("speedup: {:.1f}x".format(legacy / new))
+    pygame.quit()
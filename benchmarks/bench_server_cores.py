@@ -0,0 +1,128 @@
+# Compare the threaded server core with the asyncio one.
+#
+# For each core and each number of clients, this starts server.py on
+# localhost, connects that many idle clients to it, and then has every client
+# send "waited" a few times. It reports the server's memory use (resident set
+# size) with all the clients connected, and the median and 99th percentile
+# time from sending a message to getting its reply.
+#
+# Usage: python3 benchmarks/bench_server_cores.py [client counts...]
+# e.g.   python3 benchmarks/bench_server_cores.py 100 1000 10000
+
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+# Where server.py lives.
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCH_PORT = 12399
+CLIENT_COUNTS = [100, 1000, 10000]
+CORES = ["threaded", "async"]
+# How many messages each client sends once everyone is connected.
+ROUNDS = 5
+# How many connections to open at once, so we don't overflow the backlog.
+CONNECT_BATCH = 100
+
+
+# Let this process (and the server it starts) have enough sockets open.
+def raise_file_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+
+# The resident memory of a process in kB, from /proc.
+def rss_kb(pid):
+    with open("/proc/{}/status".format(pid)) as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+# Start server.py and wait until it is accepting connections.
+def start_server(mode, port):
+    server = subprocess.Popen([sys.executable, "server.py", mode, str(port)],
+                              cwd=REPO_DIR, stdout=subprocess.DEVNULL)
+    for attempt in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("server.py didn't start")
+
+
+# Open a connection and read the greeting.
+async def connect(port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    await reader.read(2048)
+    return reader, writer
+
+
+# Send one message and time how long its reply takes.
+async def timed_request(reader, writer, message):
+    start = time.perf_counter()
+    writer.write(message.encode("ascii"))
+    await reader.read(2048)
+    return time.perf_counter() - start
+
+
+# The value below which the given fraction of the (sorted) samples fall.
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+# Connect everyone, note the server's memory, then time the messages.
+async def run_clients(pid, client_count):
+    connections = []
+    for start in range(0, client_count, CONNECT_BATCH):
+        batch = min(CONNECT_BATCH, client_count - start)
+        connections += await asyncio.gather(*[connect(BENCH_PORT) for i in range(batch)])
+
+    # Give the server a moment to finish starting threads for everyone.
+    await asyncio.sleep(0.5)
+    memory = rss_kb(pid)
+
+    latencies = []
+    for round_num in range(ROUNDS):
+        latencies += await asyncio.gather(
+            *[timed_request(reader, writer, "waited") for reader, writer in connections])
+
+    for reader, writer in connections:
+        writer.close()
+    return memory, latencies
+
+
+def bench(mode, client_count):
+    server = start_server(mode, BENCH_PORT)
+    try:
+        start_rss = rss_kb(server.pid)
+        memory, latencies = asyncio.run(run_clients(server.pid, client_count))
+    finally:
+        server.kill()
+        server.wait()
+    latencies.sort()
+    print("{:>9} {:>7} {:>10.1f} {:>10.1f} {:>10.2f} {:>10.2f}".format(
+        mode, client_count, start_rss / 1024, memory / 1024,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or CLIENT_COUNTS
+    raise_file_limit(max(counts) * 2 + 100)
+
+    print("{:>9} {:>7} {:>10} {:>10} {:>10} {:>10}".format(
+        "core", "clients", "idle MB", "loaded MB", "p50 ms", "p99 ms"))
+    for client_count in counts:
+        for mode in CORES:
+            try:
+                bench(mode, client_count)
+            except (OSError, RuntimeError) as e:
+                print("{:>9} {:>7} failed: {}".format(mode, client_count, e))
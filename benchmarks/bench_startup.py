@@ -0,0 +1,62 @@
+# How long it takes before the game (or anything else that wants the rules)
+# can do anything.
+#
+# connect-4.py used to import numpy, pygame, the computer opponent and the
+# opening book (and with it multiprocessing), then start pygame, open the
+# window and load the font, before any of its code could run. Now the rules
+# (rules.py) and the server connection (net_client.py) import without any of
+# that, and pygame is only loaded when the display is opened (ui.py).
+#
+# Each case is run in a fresh interpreter, so nothing is already imported,
+# and the median of a few runs is reported. "python" is the interpreter
+# starting and doing nothing, which every other case includes.
+#
+# Usage: python3 benchmarks/bench_startup.py [runs]
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RUNS = 10
+
+# What connect-4.py imported before this change, and what it did before its
+# first function could be called.
+OLD_IMPORTS = "import numpy, pygame, socket, ai, opening_book, wire, bitboard, gpio_input, renderer"
+OLD_DISPLAY = (OLD_IMPORTS + "\n"
+               "pygame.init()\n"
+               "screen = pygame.display.set_mode((7 * 68, 7 * 68))\n"
+               "font = pygame.font.SysFont('monospace', 48)\n"
+               "renderer.BoardRenderer(screen, 6, 7, 68, 30, (0,0,255), (0,0,0), {1: (255,0,0), 2: (255,255,0)})\n")
+
+CASES = [
+    ("python", "pass"),
+    ("old imports", OLD_IMPORTS),
+    ("rules", "import rules"),
+    ("rules + net_client", "import rules, net_client"),
+    ("old, window open", OLD_DISPLAY),
+    ("ui, window open", "import rules, net_client, ui\nui.open_display()"),
+]
+
+
+# Run code in a new interpreter runs times. Returns the median wall time (s).
+def time_case(code, runs):
+    # No real screen is needed to open the window.
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy", SDL_AUDIODRIVER="dummy",
+               PYGAME_HIDE_SUPPORT_PROMPT="1")
+    times = []
+    for run in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+    for name, code in CASES:
+        print("{:>20}: {:7.1f} ms".format(name, time_case(code, runs) * 1000))
@@ -0,0 +1,100 @@
+# How the timer wheel (timer_wheel.py) compares with a heap for the server's
+# timeouts.
+#
+# The server sets a timeout for every connection and cancels nearly all of
+# them before they go off. Each case below schedules TIMERS timeouts spread
+# over a few minutes, cancels most of them, then lets the clock run until
+# the rest have gone off. The heap is the usual heapq approach: cancelling
+# marks an entry dead, and dead entries are thrown away when they reach the
+# top. Both take a lock for every call, as the threaded server needs.
+#
+# Usage: python3 benchmarks/bench_timer_wheel.py [timers]
+
+import heapq
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from timer_wheel import TimerWheel
+
+TIMERS = 50000
+# How many of the timers are cancelled before they go off.
+CANCELLED = 0.9
+# The longest timeout (seconds).
+LONGEST = 300
+
+
+# A clock the benchmark moves by hand, so no time is spent waiting.
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class HeapTimers:
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.heap = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def schedule(self, delay, callback):
+        entry = [self.clock() + delay, next(self.counter), callback]
+        with self.lock:
+            heapq.heappush(self.heap, entry)
+        return entry
+
+    def cancel(self, entry):
+        with self.lock:
+            entry[2] = None
+
+    def advance(self):
+        now = self.clock()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                callback = heapq.heappop(self.heap)[2]
+                if callback is not None:
+                    due.append(callback)
+        for callback in due:
+            callback()
+        return len(due)
+
+
+# Schedule, cancel and fire timers. Returns (seconds spent, timers fired).
+def run(make_timers, delays, cancel):
+    clock = FakeClock()
+    timers = make_timers(clock)
+    fired = [0]
+
+    def callback():
+        fired[0] += 1
+
+    start = time.perf_counter()
+    handles = [timers.schedule(delay, callback) for delay in delays]
+    for i in cancel:
+        timers.cancel(handles[i])
+    for second in range(LONGEST + 2):
+        clock.now = float(second)
+        timers.advance()
+    return time.perf_counter() - start, fired[0]
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else TIMERS
+    rng = random.Random(0)
+    delays = [rng.uniform(1, LONGEST) for i in range(count)]
+    cancel = rng.sample(range(count), int(count * CANCELLED))
+    print("{} timers, {} cancelled".format(count, len(cancel)))
+    for name, make_timers in (("heap", HeapTimers), ("timer wheel", lambda clock: TimerWheel(clock=clock))):
+        seconds, fired = run(make_timers, delays, cancel)
+        print("{:>12}: {:7.1f} ms ({} fired)".format(name, seconds * 1000, fired))
@@ -0,0 +1,203 @@
+# A load test for server.py.
+#
+# Simulated kiosks connect to the server on localhost and play complete games
+# against each other, speaking the original ASCII protocol exactly the way the
+# kiosks out in the world do: "p=1"/"p=2", polling "waited" until the game
+# starts, "turn x:y" for their own moves, polling "waiting x" for the
+# opponent's, and "gameover" at the end. Each simulated kiosk keeps its own
+# Bitboard, picks random legal moves, and stops when someone wins or the board
+# is full. With --match, the kiosks ask to be matched with anyone ("match")
+# instead, and the server tells each which piece it plays.
+#
+# At the end it reports how many games and messages per second the server
+# handled, how many connections were open at once, the server's memory use,
+# and the 50th/95th/99th percentile time from sending each type of message to
+# getting its reply. Run it before and after a change to server.py (or
+# dispatch.py, sessions.py...) to see what the change did.
+#
+# Usage: python3 benchmarks/load_test.py [options]   (--help lists them)
+# e.g.   python3 benchmarks/load_test.py --games 2000 --concurrent 200 --mode async
+
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+from bench_server_cores import REPO_DIR, start_server, raise_file_limit, rss_kb, percentile
+
+sys.path.insert(0, REPO_DIR)
+
+from bitboard import Bitboard
+
+LOAD_PORT = 12398
+GAMES = 500
+CONCURRENT_GAMES = 50
+# Poll this often (ms) while waiting for the game to start or for a move,
+# like the kiosks do.
+POLL_MS = 50
+# How long (ms) a simulated player "thinks" before each of its moves.
+THINK_MS = 0
+
+# The message types, in the order they're reported.
+MESSAGE_TYPES = ["p=", "waited", "match", "turn", "waiting", "gameover"]
+
+
+class Stats:
+
+    def __init__(self):
+        # Reply times in seconds for each message type.
+        self.latencies = {kind: [] for kind in MESSAGE_TYPES}
+        self.games = 0
+        self.connections = 0
+        self.peak_connections = 0
+        self.errors = 0
+
+
+class Player:
+
+    def __init__(self, piece, stats, options):
+        self.piece = piece
+        self.stats = stats
+        self.options = options
+        self.reader = None
+        self.writer = None
+
+    # Send one message, wait for its reply and time it.
+    async def request(self, kind, message):
+        start = time.perf_counter()
+        self.writer.write(message.encode("ascii"))
+        reply = await self.reader.read(2048)
+        self.stats.latencies[kind].append(time.perf_counter() - start)
+        if not reply:
+            raise ConnectionError("server closed the connection")
+        return reply.decode("ascii")
+
+    # Send a message every POLL_MS until the reply is something other than
+    # "wait". Returns that reply.
+    async def poll(self, kind, message):
+        while True:
+            reply = await self.request(kind, message)
+            if reply != "wait":
+                return reply
+            await asyncio.sleep(self.options.poll / 1000)
+
+    # Play one whole game, from connecting to hanging up.
+    async def play(self):
+        stats = self.stats
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.options.port)
+        stats.connections += 1
+        stats.peak_connections = max(stats.peak_connections, stats.connections)
+        try:
+            await self.reader.read(2048)  # the greeting
+
+            if self.options.match:
+                # The reply only comes once there's an opponent, so its
+                # latency is how long it took to be matched.
+                self.piece = int((await self.request("match", "match")).split()[1])
+            elif await self.request("p=", "p={}".format(self.piece)) != "start":
+                await self.poll("waited", "waited")
+
+            board = Bitboard()
+            piece = 1
+            for turn in range(1, board.rows * board.columns + 1):
+                if piece == self.piece:
+                    if self.options.think:
+                        await asyncio.sleep(self.options.think / 1000)
+                    col = random.choice(board.valid_columns())
+                    await self.request("turn", "turn {}:{}".format(turn, col))
+                else:
+                    col = int(await self.poll("waiting", "waiting {}".format(turn)))
+                row = board.play(col, piece)
+                if board.winning_cells(row, col):
+                    break
+                piece = 3 - piece
+
+            await self.request("gameover", "gameover")
+        finally:
+            self.writer.close()
+            stats.connections -= 1
+
+
+# Play one game: a red and a yellow kiosk connect at the same time. (With
+# lots of games going, the server may well pair them with other kiosks. That
+# doesn't matter, since every kiosk only follows the protocol.)
+async def play_game(stats, options):
+    results = await asyncio.gather(Player(1, stats, options).play(),
+                                   Player(2, stats, options).play(),
+                                   return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            stats.errors += 1
+            print("Client failed: {!r}".format(result))
+    stats.games += 1
+
+
+# Keep options.concurrent games going until options.games have been played,
+# starting at most options.rate games a second (if it isn't 0).
+async def run_games(stats, options):
+    started = 0
+    running = set()
+    start = time.perf_counter()
+    while started < options.games or running:
+        while started < options.games and len(running) < options.concurrent:
+            if options.rate and started >= (time.perf_counter() - start) * options.rate:
+                break
+            running.add(asyncio.ensure_future(play_game(stats, options)))
+            started += 1
+        if not running:
+            await asyncio.sleep(1 / options.rate)
+            continue
+        done, running = await asyncio.wait(running, timeout=0.1 if options.rate else None,
+                                           return_when=asyncio.FIRST_COMPLETED)
+    return time.perf_counter() - start
+
+
+def report(stats, elapsed, server_pid):
+    messages = sum(len(samples) for samples in stats.latencies.values())
+    print("{} games in {:.1f} s: {:.1f} games/sec, {:.0f} messages/sec.".format(
+        stats.games, elapsed, stats.games / elapsed, messages / elapsed))
+    print("Peak connections: {}. Client errors: {}.".format(stats.peak_connections, stats.errors))
+    if server_pid is not None:
+        print("Server memory: {:.1f} MB.".format(rss_kb(server_pid) / 1024))
+    print()
+    print("{:>9} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+        "message", "count", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for kind in MESSAGE_TYPES:
+        samples = sorted(stats.latencies[kind])
+        if not samples:
+            continue
+        print("{:>9} {:>9} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            kind, len(samples), percentile(samples, 0.5) * 1000, percentile(samples, 0.95) * 1000,
+            percentile(samples, 0.99) * 1000, samples[-1] * 1000))
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description="Play lots of games against server.py on localhost.")
+    parser.add_argument("--games", type=int, default=GAMES, help="how many games to play in total")
+    parser.add_argument("--concurrent", type=int, default=CONCURRENT_GAMES,
+                        help="how many games to have going at once (two connections each)")
+    parser.add_argument("--rate", type=float, default=0, help="start at most this many games a second (0: no limit)")
+    parser.add_argument("--poll", type=float, default=POLL_MS, help="ms between polls while waiting")
+    parser.add_argument("--think", type=float, default=THINK_MS, help="ms each player waits before moving")
+    parser.add_argument("--match", action="store_true", help="ask to be matched with anyone instead of sending \"p=\"")
+    parser.add_argument("--mode", default="threaded",
+                        help="start server.py in this mode (threaded, async or sharded), or \"none\" to use one already running")
+    parser.add_argument("--port", type=int, default=LOAD_PORT)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    options = parse_options()
+    raise_file_limit(options.concurrent * 4 + 100)
+    server = None
+    if options.mode != "none":
+        server = start_server(options.mode, options.port)
+    try:
+        stats = Stats()
+        elapsed = asyncio.run(run_games(stats, options))
+        report(stats, elapsed, server.pid if server is not None else None)
+    finally:
+        if server is not None:
+            server.kill()
+            server.wait()
@@ -0,0 +1,265 @@
+# A bitboard implementation of the Connect 4 rules.
+#
+# The board used to be a 6x7 numpy matrix of floats. Every access to it
+# (board[r][c]) made a temporary row view, which is fine for drawing the board
+# but far too slow for anything that wants to look at lots of positions (a
+# computer opponent, the server checking moves, simulations...).
+#
+# Here the board is stored as two integers, one per player. Each bit of an
+# integer is one space on the board. The bits are laid out column by column,
+# bottom to top, with one extra "sentinel" bit on top of every column:
+#
+#     6 13 20 27 34 41 48   <- sentinel row, always empty
+#     5 12 19 26 33 40 47
+#     4 11 18 25 32 39 46
+#     3 10 17 24 31 38 45
+#     2  9 16 23 30 37 44
+#     1  8 15 22 29 36 43
+#     0  7 14 21 28 35 42   <- row 0, the bottom of the board
+#
+# The sentinel row means that shifting the bits to check for a line of four
+# can never wrap around from the top of one column to the bottom of the next.
+#
+# The board doesn't have to be 6x7, and the line doesn't have to be four
+# long. For each size of board and length of line, every line that would win
+# is worked out once (see WinningLines) and shared by every board of that
+# size, so checking the lines through one space is a few lookups however big
+# the board is.
+
+import functools
+
+# Board settings. connect-4.py (through rules.py) uses these.
+ROW_COUNT = 6
+COLUMN_COUNT = 7
+# How many in a row win.
+CONNECT = 4
+
+# Piece settings. Best not to change.
+PLAYER_1_PIECE = 1
+PLAYER_2_PIECE = 2
+
+
+# Make sure a board size and line length make a game that can be played and
+# stored. Moves are stored a byte per turn (see sessions.py), and sent as
+# one character per column in the ASCII protocol (see wire.py). Raises
+# ValueError if not.
+def check_size(rows, columns, connect):
+    if rows < 1 or columns < 2 or rows * columns > 254 or columns > 36:
+        raise ValueError("a {}x{} board isn't supported".format(rows, columns))
+    if not 2 <= connect <= max(rows, columns):
+        raise ValueError("can't get {} in a row on a {}x{} board".format(connect, rows, columns))
+
+
+# Every line of connect spaces on a board. Made once per board size (see
+# winning_lines()) and shared by all the Bitboards of that size.
+class WinningLines:
+
+    __slots__ = ("masks", "cells", "by_space")
+
+    def __init__(self, rows, columns, connect):
+        column_bits = rows + 1
+        # masks[i] has a bit set for each space of line i, and cells[i] the
+        # same spaces as (row, col) tuples.
+        self.masks = []
+        self.cells = []
+        # by_space[bit number] is the masks of every line through that space.
+        self.by_space = [[] for bit in range(column_bits * columns)]
+        # Vertical, horizontal, and the two diagonals, as (row, col) steps.
+        for row_step, col_step in ((1, 0), (0, 1), (1, 1), (-1, 1)):
+            for row in range(rows):
+                for col in range(columns):
+                    end_row = row + row_step * (connect - 1)
+                    end_col = col + col_step * (connect - 1)
+                    if not (0 <= end_row < rows and end_col < columns):
+                        continue
+                    cells = [(row + row_step * i, col + col_step * i) for i in range(connect)]
+                    mask = 0
+                    for r, c in cells:
+                        mask |= 1 << (c * column_bits + r)
+                    self.masks.append(mask)
+                    self.cells.append(cells)
+                    for r, c in cells:
+                        self.by_space[c * column_bits + r].append(len(self.masks) - 1)
+        self.by_space = [tuple(lines) for lines in self.by_space]
+
+
+# The WinningLines for a board size, made the first time it's asked for.
+@functools.lru_cache(maxsize=None)
+def winning_lines(rows, columns, connect):
+    check_size(rows, columns, connect)
+    return WinningLines(rows, columns, connect)
+
+
+# How to find lines of length spaces with shifts. Runs of two are found by
+# checking the bits against themselves one step along, runs of four by
+# checking runs of two against themselves two steps along, and so on, so
+# only a few shifts are needed even for long lines. Returns how many steps
+# along each shift goes: [1, 2] for four, [1, 2, 1] for five.
+@functools.lru_cache(maxsize=None)
+def run_steps(length):
+    steps = []
+    run = 1
+    while run * 2 <= length:
+        steps.append(run)
+        run *= 2
+    if run < length:
+        steps.append(length - run)
+    return tuple(steps)
+
+
+# The bits of bits where a line of length spaces starts, going in the
+# direction that moves shift bits at a time.
+def line_starts(bits, shift, length):
+    for step in run_steps(length):
+        bits &= bits >> (step * shift)
+    return bits
+
+
+class Bitboard:
+
+    __slots__ = ("rows", "columns", "connect", "lines", "column_bits", "bottom", "pieces", "heights",
+                 "moves")
+
+    def __init__(self, rows=ROW_COUNT, columns=COLUMN_COUNT, connect=CONNECT):
+        self.rows = rows
+        self.columns = columns
+        self.connect = connect
+        self.lines = winning_lines(rows, columns, connect)
+        # How many bits each column takes up, including the sentinel.
+        self.column_bits = rows + 1
+        # One bit at the bottom of every column. Used when making keys.
+        self.bottom = 0
+        for col in range(columns):
+            self.bottom |= 1 << (col * self.column_bits)
+        # One integer per player. pieces[0] is player 1, pieces[1] is player 2.
+        self.pieces = [0, 0]
+        # How many chips are in each column. This is also the row that the
+        # next chip dropped in that column will land in.
+        self.heights = [0] * columns
+        # Every column played so far, in order. Used to undo moves.
+        self.moves = []
+
+    # Which bit a given row and column is stored in.
+    def bit(self, row, col):
+        return 1 << (col * self.column_bits + row)
+
+    # A chip can be dropped in a column if the column isn't full yet.
+    def can_play(self, col):
+        return self.heights[col] < self.rows
+
+    # The row a chip dropped in col would land in, or None if it's full.
+    def next_open_row(self, col):
+        if self.heights[col] < self.rows:
+            return self.heights[col]
+        return None
+
+    # Every column that a chip can currently be dropped in.
+    def valid_columns(self):
+        return [col for col in range(self.columns) if self.heights[col] < self.rows]
+
+    # Drop a piece into a column. Returns the row the piece landed in.
+    def play(self, col, piece):
+        row = self.heights[col]
+        self.pieces[piece - 1] |= 1 << (col * self.column_bits + row)
+        self.heights[col] = row + 1
+        self.moves.append(col)
+        return row
+
+    # Take back the last move. Returns the column it was played in.
+    def undo(self):
+        col = self.moves.pop()
+        row = self.heights[col] - 1
+        self.heights[col] = row
+        bit = ~(1 << (col * self.column_bits + row))
+        self.pieces[0] &= bit
+        self.pieces[1] &= bit
+        return col
+
+    # What is at a given row and column? 0 for nothing, otherwise the piece.
+    def piece_at(self, row, col):
+        bit = 1 << (col * self.column_bits + row)
+        if self.pieces[0] & bit:
+            return PLAYER_1_PIECE
+        if self.pieces[1] & bit:
+            return PLAYER_2_PIECE
+        return 0
+
+    # Has the given piece got connect in a row anywhere on the board?
+    def is_win(self, piece):
+        bits = self.pieces[piece - 1]
+        # The four directions are: vertical (1), horizontal (column_bits),
+        # and the two diagonals (column_bits - 1 and column_bits + 1).
+        for shift in (1, self.column_bits, self.column_bits - 1, self.column_bits + 1):
+            if line_starts(bits, shift, self.connect):
+                return True
+        return False
+
+    # Did the piece just dropped at row, col win the game? Only the lines that
+    # pass through that space are looked at, which is much less work than
+    # checking the whole board. Returns the winning spaces as a list of
+    # (row, col) tuples, or None if the piece didn't win.
+    # If the piece made more than one line at once, every space of every one
+    # of them is returned.
+    def winning_cells(self, row, col):
+        space = col * self.column_bits + row
+        bit = 1 << space
+        if self.pieces[0] & bit:
+            bits = self.pieces[0]
+        elif self.pieces[1] & bit:
+            bits = self.pieces[1]
+        else:
+            return None
+        masks = self.lines.masks
+        won = [line for line in self.lines.by_space[space] if bits & masks[line] == masks[line]]
+        if not won:
+            return None
+        cells = set()
+        for line in won:
+            cells.update(self.lines.cells[line])
+        return sorted(cells)
+
+    # Is every space on the board taken?
+    def is_full(self):
+        return len(self.moves) == self.rows * self.columns
+
+    # An integer which is unique to this position. The occupied spaces plus
+    # one bit per column tell us the height of every column, and player 1's
+    # pieces tell us who owns each of them.
+    def key(self):
+        return self.pieces[0] + (self.pieces[0] | self.pieces[1]) + self.bottom
+
+    # The key of this position seen in a mirror, with the columns swapped
+    # left to right. A position and its mirror image play exactly the same.
+    def mirror_key(self):
+        column_mask = (1 << self.column_bits) - 1
+        occupied = self.pieces[0] | self.pieces[1]
+        mirrored_pieces = 0
+        mirrored_occupied = 0
+        for col in range(self.columns):
+            shift = col * self.column_bits
+            mirror_shift = (self.columns - 1 - col) * self.column_bits
+            mirrored_pieces |= ((self.pieces[0] >> shift) & column_mask) << mirror_shift
+            mirrored_occupied |= ((occupied >> shift) & column_mask) << mirror_shift
+        return mirrored_pieces + mirrored_occupied + self.bottom
+
+    # The same key for a position and its mirror image: whichever of the two
+    # is smaller. Returns the key, and whether it's the mirror's.
+    def canonical_key(self):
+        key = self.key()
+        mirrored = self.mirror_key()
+        if mirrored < key:
+            return mirrored, True
+        return key, False
+
+    # A copy of the board that can be changed without touching this one.
+    def copy(self):
+        board = Bitboard(self.rows, self.columns, self.connect)
+        board.pieces = self.pieces[:]
+        board.heights = self.heights[:]
+        board.moves = self.moves[:]
+        return board
+
+    # The board as a list of rows (row 0 first) of pieces. Handy for printing.
+    def to_grid(self):
+        return [[self.piece_at(row, col) for col in range(self.columns)]
+                for row in range(self.rows)]
@@ -12,527 +12,626 @@
 # base game and UI. His work is provided under the MIT license, which means
 # it is free to use The full source code of his can be found at
 # https://github.com/KeithGalli/Connect4-Python.
+#
+# This file is the game itself: reading the arguments and playing. The rules
+# are in rules.py, the connection to the server in net_client.py (run on its
+# own thread by net_events.py) and the display in ui.py. pygame (and the
+# computer opponent) are only imported once the arguments say they're needed.
 
-import numpy as np
-import pygame
-import socket
+import os
 import sys
-import time
-
-# Board settings
-ROW_COUNT = 6
-COLUMN_COUNT = 7
-
-# Piece settings. Best not to change.
-PLAYER_1_PIECE = 1
-PLAYER_2_PIECE = 2
-
-# Colors
-BLUE = (0,0,255)
-BLACK = (0,0,0)
-RED = (255,0,0)
-YELLOW = (255,255,0)
-
-# Spacing of GUI features
-SQUARE_SIZE = 68
-CIRCLE_RADIUS = (SQUARE_SIZE // 2) - 4
-LABEL_POS = (40, 10)
-TEXT_SIZE = 48
-TEXT_FONT = "monospace"
-
-# The pins connected to the button and LED
-BUTTON_PIN = 24
-LED_PIN = 23
-# How many milliseconds to wait in-between GPIO checks.
-GPIO_CHECK_DELAY = 10
-
-# Server settings
-SERVER_IP = "104.238.145.167"
-PORT = 12345
-CODEC = "ascii"
+import threading
+
+from net_client import ServerConnection, SERVER_IP, PORT, subscribe_reply
+from rules import (PLAYER_1_PIECE, PLAYER_2_PIECE, create_board, drop_piece, is_valid_location,
+                   get_next_open_row, winning_move, winning_move_at, piece_for_turn, board_full,
+                   get_position_change_delay, parse_board_args)
+from wire import COLUMN_DIGITS
 
 # How long to wait for various notifications (ms)
 START_TEXT_TIME = 1000
 
+# How much of a turn's position_change_delay the computer opponent may spend
+# thinking. The rest is left for drawing and the Pi's own overhead.
+AI_TIME_FRACTION = 0.8
+
+# The board's size and how many in a row win ("size=9x10 connect=5") can go
+# anywhere in the arguments (see rules.py). They have to match the server's.
+try:
+    sys.argv[1:], ROWS, COLUMNS, CONNECT = parse_board_args(sys.argv[1:])
+except ValueError as e:
+    print("Bad board settings: {}".format(e))
+    sys.exit()
+
 # Argument processing. If none are passed, default to red piece and testing
 # mode.
 MY_PIECE = 1
 KIOSK_MODE = False
+# Play against the computer (see ai.py) instead of someone over the network.
+AI_OPPONENT = False
+# In fake kiosk mode, the GPIO pins are simulated by fake_gpio.py, the game
+# runs in a window, and the B key presses the button.
+FAKE_GPIO = False
+# In watch mode ("python3 connect-4.py watch <game>"), we don't play. We just
+# show the moves of a game that other people are playing.
+WATCH_GAME = None
+# In match mode ("python3 connect-4.py match ..."), we play whoever else is
+# waiting, and the server tells us which piece we are.
+MATCHMAKING = False
 if len(sys.argv) == 1:
     print("No arguments passed.")
     print("Defaulting to piece 1: red.")
     print("Defaulting to testing mode.")
-    print("Script is properly run: \"python3 connect-4.py <piece> <kiosk>\"")
+    print("Script is properly run: \"python3 connect-4.py <piece> <kiosk> <ai>\"")
+    print("or, to play whoever is waiting: \"python3 connect-4.py match <kiosk>\"")
+    print("or, to watch a game: \"python3 connect-4.py watch <game>\"")
+    print("Add \"size=<rows>x<columns> connect=<n>\" to change the board.")
+elif sys.argv[1].lower() == "watch":
+    if len(sys.argv) < 3:
+        print("Which game? \"python3 connect-4.py watch <game>\"")
+        sys.exit()
+    WATCH_GAME = int(sys.argv[2])
+    print("Watching game {}.".format(WATCH_GAME))
 elif len(sys.argv) == 2:
-    MY_PIECE = int(sys.argv[1])
+    MATCHMAKING = sys.argv[1].lower() == "match"
+    if not MATCHMAKING:
+        MY_PIECE = int(sys.argv[1])
     print("Defaulting to testing mode.")
 else:
-    MY_PIECE = int(sys.argv[1])
-    if sys.argv[2].lower() == "kiosk":
+    MATCHMAKING = sys.argv[1].lower() == "match"
+    if not MATCHMAKING:
+        MY_PIECE = int(sys.argv[1])
+    modes = [arg.lower() for arg in sys.argv[2:]]
+    if "kiosk" in modes:
         print("Running in kiosk mode.")
         KIOSK_MODE = True
-        import RPi.GPIO as GPIO
+    elif "fakekiosk" in modes:
+        print("Running in kiosk mode with a fake GPIO button. Press B to push it.")
+        KIOSK_MODE = True
+        FAKE_GPIO = True
     else:
         print("Running in testing mode.")
+    if "ai" in modes:
+        print("Playing against the computer.")
+        AI_OPPONENT = True
 
-# Some derivative variables
-# 3 - MY_PIECE only works if the pieces are 1 and 2.
-OPP_PIECE = 3 - MY_PIECE
-# Our color.
-if MY_PIECE == 1:
-    MY_COLOR = RED
-    OPP_COLOR = YELLOW
-else:
-    MY_COLOR = YELLOW
-    OPP_COLOR = RED
-
-
-# Function which creates an empty "board" - a 6x7 numpy matrix.
-def create_board():
-    # Make a numpy matrix with 6 rows and 7 columns. Each item is 0 - no chip.
-    board = np.zeros((ROW_COUNT, COLUMN_COUNT))
-    return board
-
-# Function which changes the value of a given board at a given row and column
-# to a given value.
-def drop_piece(board, row, col, piece):
-    board[row][col] = piece
-
-# Function to determine if a chip can be dropped in the given column.
-def is_valid_location(board, col):
-    # The top row has an index of ROW_COUNT - 1. If the top row at a given
-    # column has a value of 0, then the chip can be dropped there.
-    return board[ROW_COUNT - 1][col] == 0
-
-# The below function is run when a user selects a column to drop a chip into.
-# It returns the lowest row available. In real life, gravity does this.
-def get_next_open_row(board, col):
-    for row in range(ROW_COUNT):
-        if board[row][col] == 0:
-            return row
-
-# A function which takes in a board and a piece. Returns True if piece has won
-# the game, or False if piece has not won the game.
-def winning_move(board, piece):
-    # Check horizontal locations for wins. Since we are only checking for
-    # horizontal wins, we don't need or want to start checking from the
-    # spaces in the rightmost 3 columns of the board since we will overstep
-    # the bounds of the board in doing so.
-    for c in range(COLUMN_COUNT - 3):
-        # For hozontal wins, we must check all the rows.
-        for r in range(ROW_COUNT):
-            if board[r][c] == piece and board[r][c+1] == piece and board[r][c+2] == piece and board[r][c+3] == piece:
-                return True
-    # Check vertical locations for wins. This is very similar to the horizontal
-    # check above.
-    for c in range(COLUMN_COUNT):
-        # We don't want or need to check all the rows.
-        for r in range(ROW_COUNT - 3):
-            if board[r][c] == piece and board[r+1][c] == piece and board[r+2][c] == piece and board[r+3][c] == piece:
-                return True
-    # Check positively sloped diagonals for wins. This only needs to be done for
-    # row 0 to ROW_COUNT-3, and column 0 to COLUMN_COUNT - 3. Anything more
-    # would result in us trying to access a variable outside the range of the
-    # board.
-    for c in range(COLUMN_COUNT - 3):
-        for r in range(ROW_COUNT - 3):
-            if board[r][c] == piece and board[r+1][c+1] == piece and board[r+2][c+2] == piece and board[r+3][c+3] == piece:
-                return True
-    # Check negatively sloped diagonals for wins. Similar to the above loop,
-    # but we only need to check from row 3 to ROW_COUNT, and column 0 to
-    # COLUMN_COUNT - 3.
-    for c in range(COLUMN_COUNT - 3):
-        for r in range(3, ROW_COUNT):
-            if board[r][c] == piece and board[r-1][c+1] == piece and board[r-2][c+2] == piece and board[r-3][c+3] == piece:
-                return True
-
-# Change the orientation of the board so it looks nice when printing,
-# then print the board.
-def print_board(board):
-    # flip the board over the 0 axis (x)
-    print(np.flip(board, 0))
-
-# Fill the top row of the screen (where text is placed) with a
-# BLACK rectangle.
-def draw_top_row():
-    pygame.draw.rect(screen, BLACK, (0, 0, screen_width, SQUARE_SIZE))
-
-# Close down Pygame and then exit the program.
-def exit_all():
-    pygame.display.quit()
-    pygame.quit()
-    sys.exit()
-
-# The function which translates the numpy matrix into a pretty picture for
-# us to look at!
-def draw_board(board):
-    # We need to flip the board to make x=0,y=0 the bottom-right.
-    board = np.flip(board, 0)
-
-    for c in range(COLUMN_COUNT):
-        for r in range(ROW_COUNT):
-            # Pygame's draw.rect() func needs a rectangle as its third argument.
-            # Rectangles have an X value, a Y value, an X size, and a Y size.
-            # There is also a 4th available parameter, but we don't need to
-            # use it - it is for the outline of the rectangle, which we don't
-            # want.
-            rect = (c*SQUARE_SIZE, (r+1)*SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE)
-            pygame.draw.rect(screen, BLUE, rect)
-
-            # Pygame's circles need a position and a radius.
-            circle_position = ((c*SQUARE_SIZE) + (SQUARE_SIZE // 2), ((r+1)*SQUARE_SIZE) + (SQUARE_SIZE // 2))
-            # We default to a black circle - no piece. If there is actually a
-            # piece at board[r][c] though, change that color.
-            circle_color = BLACK
-            if board[r][c] == PLAYER_1_PIECE:
-                circle_color = RED
-            elif board[r][c] == PLAYER_2_PIECE:
-                circle_color = YELLOW
-
-            pygame.draw.circle(screen, circle_color, circle_position, CIRCLE_RADIUS)
-
-    # This needs to be called to actually change what is shown on the screen.
-    pygame.display.update()
-
-# Check for important events (like the mouse button being clicked, the GPIO
-# button being pressed, or the QUIT signal). This is run after the chip changes
-# position over the top of the board.
-def important_event_happened():
-    for event in pygame.event.get():
-
-        # If the user has quit the game, terminate immediately.
-        if event.type == pygame.QUIT:
-            exit_all()
-
-        # Also exit if the user pressed Q.
-        elif event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_q:
-                exit_all()
-            if event.key == pygame.K_SPACE:
-                return True
-
-        # If the user clicked the mouse or button, return true.
-        elif event.type == pygame.MOUSEBUTTONDOWN:
-            return True
-
-    # We didn't find anything worth writing home about. Return False.
-    return False
-
-# This function creates the initial connection to the server.
-def init_networking(server_ip, port):
-    try:
-        # Bind to the host and port
-        server_sock.connect((server_ip, port))
-    except Exception as e:
-        print("Failed to connect to server. Exception:")
-        print(e)
-        return None
-    print("Connected to server, response: ", end='')
-    print(get_next_data(server_sock))
-
-    global socket_connected
-    socket_connected = True
-
-# Set up all the GPIO stuff. Lots of things that don't need changing here.
-def setupGPIO():
-    # Set pin mode
-    GPIO.setmode(GPIO.BCM)
-
-    # Set up our one input pin.
-    GPIO.setup(BUTTON_PIN, GPIO.IN)
-
-    # Set up our one LED pin.
-    GPIO.setup(LED_PIN, GPIO.OUT)
-
-# Is the GPIO button being pressed right now?
-def read_button():
-    return GPIO.input(BUTTON_PIN)
-
-# Get the next 2048 bytes (overkill) from a socket
-def get_next_data(sock):
-    data = sock.recv(2048).decode(CODEC)
-    # print("Received data: \"{}\"".format(data))
-    return data
-
-# Send data to the server
-def send_data(data):
-    # print("Sent data: \"{}\"".format(data))
-    server_sock.send(data.encode(CODEC))
-
-# Query the server for the opponent's move. If the other player hasn't moved
-# yet, then wait a second and try again.
-def get_move(turn_num):
-    print("Waiting for opponent to move ", end='')
-    seconds_waited = 0
-    response = ''
-    while True:
-        send_data("waiting {}".format(turn_num))
-        response = get_next_data(server_sock)
-        if response == "wait":
-            waiting_move_text(seconds_waited)
-            time.sleep(1)
-            seconds_waited += 1
-            print('.', end='')
-        elif len(response) == 1:
-            break
-    print("\nOpponent played on col {}!".format(response))
-    return(int(response))
-
-# Generic function to show text on the top of the screen. Intended to be
-# called by functions other than play_game().
-def show_text(text, color):
-    # Remove anything that was on the screen before
-    draw_top_row()
-    # Create the label and display it
-    label = text_font.render(text, 1, color)
-    # Display the label
-    screen.blit(label, LABEL_POS)
-    pygame.display.update()
-
-# Function which shows some text at the top of the screen to indicate that the
-# other player has not yet connected.
-def no_opponent_text(seconds_waited):
-    show_text(" Matching " + "." * (seconds_waited % 4), MY_COLOR)
-
-# Function which makes the Opponent playing... text
-def waiting_move_text(seconds_waited):
-    show_text(" Waiting " + "." * (seconds_waited % 4), MY_COLOR)
-
-# Show text at the top of the screen to indicate that the game is starting.
-# The one argument indicates the amount of time to wait with this text at the top.
-def show_game_start_text():
-    # Show the text.
-    show_text("Starting game!", MY_COLOR)
+# Everything from here on needs the display.
+import pygame
+import ui
+from net_events import NETWORK_EVENT, NetworkThread
+from ui import RED, YELLOW, WHITE
+
+# The computer opponent, and its opening book (see opening_book.py) if one has
+# been built.
+book = None
+if AI_OPPONENT:
+    import ai
+    import opening_book
+    if os.path.exists(opening_book.BOOK_FILE):
+        book = opening_book.OpeningBook(opening_book.BOOK_FILE)
+        print("Using the opening book, {} moves deep.".format(book.plies))
+
+# Some derivative variables. In match mode these change once the server has
+# told us our piece.
+def set_piece(piece):
+    global MY_PIECE, OPP_PIECE, MY_COLOR, OPP_COLOR
+    MY_PIECE = piece
+    # 3 - MY_PIECE only works if the pieces are 1 and 2.
+    OPP_PIECE = 3 - MY_PIECE
+    # Our color.
+    if MY_PIECE == 1:
+        MY_COLOR = RED
+        OPP_COLOR = YELLOW
+    else:
+        MY_COLOR = YELLOW
+        OPP_COLOR = RED
 
-    # Wait for duration seconds
-    pygame.time.wait(START_TEXT_TIME)
+set_piece(MY_PIECE)
 
-    # Remove the starting text
-    draw_top_row()
-    pygame.display.update()
 
-# Show text at the beginning of the game before the server connection
-# is established.
-def show_startup_screen():
-    show_text("Press to play!", MY_COLOR)
-    while True:
-        if KIOSK_MODE:
-            GPIO.output(LED_PIN, GPIO.HIGH)
-        if wait_for_event(500):
-            break
-        if KIOSK_MODE:
-            GPIO.output(LED_PIN, GPIO.LOW)
-        if wait_for_event(500):
-            break
-    if KIOSK_MODE:
-        GPIO.output(LED_PIN, GPIO.LOW)
-
-# Wait a maximum time for some interesting event (mouse click, button press).
-def wait_for_event(millis_to_wait):
-    if KIOSK_MODE:
-        start_millis = time.time() * 1000
-        while time.time() * 1000 < (start_millis + millis_to_wait):
-            if read_button():
-                return True
-            else:
-                pygame.time.wait(GPIO_CHECK_DELAY)
-    else:
-        pygame.time.wait(millis_to_wait)
-    return important_event_happened()
+# The game runs in a loop that goes round FPS times a second. Each time round
+# it handles whatever has happened (clicks, the button, messages from the
+# server, the computer's move) and moves things on the screen along. Nothing
+# in the loop waits: the server is talked to on another thread (see
+# net_events.py), and the computer thinks on one too.
+FPS = 30
 
+# How long the end of a game stays on the screen (ms).
+GAME_OVER_TIME = 5000
 
-def play_game():
+# How long the piece waits over the column a hint picked (ms), so there's
+# time to drop it there.
+HINT_HOLD_TIME = 2000
 
-    # Game variables!
+# The pygame event type posted when the computer has picked its move.
+AI_EVENT = pygame.USEREVENT + 3
 
-    # the game board
-    global board
-    # The game's state. The game is not over by default, and the game has not
-    # started by default.
-    game_over = False
-    game_started = False
-    # Which turn is it? This increments each time someone places a piece down.
-    turn = 1
-    # which spot over the board is the piece hovering? Changes many times
-    # per turn.
-    piece_col = 0
-    # Is the piece moving right or left? 1 for right, -1 for left.
-    piece_direction = 1
+# Function which shows some text at the top of the screen to indicate that the
+# other player has not yet connected.
+def no_opponent_text(seconds_waited):
+    ui.show_text(" Matching " + "." * (seconds_waited % 4), MY_COLOR)
 
-    # Show the board on the screen.
-    draw_board(board)
-    # Wait for a button press before starting.
-    show_startup_screen()
-    # The board. A numpy matrix.
-    board = create_board()
-    pygame.display.update()
+# Function which makes the Opponent playing... text
+def waiting_move_text(seconds_waited):
+    ui.show_text(" Waiting " + "." * (seconds_waited % 4), MY_COLOR)
 
-    # Start the server connection if needed.
-    if not socket_connected:
-        init_networking(SERVER_IP, PORT)
+# Let the computer pick the opponent's move, on a thread of its own, and post
+# it as an AI_EVENT. It gets as long to think as a person would have to make
+# the same move.
+def start_ai_move(board, turn_num):
+    ui.show_text(" Thinking...", OPP_COLOR)
 
-    while not game_over:
+    def think():
+        result = ai.best_move(board, OPP_PIECE, get_position_change_delay(turn_num) * AI_TIME_FRACTION, book=book)
+        print("Computer played on col {} (score {}, depth {}, {} nodes/sec).".format(
+            result.column, result.score, result.depth, result.nodes_per_sec))
+        pygame.event.post(pygame.event.Event(AI_EVENT, column=result.column))
 
-        # Draw the board as it currently is.
-        draw_board(board)
+    # The search plays moves on the board it's given, so it gets a copy.
+    board = board.copy()
+    threading.Thread(target=think, daemon=True).start()
 
-        # Clear the Pygame events.
-        pygame.event.clear()
 
-        if not game_started:
+# One game, from "Press to play!" to the end. The game is always in one of
+# these states, and moves between them as things happen:
+#
+#   "startup"       waiting for a press to start
+#   "connecting"    waiting for the connection to the server
+#   "joining"       sent our piece ("p=1"), waiting to hear if there's an
+#                   opponent
+#   "matching"      waiting for the server to start the game
+#   "starting"      showing "Starting game!"
+#   "our turn"      the piece is moving over the board, waiting for a press
+#   "sending"       sent our move, waiting for the server to agree
+#   "opponent"      waiting for the other player's (or the computer's) move
+#   "reconnecting"  lost the server, connecting again
+#   "resuming"      asked to get back into the game, waiting for the moves
+#   "over"          showing the end of the game
+class Game:
+
+    # board is the last game's board, which is shown until someone presses
+    # the button.
+    def __init__(self, board):
+        self.board = board
+        self.state = None
+        # When we got into the current state, and when it ends (for states
+        # that only last so long), in pygame ticks (ms).
+        self.state_since = 0
+        self.deadline = 0
+        # Shows text that changes every second (the moving "..."), given
+        # the number of seconds spent in the state, or None.
+        self.waiting_text = None
+        self.seconds_shown = -1
+        self.started = False
+        self.finished = False
+        # Which turn is it? This increments each time someone places a piece down.
+        self.turn = 1
+        # which spot over the board is the piece hovering? Changes many times
+        # per turn.
+        self.piece_col = 0
+        # Is the piece moving right or left? 1 for right, -1 for left.
+        self.piece_direction = 1
+        # When the piece next moves, and how long it stays in each column.
+        self.next_hover = 0
+        self.position_change_delay = 0
+        # The column we asked the server to play.
+        self.sent_col = None
+        # Whether the LED is on while we wait to start.
+        self.led_on = False
+        # The token that gets us back into this game if the connection
+        # drops (see dispatch.py), or None.
+        self.token = None
+        # The turn we last asked the server for a hint on, or None.
+        self.hint_turn = None
+
+        ui.draw_board(self.board)
+        ui.show_text("Press to play!", MY_COLOR)
+        self.enter("startup")
+
+    def enter(self, state, waiting_text=None, duration=None):
+        self.state = state
+        self.state_since = pygame.time.get_ticks()
+        if duration is not None:
+            self.deadline = self.state_since + duration
+        self.waiting_text = waiting_text
+        self.seconds_shown = -1
+
+    # Called every time round the loop. now is the time in pygame ticks.
+    def tick(self, now):
+        if self.state == "startup":
+            # Blink the LED: on for half a second, off for half a second.
+            led_on = (now - self.state_since) // 500 % 2 == 0
+            if led_on != self.led_on:
+                ui.set_led(led_on)
+                self.led_on = led_on
+        elif self.state == "our turn" and now >= self.next_hover:
+            self.move_piece()
+            self.next_hover = now + self.position_change_delay
+        elif self.state == "starting" and now >= self.deadline:
+            ui.clear_text()
+            self.start_turn()
+        elif self.state == "over" and now >= self.deadline:
+            self.finished = True
+
+        if self.waiting_text is not None:
+            seconds = (now - self.state_since) // 1000
+            if seconds != self.seconds_shown:
+                self.waiting_text(seconds)
+                self.seconds_shown = seconds
+                if seconds:
+                    print('.', end='', flush=True)
+
+    # The mouse was clicked or the big red button pressed.
+    def on_press(self):
+        if self.state == "startup":
+            self.start()
+        elif self.state == "our turn":
+            self.try_move(self.piece_col)
+
+    def on_network(self, kind, data):
+        if kind == "lost":
+            self.on_lost()
+        elif kind == "connected":
+            self.on_connected(data)
+        elif data.startswith("token "):
+            # The answer to asking for a resume token. It can come whatever
+            # state we're in.
+            self.token = data.split(' ')[1]
+        elif data.startswith("analysis"):
+            # So can a hint, if the search took a while.
+            self.on_analysis(data)
+        else:
+            # Replies that are pushed to spectators too, like "ended", end
+            # with a newline, since a spectator can get several at once.
+            self.on_message(data.rstrip("\n"))
+
+    # H was pressed. Ask the server which column is best (see analysis.py),
+    # once per turn. The computer opponent doesn't give hints.
+    def on_hint_request(self):
+        if self.state != "our turn" or AI_OPPONENT or self.hint_turn == self.turn:
+            return
+        self.hint_turn = self.turn
+        print("Asking the server for a hint.")
+        net.send("analyze {}".format("".join(COLUMN_DIGITS[col] for col in self.board.moves)))
+
+    # The server's hint. If it's still our turn, move the piece over the best
+    # column and hold it there for a moment.
+    def on_analysis(self, message):
+        if self.state != "our turn" or self.hint_turn != self.turn or message == "analysis":
+            return
+        best, scores = message.split(' ')[1].split(':')
+        print("Hint: column {} (scores {}).".format(int(best) + 1, scores.replace(',', ' ')))
+        self.piece_col = int(best)
+        ui.draw_hover(self.piece_col, MY_COLOR)
+        self.next_hover = pygame.time.get_ticks() + HINT_HOLD_TIME
+
+    # Someone pressed the button. Get a game going.
+    def start(self):
+        ui.set_led(False)
+        # The board. A Bitboard.
+        self.board = create_board(ROWS, COLUMNS, CONNECT)
+        ui.draw_board(self.board)
+        ui.clear_text()
+        if AI_OPPONENT:
+            # The computer doesn't need a server, and is always ready to play.
+            self.game_started()
+        elif not net.connected:
+            net.connect(SERVER_IP, PORT)
+            self.enter("connecting")
+        else:
+            self.join()
+
+    # Ask the server for a game.
+    def join(self):
+        if MATCHMAKING:
+            # Ask the server for an opponent. It replies as soon as there's
+            # one, with the piece we're playing: "start 1" or "start 2".
+            net.send("match")
+            print("Waiting to be matched with another player.", end='')
+            self.enter("matching", no_opponent_text)
+        else:
             # send the server our piece
-            send_data("p={}".format(MY_PIECE))
+            net.send("p={}".format(MY_PIECE))
             print("Sent piece to server.")
-
-            # Check if other player has connected
-            response = get_next_data(server_sock)
-            if response == "wait":
-                # Other player hasn't connected. Let's wait.
+            self.enter("joining")
+
+    def game_started(self):
+        print("\nOpponent found! Starting game.")
+        self.started = True
+        ui.show_text("Starting game!", MY_COLOR)
+        self.enter("starting", duration=START_TEXT_TIME)
+        if not AI_OPPONENT:
+            # Ask for the token that gets us back into this game if the
+            # connection drops.
+            net.send("token")
+
+    # Start the next turn, whoever's it is.
+    def start_turn(self):
+        # If every space is taken and nobody has won, the game is a tie.
+        if board_full(self.board):
+            ui.show_text("    Tie!", MY_COLOR)
+            self.game_over()
+        elif 2 - (self.turn % 2) == MY_PIECE:
+            # It's our turn! Start moving the piece over the top of the
+            # board. Clicks made while the other player was playing don't
+            # count.
+            ui.clear_events()
+            self.position_change_delay = get_position_change_delay(self.turn)
+            ui.clear_text()
+            ui.set_led(True)
+            ui.draw_hover(self.piece_col, MY_COLOR)
+            self.enter("our turn")
+            self.next_hover = self.state_since + self.position_change_delay
+        elif AI_OPPONENT:
+            start_ai_move(self.board, self.turn)
+            self.enter("opponent")
+        else:
+            # The server doesn't reply until the other player has actually
+            # moved, so there's no need to keep asking.
+            print("Waiting for opponent to move ", end='')
+            net.send("subscribe {}".format(self.turn))
+            self.enter("opponent", waiting_move_text)
+
+    # Move the piece to the next column, bouncing off the sides. Only the
+    # square it left and the square it moved to are redrawn.
+    def move_piece(self):
+        if self.piece_col == COLUMNS - 1 and self.piece_direction == 1:
+            # We reached the right side of the board.
+            # Move back a column and change direction.
+            self.piece_direction = -1
+            self.piece_col = COLUMNS - 2
+        elif self.piece_col == 0 and self.piece_direction == -1:
+            # We reached the left side of the board.
+            # Move to col 1 and change direction.
+            self.piece_direction = 1
+            self.piece_col = 1
+        else:
+            self.piece_col += self.piece_direction
+        ui.draw_hover(self.piece_col, MY_COLOR)
+
+    # The player wants to drop the piece in col.
+    def try_move(self, col):
+        if not is_valid_location(self.board, col):
+            return
+        if AI_OPPONENT:
+            self.play_ours(col)
+            return
+        # Valid move! Send the turn to the server, and play it once the
+        # server has it.
+        self.sent_col = col
+        net.send("turn {}:{}".format(self.turn, col))
+        self.enter("sending")
+
+    def play_ours(self, col):
+        ui.set_led(False)
+        row = get_next_open_row(self.board, col)
+        drop_piece(self.board, row, col, MY_PIECE)
+        ui.draw_move(self.board, row, col)
+        self.turn += 1
+
+        # Check to see if the game is over. Only the lines through the chip
+        # we just dropped can have changed.
+        winning_cells = winning_move_at(self.board, row, col)
+        if winning_cells:
+            # It is! Show the winning chips.
+            ui.highlight_cells(winning_cells)
+            ui.show_text("Player {} wins!".format(MY_PIECE), MY_COLOR)
+            self.game_over()
+        else:
+            self.start_turn()
+
+    # Assuming the other player isn't cheating in some way, this will be a
+    # guaranteed good move.
+    def play_theirs(self, col):
+        print("\nOpponent played on col {}!".format(col))
+        row = get_next_open_row(self.board, col)
+        drop_piece(self.board, row, col, OPP_PIECE)
+        ui.draw_move(self.board, row, col)
+        self.turn += 1
+
+        # Check if the other player has just won.
+        winning_cells = winning_move_at(self.board, row, col)
+        if not winning_cells:
+            self.start_turn()
+            return
+        # They did! gg!
+        ui.highlight_cells(winning_cells)
+        ui.show_text("Player {} wins!".format(OPP_PIECE), OPP_COLOR)
+        # The server saw the winning move too, and has already ended the game.
+        self.game_over()
+
+    def on_ai_move(self, col):
+        if self.state == "opponent":
+            self.play_theirs(col)
+
+    def on_message(self, message):
+        if self.state == "joining":
+            if message == "wait":
+                # Other player hasn't connected. Ask the server to tell us as
+                # soon as they do.
                 print("Waiting for other player to connect.", end='')
-                seconds_waited = 0
-                while True:
-                    time.sleep(1)
-                    seconds_waited += 1
-                    send_data("waited")
-                    if get_next_data(server_sock) == "start":
-                        print("\nOpponent found! Starting game.")
-                        game_started = True
-                        show_game_start_text()
-                        break
-                    no_opponent_text(seconds_waited)
-
-            # If the initial response is "start", then the other player has
-            # already connected.
-            elif response == "start":
-                print("Opponent found! Starting game.")
-                game_started = True
-                show_game_start_text()
-
-        # If we get to turn 43, then the game is a tie. Tell the user this,
-        # and then break.
-        if turn == 43:
-            show_text("    Tie!", MY_COLOR)
-            game_over = True
-            break
-
-        # If we get here, the other player has connected.
-
-        if 2 - (turn % 2) == MY_PIECE:
-            # It's player 1's turn! Start moving the piece over the top of the
-            # board.
-
-            # Clear any events from the queue. This is done so that we don't
-            # count clicks made while the other player was playing.
-            pygame.event.clear()
-
-            # How long should we wait before changing the position of the piece? (ms)
-            # This time starts off at 500ms, then goes down by 25ms for each
-            # turn until it reaches 100ms. It then stays there fore the rest
-            # of the game.
-            if turn <= 17:
-                position_change_delay = 500 - (25 * (turn - 1))
+                net.send("waitstart")
+                self.enter("matching", no_opponent_text)
+            elif message == "start":
+                # The other player had already connected.
+                self.game_started()
+        elif self.state == "matching":
+            if message.startswith("start "):
+                set_piece(int(message.split()[1]))
+                print("\nMatched! Playing piece {}.".format(MY_PIECE))
+                self.game_started()
+            elif message == "start":
+                self.game_started()
+        elif self.state == "sending":
+            if message == "affirm":
+                print("Turn {}:{} received by server.".format(self.turn, self.sent_col))
+                self.play_ours(self.sent_col)
+            elif message == "refused":
+                # The server doesn't think this move can be played, so the
+                # boards don't agree and the game can't go on.
+                print("\nThe server refused turn {}:{}.".format(self.turn, self.sent_col))
+                ui.show_text(" Move refused", WHITE)
+                self.game_over()
+            else:
+                net.send("turn {}:{}".format(self.turn, self.sent_col))
+        elif self.state == "opponent":
+            kind, col = subscribe_reply(message, self.board)
+            if kind == "moved":
+                self.play_theirs(col)
+            elif kind == "ended":
+                # The other player left and never came back.
+                print("\nOpponent left the game.")
+                ui.show_text(" Opponent left", WHITE)
+                self.game_over()
+            elif kind == "lost":
+                # The server has a move we can't play, or doesn't know this
+                # turn. Either way our board isn't the server's, and there's
+                # no carrying on.
+                print("\nThe server sent {!r} for turn {}.".format(message, self.turn))
+                ui.show_text(" Game lost", WHITE)
+                self.game_over()
+            else:
+                # Not an answer to "subscribe", which is still waiting on the
+                # server. Asking again would get the move twice, so ignore it.
+                print("\nIgnoring {!r} from the server.".format(message))
+        elif self.state == "resuming":
+            if message.startswith("resumed "):
+                piece, columns = message.split(' ')[1].split(':')
+                self.resumed(int(piece), [int(col, 36) for col in columns])
             else:
-                position_change_delay = 100
-
-            is_our_turn = True
-            while is_our_turn:
-
-                # Remove the previous piece's circle on the screen.
-                draw_top_row()
-
-                # Turn on the LED if we're in kiosk mode.
-                if KIOSK_MODE:
-                    GPIO.output(LED_PIN, GPIO.HIGH)
-
-                # Determine the piece's position and draw it.
-                circle_pos = ((piece_col * SQUARE_SIZE) + (SQUARE_SIZE // 2), SQUARE_SIZE // 2)
-                pygame.draw.circle(screen, MY_COLOR, circle_pos, CIRCLE_RADIUS)
-                pygame.display.update()
-
-                # If, in the last position_change_delay millis, the mouse was
-                # clicked or the GPIO was pressed, try to place the piece.
-                if wait_for_event(position_change_delay):
-
-                    # Looks like the user clicked the mouse or the big red
-                    # button! See if we can execute that move.
-                    if is_valid_location(board, piece_col):
-
-                        # Valid move! Send the turn to the server.
-                        while True:
-                            send_data("turn {}:{}".format(turn, piece_col))
-                            if get_next_data(server_sock) == "affirm":
-                                print("Turn {}:{} received by server.".format(turn, piece_col))
-                                if KIOSK_MODE:
-                                    GPIO.output(LED_PIN, GPIO.LOW)
-                                break
-
-
-                        # Place the piece.
-                        row = get_next_open_row(board, piece_col)
-                        drop_piece(board, row, piece_col, MY_PIECE)
-                        # Draw the top row to get rid of the piece that was
-                        # just there.
-                        draw_top_row()
-                        draw_board(board)
-                        pygame.display.update()
-                        is_our_turn = False
-                        turn += 1
-
-                        # Check to see if the game is over.
-                        if winning_move(board, MY_PIECE):
-                            # It is!
-                            # Make the label which will be displayed.
-                            show_text("Player {} wins!".format(MY_PIECE), MY_COLOR)
-                            game_over = True
-
-
-                # If we get here, nothing interesting happened since we started
-                # wait()ing. Move the piece to the next column.
-                else:
-                    if piece_col == 6 and piece_direction == 1:
-                        # We reached the right side of the board.
-                        # Move to col 5 and change direction.
-                        piece_direction = -1
-                        piece_col = 5
-                    elif piece_col == 0 and piece_direction == -1:
-                        # We reached the left side of the board.
-                        # Move to col 1 and change direction.
-                        piece_direction = 1
-                        piece_col = 1
-                    else:
-                        piece_col += piece_direction
+                ui.show_text(" Game lost", WHITE)
+                self.game_over()
 
+    def on_connected(self, connected):
+        if self.state == "connecting":
+            if connected:
+                self.join()
+            else:
+                ui.show_text(" No server!", WHITE)
+                self.game_over()
+        elif self.state == "reconnecting":
+            if not connected:
+                ui.show_text(" No server!" if not self.started else " Game lost", WHITE)
+                self.game_over()
+            elif not self.started:
+                # There's no game to get back into. Just ask for one again.
+                self.join()
+            elif self.token is None:
+                ui.show_text(" Game lost", WHITE)
+                self.game_over()
+            else:
+                net.send("resume {}".format(self.token))
+                self.enter("resuming")
+
+    # We lost the server. Get back into the game (or, if it hadn't started
+    # yet, back in the queue) and carry on from wherever the server says the
+    # game is.
+    def on_lost(self):
+        if self.state in ("startup", "over", "reconnecting"):
+            # Nothing's going on that needs the server. The next game
+            # connects again.
+            return
+        ui.show_text(" Reconnecting", MY_COLOR)
+        ui.set_led(False)
+        net.reconnect()
+        self.enter("reconnecting")
+
+    # We're back in the game. The server sent every move so far in one
+    # message: rebuild the board in one pass, and redraw it all at once.
+    def resumed(self, piece, columns):
+        set_piece(piece)
+        print("Back in the game after {} moves.".format(len(columns)))
+        self.board = create_board(ROWS, COLUMNS, CONNECT)
+        winning_cells = None
+        for turn_num, col in enumerate(columns, 1):
+            row = get_next_open_row(self.board, col)
+            drop_piece(self.board, row, col, piece_for_turn(turn_num))
+            winning_cells = winning_move_at(self.board, row, col)
+        ui.draw_board(self.board)
+        ui.clear_text()
+        self.turn = len(columns) + 1
+
+        # The game might have been won while we were away. If it filled the
+        # board instead, start_turn() calls it a tie.
+        if winning_cells:
+            winner = piece_for_turn(len(columns))
+            ui.highlight_cells(winning_cells)
+            ui.show_text("Player {} wins!".format(winner), MY_COLOR if winner == MY_PIECE else OPP_COLOR)
+            self.game_over()
         else:
-            # Looks like it's not our turn. Get (read: wait for) the opponent's
-            # move, then do the normal operations on it. Assuming the other
-            # player isn't cheating in some way, this will be a guaranteed
-            # good move.
-            opp_move = get_move(turn)
-            row = get_next_open_row(board, opp_move)
-            drop_piece(board, row, opp_move, OPP_PIECE)
-            draw_board(board)
-            pygame.display.update()
-
-            # Check if the other player has just won.
-            if winning_move(board, OPP_PIECE):
-                # They did! gg!
-                show_text("Player {} wins!".format(OPP_PIECE), OPP_COLOR)
-                game_over = True
-                # Tell the server that the game is over.
-                while True:
-                    print("Telling the server that the game is over.")
-                    send_data("gameover")
-                    if get_next_data(server_sock) == "affirm":
-                        break
-
-            # Increment the turn counter.
-            turn += 1
-
-
-
-    # Looks like the game just ended!
-    # Let's wait a few seconds to let this sink in.
-    pygame.time.wait(5000)
+            self.start_turn()
+
+    # Looks like the game just ended! Leave it on the screen for a few
+    # seconds to let this sink in.
+    def game_over(self):
+        ui.set_led(False)
+        self.enter("over", duration=GAME_OVER_TIME)
+
+
+# Run the loop until the game is over. Returns the game's board.
+def play_game(board):
+    game = Game(board)
+    clock = pygame.time.Clock()
+    while not game.finished:
+        for event in pygame.event.get():
+            if event.type == NETWORK_EVENT:
+                game.on_network(event.kind, event.data)
+            elif event.type == AI_EVENT:
+                game.on_ai_move(event.column)
+            elif ui.is_hint_request(event):
+                game.on_hint_request()
+            elif ui.handle_event(event):
+                game.on_press()
+        game.tick(pygame.time.get_ticks())
+        clock.tick(FPS)
+    return game.board
+
+# Watch a game being played by other people, until it ends. The server sends
+# every move so far, then each move as it's played (see dispatch.py).
+def watch_game(game_id):
+    board = create_board(ROWS, COLUMNS, CONNECT)
+    ui.draw_board(board)
+    net.connect(SERVER_IP, PORT)
+
+    # With ASCII, several messages can arrive together, and the last one
+    # might not have arrived in full. Each one ends with a newline.
+    partial = ""
+    clock = pygame.time.Clock()
+    while True:
+        for event in pygame.event.get():
+            if event.type != NETWORK_EVENT:
+                # Keep the window responsive (and Q working).
+                ui.handle_event(event)
+                continue
+            if event.kind == "connected":
+                if not event.data:
+                    ui.show_text(" No server!", WHITE)
+                    return
+                net.send("watch {}".format(game_id))
+                continue
+            if event.kind == "lost":
+                ui.show_text(" Disconnected", WHITE)
+                return
+            lines = (partial + event.data).split("\n")
+            partial = lines.pop()
+            for line in lines:
+                if line == "watching":
+                    ui.show_text(" Game {}".format(game_id), WHITE)
+                elif line.startswith("played"):
+                    turn_num, col = [int(part) for part in line.split(' ')[1].split(':')]
+                    piece = piece_for_turn(turn_num)
+                    row = get_next_open_row(board, col)
+                    drop_piece(board, row, col, piece)
+                    ui.draw_move(board, row, col)
+                    cells = winning_move_at(board, row, col)
+                    if cells:
+                        ui.highlight_cells(cells)
+                        ui.show_text("Player {} wins!".format(piece), RED if piece == PLAYER_1_PIECE else YELLOW)
+                elif line == "ended":
+                    if not winning_move(board, PLAYER_1_PIECE) and not winning_move(board, PLAYER_2_PIECE):
+                        ui.show_text(" Game over", WHITE)
+                    return
+        clock.tick(FPS)
 
 
 #
@@ -541,44 +640,27 @@ def play_game():
 #
 #
 
-# initialize pygame
-pygame.init()
-
-# FYI: The Raspi screens are 800x480 pixels.
-
-# Determine screen width and height. The height gets an extra square added
-# for the space that holds the text and the piece to be dropped.
-screen_width = COLUMN_COUNT * SQUARE_SIZE
-screen_height = (ROW_COUNT + 1) * SQUARE_SIZE
-screen_size = (screen_width, screen_height)
-
-# Depending on whether or not we're in kiosk mode, activate fullscreen.
-if KIOSK_MODE:
-    screen = pygame.display.set_mode(screen_size, pygame.FULLSCREEN)
-else:
-    screen = pygame.display.set_mode(screen_size)
-
-text_font = pygame.font.SysFont(TEXT_FONT, TEXT_SIZE)
-
-# If we're in kiosk mode, set up GPIO.
-if KIOSK_MODE:
-    setupGPIO()
+# Open the window (and set up GPIO if we're in kiosk mode).
+ui.open_display(KIOSK_MODE, FAKE_GPIO, ROWS, COLUMNS)
 
 # Start up networking! This doesn't actually connect to anything yet (that is
-# done where the user can see). The two arguments here are really just
-# boilerplate to us. We don't need to change them.
-server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-socket_connected = False
+# done where the user can see). From here on the connection belongs to the
+# network thread.
+net = NetworkThread(ServerConnection())
 
-board = create_board()
+board = create_board(ROWS, COLUMNS, CONNECT)
+
+if WATCH_GAME is not None:
+    watch_game(WATCH_GAME)
+    # Leave the final board up until someone closes the window.
+    while True:
+        ui.wait_for_event(1000)
 
 while True:
 
     # Clear any events from the queue. This prevents people from placing chips
     # in-between games.
-    pygame.event.clear()
+    ui.clear_events()
 
     # start the game! Lessss gooo!
-    play_game()
-
-server_sock.close()
+    board = play_game(board)
@@ -0,0 +1,280 @@
+# The server's side of the Connect 4 protocol.
+#
+# Both server cores (the one-thread-per-connection core in server.py and the
+# asyncio core in async_server.py) read messages off their sockets and hand
+# them to handle_message(), so the two always give the same replies.
+#
+# Messages a client can send, and the replies it gets, written the ASCII way
+# (wire.py has the framed versions):
+#   "p=1" / "p=2"  -> "start" if the opponent is here, otherwise "wait"
+#   "waited"       -> "start" once the opponent is here, otherwise "wait"
+#   "turn x:y"     -> "affirm". Records column y for turn x. "refused" if it
+#                     isn't the player's turn x, or column y can't be played.
+#                     A move that wins or fills the board ends the game.
+#   "waiting x"    -> the column played on turn x, or "wait". "refused" if
+#                     the game has no turn x.
+#   "gameover"     -> "affirm". Frees the game, if the last move didn't
+#                     already end it.
+#
+# Clients that don't want to poll with "waited" and "waiting x" can send these
+# instead. The reply isn't sent until there is something to say, so the
+# client just waits for it:
+#   "waitstart"    -> "start", as soon as the opponent is here
+#   "subscribe x"  -> the column played on turn x, as soon as it is played
+# Both are "refused" if the client hasn't joined a game, and "subscribe x" is
+# if the game has no turn x.
+#
+# A client that doesn't mind which piece it plays can ask to be matched with
+# whoever else is waiting. The reply comes as soon as there's someone:
+#   "match"        -> "start 1" or "start 2", the piece to play
+#
+# A player whose connection drops can get back into their game on a new
+# connection, and catch up on everything that happened in one go:
+#   "token"        -> "token x" once the game has started (otherwise "wait",
+#                     or "ended" if it's over). x is the player's resume
+#                     token.
+#   "resume x"     -> "resumed p:ccc", where p is the player's piece and ccc
+#                     every column played so far. A game that was won or
+#                     drawn can still be resumed for a couple of minutes,
+#                     to see how it ended. After that, or if it was
+#                     abandoned, the reply is "ended".
+#
+# A player who leaves a game and doesn't come back within a couple of minutes
+# has abandoned it (see lifecycle.py). Anyone still waiting for something to
+# happen in the game is sent "ended".
+#
+# A client that's waiting for a reply can let the server know it's still
+# there (and find out the server still is):
+#   "ping"         -> "pong"
+#
+# Anyone can ask how good each move is in a position, for a hint. The
+# position is searched on another process (see analysis.py), and the reply
+# comes once it's done, or straight away if it has been searched before:
+#   "analyze ccc"  -> "analysis b:s,s,...", where ccc is every column played
+#                     so far (written like "resumed" writes them), b the
+#                     best column to play next and s the score of each
+#                     column ("x" if it's full). Just "analysis" if the
+#                     game is over or the moves can't be played.
+#
+# Anyone can watch a game being played:
+#   "watch x"      -> "watching", then "played t:c" for every move so far and
+#                     every move after that, then "ended" when game x is
+#                     over. Just "ended" if there's no game x.
+
+import time
+
+import wire
+from sessions import MOVE_DRAWN, MOVE_REFUSED, MOVE_REPEATED, MOVE_WON
+
+# The first thing sent to every client when it connects.
+GREETING = "Welcome to the server!".encode(wire.CODEC)
+
+# How many connections can be waiting to be accepted at once.
+BACKLOG = 128
+
+# A spectator with this many bytes it hasn't read yet is dropped, so that a
+# slow spectator can never hold up the game it's watching.
+SPECTATOR_BUFFER_LIMIT = 64 * 1024
+
+
+class Client:
+
+    __slots__ = ("sessions", "send", "push", "analyzer", "session", "piece", "watching", "last_seen",
+                 "idle_timer")
+
+    def __init__(self, sessions, send, push, analyzer=None):
+        # The SessionTable the server is using.
+        self.sessions = sessions
+        # A function which sends a reply tuple (see wire.py) to this client.
+        # The server core provides this, and it is used to push replies to
+        # clients that are waiting for something to happen in their game.
+        self.send = send
+        # A function which pushes something to a spectator. It is given an
+        # (ASCII, framed) pair of already encoded messages (see wire.py),
+        # writes the one this client understands without waiting, and
+        # returns False if the client can't keep up and has been dropped.
+        self.push = push
+        # The Analyzer (see analysis.py) that works out hints, or None if
+        # the server doesn't give them.
+        self.analyzer = analyzer
+        # The game this connection is playing in, and which piece it is
+        # playing. Both are None until the client tells us its piece.
+        self.session = None
+        self.piece = None
+        # The game this client is watching, if any.
+        self.watching = None
+        # When the client last sent us anything (time.monotonic()), and the
+        # timer that checks whether it has gone quiet for too long. See
+        # lifecycle.py.
+        self.last_seen = time.monotonic()
+        self.idle_timer = None
+
+
+# Work out the reply to one message from a client. The message is a request
+# tuple and the reply is a reply tuple (see wire.py), so this doesn't care
+# which protocol the client speaks. Returns None if the reply will be pushed
+# to the client later, once there is something to tell it.
+def handle_message(client, message):
+
+    op, a, b = message
+    # default reply
+    reply = wire.REPLY_NOTHING
+    session = client.session
+    client.last_seen = time.monotonic()
+
+    # The client wants to use the framed protocol. The reader has already
+    # switched over, so all that's left is to say hello back.
+    if op == wire.HELLO:
+        reply = wire.REPLY_HELLO
+
+    # If a player sends us an initial message while they are already in a
+    # game, it's likely that the game ended and they want to play again.
+    # Leave the old game before joining a new one.
+    elif op == wire.JOIN and (a == 1 or a == 2):
+        client.sessions.unmatch(client)
+        if session is not None:
+            client.sessions.leave(session, client.piece, client)
+        client.piece = a
+        session, waiters = client.sessions.join(client.piece)
+        client.session = session
+        print("Player {} joined game {}.".format(client.piece, session.id))
+        # Let the opponent know straight away if they were waiting for us.
+        for waiter in waiters:
+            waiter.send(wire.REPLY_START)
+        if session.started():
+            reply = wire.REPLY_START
+        else:
+            reply = wire.REPLY_WAIT
+
+    elif op == wire.MATCH:
+        client.sessions.unmatch(client)
+        if session is not None:
+            client.sessions.leave(session, client.piece, client)
+            client.session = None
+        opponent = client.sessions.match(client)
+        if opponent is None:
+            reply = None
+        else:
+            print("Matched two players in game {}.".format(client.session.id))
+            opponent.send((wire.MATCHED, opponent.piece))
+            reply = (wire.MATCHED, client.piece)
+
+    elif op == wire.WAITED:
+        if session is not None and session.started():
+            reply = wire.REPLY_START
+        else:
+            reply = wire.REPLY_WAIT
+
+    elif op == wire.WAITSTART:
+        if session is None:
+            reply = wire.REPLY_REFUSED
+        elif client.sessions.subscribe(session, 0, client):
+            reply = wire.REPLY_START
+        else:
+            reply = None
+
+    elif op == wire.GAMEOVER:
+        # The game is over. Free it so its memory can be reused. It usually
+        # already is: the server ends games itself when they're won or drawn.
+        if session is not None:
+            if not session.finished:
+                client.sessions.finish(session)
+                print("Game {} is over. {} games left.".format(session.id, client.sessions.count()))
+            client.session = None
+        reply = wire.REPLY_AFFIRM
+
+    elif op == wire.TURN:
+        # This is turn data. Very important. a is the turn, b the column.
+        if session is None:
+            result, waiters = MOVE_REFUSED, []
+        else:
+            result, waiters = client.sessions.record_move(session, client.piece, a, b)
+        if result == MOVE_REFUSED:
+            print("Refused turn {}:{} from player {}.".format(a, b, client.piece))
+            reply = wire.REPLY_REFUSED
+        else:
+            if result != MOVE_REPEATED:
+                print("Game {}. Turn num: {}. Column: {}".format(session.id, a, b))
+            # Push the move to the opponent if they subscribed to this turn.
+            for waiter in waiters:
+                waiter.send((wire.MOVE, b))
+            if result == MOVE_WON:
+                print("Game {} won by player {}. {} games left.".format(
+                    session.id, client.piece, client.sessions.count()))
+            elif result == MOVE_DRAWN:
+                print("Game {} is a draw. {} games left.".format(session.id, client.sessions.count()))
+            reply = wire.REPLY_AFFIRM
+
+    elif op == wire.WAITING:
+        # Nothing has been played in a game the client hasn't joined yet.
+        if session is None:
+            reply = wire.REPLY_WAIT
+        elif not session.has_turn(a):
+            reply = wire.REPLY_REFUSED
+        else:
+            move = session.get_move(a)
+            if move is None:
+                reply = wire.REPLY_WAIT
+            else:
+                reply = (wire.MOVE, move)
+
+    elif op == wire.WATCH:
+        if client.watching is not None:
+            client.sessions.unwatch(client.watching, client)
+            client.watching = None
+        if client.sessions.watch(a, client):
+            reply = None
+        else:
+            reply = wire.REPLY_ENDED
+
+    elif op == wire.TOKEN:
+        if session is not None and session.finished:
+            reply = wire.REPLY_ENDED
+        elif session is not None and session.started():
+            reply = (wire.SESSION_TOKEN, client.sessions.issue_token(session, client.piece, client))
+        else:
+            reply = wire.REPLY_WAIT
+
+    elif op == wire.RESUME:
+        client.sessions.unmatch(client)
+        if session is not None:
+            client.sessions.leave(session, client.piece, client)
+            client.session = None
+        resumed = client.sessions.resume(a, client)
+        if resumed is None:
+            reply = wire.REPLY_ENDED
+        else:
+            client.session, client.piece = resumed
+            print("Player {} is back in game {}.".format(client.piece, client.session.id))
+            reply = (wire.RESUMED, client.piece, client.session.columns())
+
+    elif op == wire.PING:
+        reply = wire.REPLY_PONG
+
+    elif op == wire.ANALYZE:
+        # b is every column played so far.
+        if client.analyzer is None:
+            reply = wire.REPLY_NO_ANALYSIS
+        else:
+            reply = client.analyzer.analyze(b, client.send)
+
+    elif op == wire.SUBSCRIBE:
+        if session is None or not session.has_turn(a):
+            reply = wire.REPLY_REFUSED
+        elif client.sessions.subscribe(session, a, client):
+            reply = (wire.MOVE, session.get_move(a))
+        else:
+            reply = None
+
+    return reply
+
+
+# The client went away. Take it out of its game.
+def client_disconnected(client):
+    client.sessions.unmatch(client)
+    if client.watching is not None:
+        client.sessions.unwatch(client.watching, client)
+        client.watching = None
+    if client.session is not None:
+        client.sessions.leave(client.session, client.piece, client)
+        client.session = None
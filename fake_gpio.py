@@ -0,0 +1,120 @@
+# A stand-in for the RPi.GPIO module, for running kiosk mode on a computer
+# that isn't a Raspberry Pi.
+#
+# It has the parts of RPi.GPIO that connect-4.py uses, so it can be imported
+# in its place ("import fake_gpio as GPIO"). Nothing is wired to anything:
+# outputs are just remembered, and press() and release() change an input pin
+# and fire any callbacks registered with add_event_detect(), on a separate
+# thread like the real library does.
+
+import threading
+import time
+
+# Pin numbering modes
+BCM = 11
+BOARD = 10
+
+# Pin directions
+IN = 1
+OUT = 0
+
+# Levels
+HIGH = 1
+LOW = 0
+
+# Edges
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+# Pull up/down resistors
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+
+# The current level of every pin that has been set up.
+pin_levels = {}
+# The pins with event detection on them: pin -> (edge, callbacks, bouncetime,
+# time of the last edge that fired the callbacks).
+event_pins = {}
+# Only one thread touches the pins at once.
+lock = threading.Lock()
+
+
+def setmode(mode):
+    pass
+
+
+def setwarnings(flag):
+    pass
+
+
+def setup(pin, direction, pull_up_down=PUD_OFF, initial=LOW):
+    with lock:
+        pin_levels[pin] = initial
+
+
+def input(pin):
+    with lock:
+        return pin_levels.get(pin, LOW)
+
+
+def output(pin, level):
+    with lock:
+        pin_levels[pin] = level
+
+
+def add_event_detect(pin, edge, callback=None, bouncetime=0):
+    with lock:
+        callbacks = [callback] if callback is not None else []
+        event_pins[pin] = (edge, callbacks, bouncetime, [0.0])
+
+
+def add_event_callback(pin, callback):
+    with lock:
+        event_pins[pin][1].append(callback)
+
+
+def remove_event_detect(pin):
+    with lock:
+        event_pins.pop(pin, None)
+
+
+def cleanup(pin=None):
+    with lock:
+        if pin is None:
+            pin_levels.clear()
+            event_pins.clear()
+        else:
+            pin_levels.pop(pin, None)
+            event_pins.pop(pin, None)
+
+
+# Change the level of an input pin, as if something outside had done it, and
+# fire the pin's callbacks if that was an edge they're waiting for.
+def set_input(pin, level):
+    with lock:
+        old_level = pin_levels.get(pin, LOW)
+        pin_levels[pin] = level
+        if pin not in event_pins or old_level == level:
+            return
+        edge, callbacks, bouncetime, last_fired = event_pins[pin]
+        if edge == RISING and level == LOW or edge == FALLING and level == HIGH:
+            return
+        now = time.monotonic()
+        if (now - last_fired[0]) * 1000 < bouncetime:
+            return
+        last_fired[0] = now
+        callbacks = callbacks[:]
+
+    for callback in callbacks:
+        threading.Thread(target=callback, args=(pin,), daemon=True).start()
+
+
+# Press and release a button wired to pin.
+def press(pin):
+    set_input(pin, HIGH)
+
+
+def release(pin):
+    set_input(pin, LOW)
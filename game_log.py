@@ -0,0 +1,328 @@
+# A permanent record of every game played on the server.
+#
+# When a game ends, the server used to throw its moves away. Now they are
+# appended to a log file, along with when the game started and ended and how
+# it turned out. Each move is stored as a 3-bit column number (enough for up
+# to 8 columns), so a whole 42-move game is 16 bytes of moves:
+#
+#     log header:   magic, version, rows, columns, how many in a row win
+#     game record:  start time (4 B), end time (4 B), result (1 B),
+#                   number of moves (1 B), the moves packed 3 bits each
+#
+# Records are different sizes, so finding a game in the log would mean reading
+# every record before it. A second file, the index, has one fixed-size entry
+# per game, in the same order:
+#
+#     index header: magic, version
+#     index entry:  offset of the game's record in the log (8 B), end time
+#                   (4 B), result (1 B)
+#
+# A game's ID is its position in the index, so fetching a game by ID is one
+# read from each file. Games are logged in the order they end, so the end
+# times in the index only ever go up and a range of dates can be found with a
+# binary search. Filtering by result only reads the index.
+#
+# The server must never wait for the disk in the middle of a game, so
+# GameLog.append() only adds the game to a list. A writer thread takes
+# everything on the list every FLUSH_INTERVAL seconds (or sooner, once
+# BATCH_SIZE games are waiting) and writes it in one go.
+#
+# Show one game:       python3 game_log.py <id> [log file]
+# List games:          python3 game_log.py list [red|yellow|draw|unfinished]
+#                                               [since YYYY-MM-DD] [until YYYY-MM-DD]
+
+import os
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from bitboard import Bitboard, ROW_COUNT, COLUMN_COUNT, CONNECT
+
+LOG_FILE = "games.log"
+
+LOG_MAGIC = b"C4GL"
+INDEX_MAGIC = b"C4GI"
+VERSION = 2
+LOG_HEADER = struct.Struct(">4sBBBB")
+# Version 1 logs don't say how many in a row win. It was always four.
+LOG_HEADER_V1 = struct.Struct(">4sBBB")
+INDEX_HEADER = struct.Struct(">4sB")
+RECORD_HEADER = struct.Struct(">IIBB")
+INDEX_ENTRY = struct.Struct(">QIB")
+
+# How a game turned out.
+UNFINISHED = 0  # someone left before the end
+RED_WIN = 1
+YELLOW_WIN = 2
+DRAW = 3
+RESULT_NAMES = {UNFINISHED: "unfinished", RED_WIN: "red", YELLOW_WIN: "yellow", DRAW: "draw"}
+
+# How often the writer thread writes (seconds), and how many games waiting to
+# be written make it write straight away.
+FLUSH_INTERVAL = 1.0
+BATCH_SIZE = 256
+
+# One game read back from the log. moves is a list of columns, in order.
+GameRecord = namedtuple("GameRecord", ["id", "start_time", "end_time", "result", "moves"])
+
+
+# The index file that goes with a log file.
+def index_path(path):
+    return path + ".idx"
+
+
+# How many bits each move takes for a board with this many columns.
+def move_bits(columns):
+    return max(1, (columns - 1).bit_length())
+
+
+# Pack a list of columns into bytes, bits bits each, first move lowest.
+def pack_moves(moves, bits):
+    value = 0
+    for i, col in enumerate(moves):
+        value |= col << (i * bits)
+    return value.to_bytes((len(moves) * bits + 7) // 8, "little")
+
+
+def unpack_moves(data, count, bits):
+    value = int.from_bytes(data, "little")
+    mask = (1 << bits) - 1
+    return [(value >> (i * bits)) & mask for i in range(count)]
+
+
+# Read a log's header. Returns (magic, version, rows, columns, connect, the
+# header's size).
+def read_log_header(log_file):
+    log_file.seek(0)
+    magic, version, rows, columns = LOG_HEADER_V1.unpack(log_file.read(LOG_HEADER_V1.size))
+    if version == 1:
+        return magic, version, rows, columns, 4, LOG_HEADER_V1.size
+    connect = log_file.read(1)[0]
+    return magic, version, rows, columns, connect, LOG_HEADER.size
+
+
+# Work out how a game ended from its moves.
+def game_result(moves, rows, columns, connect):
+    board = Bitboard(rows, columns, connect)
+    piece = 1
+    for col in moves:
+        row = board.play(col, piece)
+        if board.winning_cells(row, col):
+            return piece
+        piece = 3 - piece
+    if board.is_full():
+        return DRAW
+    return UNFINISHED
+
+
+class GameLog:
+
+    def __init__(self, path=LOG_FILE, rows=ROW_COUNT, columns=COLUMN_COUNT, connect=CONNECT):
+        self.path = path
+        self.rows = rows
+        self.columns = columns
+        self.connect = connect
+        self.bits = move_bits(columns)
+        self.log_file, self.index_file = open_files(path, rows, columns, connect)
+        # Games waiting for the writer thread: (start time, end time, moves).
+        self.pending = []
+        self.condition = threading.Condition()
+        self.closing = False
+        self.thread = threading.Thread(target=self.write_forever, daemon=True)
+        self.thread.start()
+
+    # Log a finished game. moves holds the column played on each turn plus
+    # one, from turn 1, with 0 after the last move (see sessions.py). Only
+    # takes a copy and returns; the writing happens on the writer thread.
+    def append(self, start_time, moves):
+        with self.condition:
+            self.pending.append((start_time, int(time.time()), bytes(moves)))
+            if len(self.pending) >= BATCH_SIZE:
+                self.condition.notify()
+
+    def write_forever(self):
+        while True:
+            with self.condition:
+                if not self.pending and not self.closing:
+                    self.condition.wait(FLUSH_INTERVAL)
+                batch = self.pending
+                self.pending = []
+                closing = self.closing
+            if batch:
+                self.write_batch(batch)
+            if closing:
+                return
+
+    # Write a batch of games to the end of the log and index.
+    def write_batch(self, batch):
+        offset = self.log_file.tell()
+        records = []
+        entries = []
+        for start_time, end_time, slots in batch:
+            moves = []
+            for slot in slots[1:]:
+                if slot == 0:
+                    break
+                moves.append(slot - 1)
+            result = game_result(moves, self.rows, self.columns, self.connect)
+            record = RECORD_HEADER.pack(start_time, end_time, result, len(moves)) + pack_moves(moves, self.bits)
+            records.append(record)
+            entries.append(INDEX_ENTRY.pack(offset, end_time, result))
+            offset += len(record)
+        # The log first, so the index never points at a record that isn't
+        # there.
+        self.log_file.write(b"".join(records))
+        self.log_file.flush()
+        self.index_file.write(b"".join(entries))
+        self.index_file.flush()
+
+    # Write anything still waiting and close the files.
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join()
+        self.log_file.close()
+        self.index_file.close()
+
+
+# Open (or create) a log and its index for appending. If the server stopped in
+# the middle of writing, cut off whatever was only half written, so the two
+# files agree again. Returns the two files.
+def open_files(path, rows, columns, connect):
+    log_file = open(path, "a+b")
+    index_file = open(index_path(path), "a+b")
+    if log_file.seek(0, os.SEEK_END) == 0:
+        log_file.write(LOG_HEADER.pack(LOG_MAGIC, VERSION, rows, columns, connect))
+    if index_file.seek(0, os.SEEK_END) == 0:
+        index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, VERSION))
+    log_file.flush()
+    index_file.flush()
+
+    # Version 1 logs are the same apart from the header, so new games can
+    # still be added to them.
+    magic, version, log_rows, log_columns, log_connect, header_size = read_log_header(log_file)
+    if magic != LOG_MAGIC or version > VERSION or (log_rows, log_columns, log_connect) != (rows, columns, connect):
+        raise ValueError("{} isn't a game log for this version and board size".format(path))
+
+    log_size = log_file.seek(0, os.SEEK_END)
+    index_size = index_file.seek(0, os.SEEK_END)
+    entries = (index_size - INDEX_HEADER.size) // INDEX_ENTRY.size
+    log_end = header_size
+    while entries > 0:
+        index_file.seek(INDEX_HEADER.size + (entries - 1) * INDEX_ENTRY.size)
+        offset, end_time, result = INDEX_ENTRY.unpack(index_file.read(INDEX_ENTRY.size))
+        log_file.seek(offset)
+        header = log_file.read(RECORD_HEADER.size)
+        if len(header) == RECORD_HEADER.size:
+            move_count = RECORD_HEADER.unpack(header)[3]
+            record_end = offset + RECORD_HEADER.size + (move_count * move_bits(columns) + 7) // 8
+            if record_end <= log_size:
+                log_end = record_end
+                break
+        entries -= 1
+    index_file.truncate(INDEX_HEADER.size + entries * INDEX_ENTRY.size)
+    log_file.truncate(log_end)
+    log_file.seek(0, os.SEEK_END)
+    index_file.seek(0, os.SEEK_END)
+    return log_file, index_file
+
+
+class GameLogReader:
+
+    def __init__(self, path=LOG_FILE):
+        self.log_file = open(path, "rb")
+        self.index_file = open(index_path(path), "rb")
+        magic, version, self.rows, self.columns, self.connect, header_size = read_log_header(self.log_file)
+        if magic != LOG_MAGIC or version > VERSION:
+            self.close()
+            raise ValueError("{} isn't a game log this version can read".format(path))
+        self.bits = move_bits(self.columns)
+
+    # How many games are in the log.
+    def count(self):
+        return (os.fstat(self.index_file.fileno()).st_size - INDEX_HEADER.size) // INDEX_ENTRY.size
+
+    # The index entry of a game: (log offset, end time, result).
+    def entry(self, game_id):
+        self.index_file.seek(INDEX_HEADER.size + game_id * INDEX_ENTRY.size)
+        return INDEX_ENTRY.unpack(self.index_file.read(INDEX_ENTRY.size))
+
+    # Fetch a game by ID. Raises IndexError if there's no such game.
+    def get(self, game_id):
+        if not 0 <= game_id < self.count():
+            raise IndexError("no game {}".format(game_id))
+        offset = self.entry(game_id)[0]
+        self.log_file.seek(offset)
+        start_time, end_time, result, move_count = RECORD_HEADER.unpack(self.log_file.read(RECORD_HEADER.size))
+        data = self.log_file.read((move_count * self.bits + 7) // 8)
+        return GameRecord(game_id, start_time, end_time, result, unpack_moves(data, move_count, self.bits))
+
+    # The ID of the first game that ended at or after timestamp.
+    def first_after(self, timestamp):
+        low = 0
+        high = self.count()
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[1] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Every game that ended in [since, until) and, if result isn't None, had
+    # that result. Times are Unix timestamps. Only the matching games' records
+    # are read from the log.
+    def find(self, since=None, until=None, result=None):
+        first = 0 if since is None else self.first_after(since)
+        last = self.count() if until is None else self.first_after(until)
+        self.index_file.seek(INDEX_HEADER.size + first * INDEX_ENTRY.size)
+        entries = self.index_file.read((last - first) * INDEX_ENTRY.size)
+        matching = [first + i for i, (offset, end_time, entry_result)
+                    in enumerate(INDEX_ENTRY.iter_unpack(entries))
+                    if result is None or entry_result == result]
+        for game_id in matching:
+            yield self.get(game_id)
+
+    def close(self):
+        self.log_file.close()
+        self.index_file.close()
+
+
+def describe(game):
+    return "Game {}: {} to {}, {} moves, {}. Moves: {}".format(
+        game.id, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(game.start_time)),
+        time.strftime("%H:%M:%S", time.localtime(game.end_time)), len(game.moves),
+        RESULT_NAMES[game.result], "".join(str(col) for col in game.moves))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "list":
+        args = sys.argv[2:]
+        result = None
+        since = None
+        until = None
+        path = LOG_FILE
+        while args:
+            arg = args.pop(0)
+            if arg in RESULT_NAMES.values():
+                result = [number for number, name in RESULT_NAMES.items() if name == arg][0]
+            elif arg == "since":
+                since = time.mktime(time.strptime(args.pop(0), "%Y-%m-%d"))
+            elif arg == "until":
+                until = time.mktime(time.strptime(args.pop(0), "%Y-%m-%d"))
+            else:
+                path = arg
+        reader = GameLogReader(path)
+        for game in reader.find(since, until, result):
+            print(describe(game))
+        reader.close()
+    elif len(sys.argv) >= 2:
+        reader = GameLogReader(sys.argv[2] if len(sys.argv) >= 3 else LOG_FILE)
+        print(describe(reader.get(int(sys.argv[1]))))
+        reader.close()
+    else:
+        print("Usage: python3 game_log.py <id> [log file]")
+        print("       python3 game_log.py list [red|yellow|draw|unfinished] [since YYYY-MM-DD] [until YYYY-MM-DD] [log file]")
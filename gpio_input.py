@@ -0,0 +1,48 @@
+# Turning GPIO button presses into pygame events.
+#
+# The game used to check the button every GPIO_CHECK_DELAY milliseconds while
+# it waited for input. That kept the Pi's CPU busy doing nothing, and a quick
+# press in between two checks was missed. Instead, we ask the GPIO library to
+# call us back when the button pin goes high, and the callback posts a
+# BUTTON_EVENT into pygame's event queue. The game then handles the button
+# exactly like a mouse click or a key press.
+#
+# Works with RPi.GPIO on the Pi, or with fake_gpio.py anywhere else.
+
+import time
+
+import pygame
+
+# The pygame event type posted when the button is pressed.
+BUTTON_EVENT = pygame.USEREVENT + 1
+
+# Presses closer together than this (ms) are treated as the same press. Cheap
+# buttons "bounce" and can look like several presses to the Pi.
+DEBOUNCE_MS = 200
+
+
+# Start posting a BUTTON_EVENT whenever the button on pin is pressed. gpio is
+# the GPIO module (RPi.GPIO or fake_gpio), already set up with the pin as an
+# input.
+def start_button_events(gpio, pin, debounce_ms=DEBOUNCE_MS):
+    # When the last press we let through happened, in seconds. A list so the
+    # callback can change it.
+    last_press = [0.0]
+
+    # Called by the GPIO library on its own thread. pygame.event.post() is
+    # safe to call from any thread.
+    def on_press(channel):
+        now = time.monotonic()
+        if (now - last_press[0]) * 1000 < debounce_ms:
+            return
+        last_press[0] = now
+        pygame.event.post(pygame.event.Event(BUTTON_EVENT, pin=channel))
+
+    # The GPIO library also debounces, but we do it ourselves too so the
+    # behaviour is the same whatever the backend.
+    gpio.add_event_detect(pin, gpio.RISING, callback=on_press, bouncetime=debounce_ms)
+
+
+# Stop posting button events.
+def stop_button_events(gpio, pin):
+    gpio.remove_event_detect(pin)
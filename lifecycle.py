@@ -0,0 +1,142 @@
+# Getting rid of connections and games that nobody is using any more.
+#
+# A kiosk that loses power doesn't hang up. Its connection just goes quiet,
+# and without something to notice, the server would keep it (and its thread,
+# in the threaded core) and its game forever. Over weeks of uptime that adds
+# up. Three things deal with it:
+#
+#   - TCP keepalive, turned on for every connection. The operating system
+#     probes a connection that has been silent for a while, and if the other
+#     end is gone the connection is closed, even for kiosks that don't know
+#     anything about the rest of this.
+#   - A read deadline for every player in a game: a connection that hasn't
+#     sent anything for IDLE_TIMEOUT seconds while in a game is closed. Newer
+#     clients send "ping" while they wait for a reply, so a player waiting
+#     for a slow opponent isn't mistaken for one who has gone. Connections
+#     that aren't in a game (kiosks sitting at "Press to play!", spectators)
+#     have no deadline, since the original kiosks send nothing at all then.
+#   - When a player leaves a game that has started, the game is given
+#     ABANDON_TIMEOUT seconds for them to come back ("resume", see
+#     dispatch.py). If they don't, the game is freed and anyone still waiting
+#     in it is sent "ended".
+#
+# All of these timeouts live on one TimerWheel (see timer_wheel.py), so tens
+# of thousands of them cost next to nothing. A connection's deadline isn't
+# moved every time it sends something: each message just records the time
+# (Client.last_seen), and when the timer goes off it works out whether the
+# connection really has been quiet that long, and if not, sets itself again
+# for the rest of the time.
+
+import socket
+import threading
+import time
+
+import wire
+from timer_wheel import TimerWheel
+
+# How long (seconds) a player in a game can go without sending anything.
+IDLE_TIMEOUT = 300
+# How long (seconds) a game waits for a player who left to come back.
+ABANDON_TIMEOUT = 120
+# The TCP keepalive settings: start probing after KEEPALIVE_IDLE seconds of
+# silence, probe every KEEPALIVE_INTERVAL seconds, and give up after
+# KEEPALIVE_COUNT probes go unanswered.
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 6
+
+
+# Turn on TCP keepalive for a socket. The timings can only be set on some
+# systems. Elsewhere the system's defaults are used.
+def enable_keepalive(sock):
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+    except OSError:
+        pass
+
+
+class Reaper:
+
+    # sessions is the SessionTable and metrics the ServerMetrics of the core
+    # using this.
+    def __init__(self, sessions, metrics):
+        self.sessions = sessions
+        self.metrics = metrics
+        self.wheel = TimerWheel()
+        # In the threaded core, a connection's thread can forget it while the
+        # timer thread is checking it.
+        self.lock = threading.Lock()
+
+    # Start keeping an eye on a new connection. close is a function that
+    # closes it (from any thread), after which the core cleans up as it
+    # would for any other disconnection.
+    def watch(self, client, close):
+        client.idle_timer = self.wheel.schedule(IDLE_TIMEOUT, lambda: self.check(client, close))
+
+    # A client's timer went off. Close it if it has been quiet for too long
+    # in a game, otherwise look again when it could next have been.
+    def check(self, client, close):
+        with self.lock:
+            if client.idle_timer is None:
+                # The connection has already closed.
+                return
+            session = client.session
+            delay = IDLE_TIMEOUT
+            if session is not None and not session.finished:
+                idle = time.monotonic() - client.last_seen
+                if idle >= IDLE_TIMEOUT:
+                    client.idle_timer = None
+                    expired = True
+                else:
+                    expired = False
+                    delay = IDLE_TIMEOUT - idle
+            else:
+                expired = False
+            if not expired:
+                client.idle_timer = self.wheel.schedule(delay, lambda: self.check(client, close))
+                return
+        print("Closing a connection that has been idle for {:.0f} s in game {}.".format(idle, session.id))
+        self.metrics.connection_reaped()
+        close()
+
+    # A connection has closed. session is the game it was in (before
+    # client_disconnected() took it out), or None.
+    def forget(self, client, session):
+        with self.lock:
+            if client.idle_timer is not None:
+                self.wheel.cancel(client.idle_timer)
+                client.idle_timer = None
+        if session is not None and not session.finished:
+            self.wheel.schedule(ABANDON_TIMEOUT, lambda: self.abandon(session))
+
+    # A player left session ABANDON_TIMEOUT seconds ago. If they haven't come
+    # back, end the game.
+    def abandon(self, session):
+        waiters = self.sessions.abandon(session)
+        if waiters is None:
+            return
+        print("Game {} was abandoned. {} games left.".format(session.id, self.sessions.count()))
+        self.metrics.game_abandoned()
+        for waiter in waiters:
+            waiter.send(wire.REPLY_ENDED)
+
+    # Fire the timers on a thread of their own, for the threaded core.
+    def start_thread(self):
+        def run():
+            while True:
+                time.sleep(self.wheel.tick_length)
+                self.wheel.advance()
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    # Fire the timers from an asyncio event loop, for the asyncio cores.
+    def start_on_loop(self, loop):
+        def run():
+            self.wheel.advance()
+            loop.call_later(self.wheel.tick_length, run)
+        loop.call_later(self.wheel.tick_length, run)
@@ -0,0 +1,268 @@
+# Counting what the server does, so we can see how it's coping.
+#
+# Both server cores tell the ServerMetrics object about every connection,
+# every message (with how long handle_message() took), and every byte sent
+# and received. render() turns all that into the Prometheus text format:
+#
+#     # TYPE connect4_messages_total counter
+#     connect4_messages_total{type="turn"} 1234
+#
+# which Prometheus (or anything else that scrapes it) can read, and which is
+# also easy enough for a person to read. It can be fetched from the stats
+# port (curl http://127.0.0.1:12346/metrics) or printed by sending the server
+# SIGUSR1 (kill -USR1 <pid>).
+#
+# Recording a message is one lock, a handful of list updates and a bisect, so
+# it's cheap enough to leave on all the time.
+
+import bisect
+import socket
+import threading
+import time
+
+import wire
+
+# The port the stats are served on, on localhost only.
+STATS_PORT = 12346
+
+# The upper bounds (in seconds) of the handle_message() latency histogram
+# buckets. Anything slower goes in the last, "+Inf", bucket.
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05)
+
+# The name each kind of message is reported under.
+MESSAGE_NAMES = {
+    wire.HELLO: "hello",
+    wire.JOIN: "join",
+    wire.WAITED: "waited",
+    wire.WAITSTART: "waitstart",
+    wire.TURN: "turn",
+    wire.WAITING: "waiting",
+    wire.SUBSCRIBE: "subscribe",
+    wire.GAMEOVER: "gameover",
+    wire.WATCH: "watch",
+    wire.MATCH: "match",
+    wire.TOKEN: "token",
+    wire.RESUME: "resume",
+    wire.PING: "ping",
+    wire.ANALYZE: "analyze",
+    wire.UNKNOWN: "unknown",
+}
+# The messages that ask "has anything happened yet?". The rest of the time
+# spent on them is wasted if the answer is "wait".
+POLL_MESSAGES = (wire.WAITED, wire.WAITING)
+
+# Opcodes are numbered below this (see wire.py), so they can index lists.
+OPCODE_COUNT = wire.UNKNOWN + 1
+
+
+class ServerMetrics:
+
+    def __init__(self):
+        # The threaded core records from every connection's thread at once.
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.connections = 0
+        self.connections_total = 0
+        # Connections closed for sitting idle, and games given up on after a
+        # player left them (see lifecycle.py).
+        self.connections_reaped = 0
+        self.games_abandoned = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Per opcode: how many messages, how many of them were polls answered
+        # with "wait", the total time spent handling them, and the latency
+        # histogram (one count per bucket, plus one for +Inf).
+        self.messages = [0] * OPCODE_COUNT
+        self.empty_polls = [0] * OPCODE_COUNT
+        self.handler_seconds = [0.0] * OPCODE_COUNT
+        self.histograms = [[0] * (len(LATENCY_BUCKETS) + 1) for op in range(OPCODE_COUNT)]
+        # The message counts at the last render(), and when that was, for
+        # working out the messages per second since then.
+        self.last_messages = [0] * OPCODE_COUNT
+        self.last_render = time.monotonic()
+
+    # A connection was opened. new is False if it was already counted by
+    # another process and has just been handed to this one.
+    def connection_opened(self, new=True):
+        with self.lock:
+            self.connections += 1
+            if new:
+                self.connections_total += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def connection_reaped(self):
+        with self.lock:
+            self.connections_reaped += 1
+
+    def game_abandoned(self):
+        with self.lock:
+            self.games_abandoned += 1
+
+    def received(self, nbytes):
+        with self.lock:
+            self.bytes_in += nbytes
+
+    def sent(self, nbytes):
+        with self.lock:
+            self.bytes_out += nbytes
+
+    # A message was handled. op is its opcode, reply the reply tuple (or
+    # None if it was deferred), and seconds how long handle_message() took.
+    def message_handled(self, op, reply, seconds):
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            self.messages[op] += 1
+            self.handler_seconds[op] += seconds
+            self.histograms[op][bucket] += 1
+            if reply is wire.REPLY_WAIT and op in POLL_MESSAGES:
+                self.empty_polls[op] += 1
+
+    # The counts, as a dict, for sending to another process.
+    def snapshot(self):
+        with self.lock:
+            return {
+                "connections": self.connections,
+                "connections_total": self.connections_total,
+                "connections_reaped": self.connections_reaped,
+                "games_abandoned": self.games_abandoned,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "messages": self.messages[:],
+                "empty_polls": self.empty_polls[:],
+                "handler_seconds": self.handler_seconds[:],
+                "histograms": [histogram[:] for histogram in self.histograms],
+            }
+
+    # Replace the counts with the totals of some snapshots.
+    def load(self, snapshots):
+        totals = ServerMetrics().snapshot()
+        for snapshot in snapshots:
+            for name, value in snapshot.items():
+                if name == "histograms":
+                    totals[name] = [[a + b for a, b in zip(mine, theirs)]
+                                    for mine, theirs in zip(totals[name], value)]
+                elif isinstance(value, list):
+                    totals[name] = [a + b for a, b in zip(totals[name], value)]
+                else:
+                    totals[name] += value
+        with self.lock:
+            for name, value in totals.items():
+                setattr(self, name, value)
+
+    # Everything, in the Prometheus text format. games is how many games are
+    # being played. extra is more metrics to include, as (name, type, help,
+    # value) tuples.
+    def render(self, games, extra=()):
+        now = time.monotonic()
+        with self.lock:
+            messages = self.messages[:]
+            empty_polls = self.empty_polls[:]
+            handler_seconds = self.handler_seconds[:]
+            histograms = [histogram[:] for histogram in self.histograms]
+            connections = self.connections
+            connections_total = self.connections_total
+            connections_reaped = self.connections_reaped
+            games_abandoned = self.games_abandoned
+            bytes_in = self.bytes_in
+            bytes_out = self.bytes_out
+            elapsed = max(now - self.last_render, 1e-9)
+            last_messages = self.last_messages
+            self.last_messages = messages
+            self.last_render = now
+        ops = [op for op in MESSAGE_NAMES if messages[op]]
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP connect4_{} {}".format(name, help_text))
+            lines.append("# TYPE connect4_{} {}".format(name, kind))
+            for labels, value in samples:
+                lines.append("connect4_{}{} {}".format(name, labels, value))
+
+        def label(op):
+            return '{{type="{}"}}'.format(MESSAGE_NAMES[op])
+
+        metric("uptime_seconds", "gauge", "Seconds since the server started.",
+               [("", round(time.time() - self.start_time, 3))])
+        metric("connections", "gauge", "Connections open now.", [("", connections)])
+        metric("connections_total", "counter", "Connections accepted.", [("", connections_total)])
+        metric("connections_reaped_total", "counter", "Connections closed for being idle.",
+               [("", connections_reaped)])
+        metric("games", "gauge", "Games that haven't finished.", [("", games)])
+        metric("games_abandoned_total", "counter", "Games ended because a player left and didn't come back.",
+               [("", games_abandoned)])
+        metric("received_bytes_total", "counter", "Bytes received from clients.", [("", bytes_in)])
+        metric("sent_bytes_total", "counter", "Bytes sent to clients.", [("", bytes_out)])
+        for name, kind, help_text, value in extra:
+            metric(name, kind, help_text, [("", value)])
+        metric("messages_total", "counter", "Messages handled, by type.",
+               [(label(op), messages[op]) for op in ops])
+        metric("messages_per_second", "gauge", "Messages handled per second since the last report, by type.",
+               [(label(op), round((messages[op] - last_messages[op]) / elapsed, 3)) for op in ops])
+        metric("empty_polls_total", "counter", "Polls answered with \"wait\", by type.",
+               [(label(op), empty_polls[op]) for op in POLL_MESSAGES if messages[op]])
+
+        polls = sum(messages[op] for op in POLL_MESSAGES)
+        if messages[wire.TURN]:
+            metric("polls_per_move", "gauge", "Polling messages (waited, waiting) per move played.",
+                   [("", round(polls / messages[wire.TURN], 3))])
+
+        lines.append("# HELP connect4_handler_seconds Time spent in handle_message(), by message type.")
+        lines.append("# TYPE connect4_handler_seconds histogram")
+        for op in ops:
+            name = MESSAGE_NAMES[op]
+            count = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS, histograms[op]):
+                count += bucket_count
+                lines.append('connect4_handler_seconds_bucket{{type="{}",le="{}"}} {}'.format(name, bound, count))
+            lines.append('connect4_handler_seconds_bucket{{type="{}",le="+Inf"}} {}'.format(name, messages[op]))
+            lines.append('connect4_handler_seconds_sum{{type="{}"}} {:.6f}'.format(name, handler_seconds[op]))
+            lines.append('connect4_handler_seconds_count{{type="{}"}} {}'.format(name, messages[op]))
+
+        return "\n".join(lines) + "\n"
+
+
+# Serve the stats to anyone who connects to port on localhost, on a thread of
+# its own. render is a function that returns them as text. Whatever the other
+# end sends is ignored and the reply is a minimal HTTP response, so a browser,
+# curl or Prometheus can all read it. Returns the thread, or None if the port
+# couldn't be opened.
+def start_stats_server(render, port=STATS_PORT):
+    stats_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    stats_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        stats_socket.bind(("127.0.0.1", port))
+        stats_socket.listen(8)
+    except OSError as e:
+        print("Couldn't serve stats on port {}: {}".format(port, e))
+        stats_socket.close()
+        return None
+
+    def serve():
+        while True:
+            connection, addr = stats_socket.accept()
+            try:
+                # Read the request, if there is one, so the client doesn't see
+                # a reset. Don't wait long for it.
+                connection.settimeout(0.5)
+                try:
+                    connection.recv(4096)
+                except OSError:
+                    pass
+                body = render().encode("utf-8")
+                connection.sendall(b"HTTP/1.0 200 OK\r\n"
+                                   b"Content-Type: text/plain; version=0.0.4\r\n"
+                                   b"Content-Length: " + str(len(body)).encode("ascii") + b"\r\n\r\n" + body)
+            except OSError:
+                pass
+            finally:
+                connection.close()
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    print("Serving stats on 127.0.0.1:{}.".format(port))
+    return thread
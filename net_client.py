@@ -0,0 +1,274 @@
+# The client end of the connection to server.py.
+#
+# A ServerConnection connects, agrees the protocol (framed if the server knows
+# it, ASCII if not), and sends and receives messages as the same ASCII text
+# either way, so the code using it never has to care which protocol is in use.
+# It only needs socket and wire.py, so a bot or a test can talk to the server
+# without pygame.
+#
+# If the connection drops in the middle of a game, reconnect() connects again
+# and uses the game's resume token (see dispatch.py) to get back in. The
+# server answers with every move played so far, in one message.
+#
+# While waiting for the other player, a framed connection sends "ping" every
+# HEARTBEAT_INTERVAL seconds. That stops the server from taking us for a
+# kiosk that has gone (see lifecycle.py), and if the server stops answering,
+# we find out and reconnect instead of waiting forever.
+
+import socket
+import time
+from collections import deque
+
+import wire
+
+# Server settings
+SERVER_IP = "104.238.145.167"
+PORT = 12345
+CODEC = "ascii"
+# Which protocol to talk to the server with. "framed" is the length-prefixed
+# protocol in wire.py, which can't be confused by TCP splitting or joining
+# messages. "ascii" is the original protocol. If the server doesn't know the
+# framed protocol, we fall back to ASCII automatically.
+PROTOCOL = "framed"
+# How long to wait for the server to agree to the framed protocol (seconds).
+HANDSHAKE_TIMEOUT = 2
+# How many times to try to connect again after the connection drops, and how
+# long to wait between tries (seconds).
+RECONNECT_ATTEMPTS = 10
+RECONNECT_DELAY = 1
+# How often to ping the server while waiting (seconds), and how long it can
+# go without sending anything before we give up on the connection.
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 35
+
+
+# What the server's answer to "subscribe x" means, for a game whose board
+# (a Bitboard) is board. One of:
+#   ("moved", col)   the opponent played col, which board has room in
+#   ("ended", None)  the opponent left the game and never came back
+#   ("lost", None)   "refused", or a column board can't take: our board
+#                    isn't the server's, so the game can't go on
+#   ("other", None)  not an answer to "subscribe" at all
+# "ended" is also pushed to spectators, so it may end with a newline.
+def subscribe_reply(message, board):
+    message = message.rstrip("\n")
+    if message == "ended":
+        return "ended", None
+    if message == "refused":
+        return "lost", None
+    if message.isdigit():
+        col = int(message)
+        if col < board.columns and board.can_play(col):
+            return "moved", col
+        return "lost", None
+    return "other", None
+
+
+class ServerConnection:
+
+    def __init__(self, protocol=PROTOCOL):
+        self.protocol = protocol
+        self.sock = None
+        self.connected = False
+        self.address = None
+        # The resume token for the game we're playing, as the hex the server
+        # sent, or None.
+        self.token = None
+        # Only used with the framed protocol: the buffer frames from the
+        # server are read into, and any whole frames that haven't been looked
+        # at yet.
+        self.reader = None
+        self.pending_replies = deque()
+        # When we last heard from the server (time.monotonic()), and whether
+        # it has ever answered a ping. Old servers don't, so they're never
+        # given up on.
+        self.last_heard = 0
+        self.answers_pings = False
+        # When we last pinged the server.
+        self.last_ping = 0
+
+    # This function creates the initial connection to the server. Returns
+    # True if it worked.
+    def connect(self, server_ip=SERVER_IP, port=PORT):
+        self.address = (server_ip, port)
+        self.reader = None
+        self.pending_replies.clear()
+        self.answers_pings = False
+        try:
+            # Bind to the host and port
+            self.sock = socket.create_connection((server_ip, port))
+        except Exception as e:
+            print("Failed to connect to server. Exception:")
+            print(e)
+            return False
+        # The greeting is always plain ASCII.
+        print("Connected to server, response: ", end='')
+        print(self.sock.recv(2048).decode(CODEC))
+
+        if self.protocol == "framed" and not self.start_framing():
+            # Old servers hang up on (or ignore) the framed handshake. Connect
+            # again and speak ASCII instead.
+            print("Server doesn't know the framed protocol. Using ASCII.")
+            self.sock.close()
+            self.sock = socket.create_connection((server_ip, port))
+            self.sock.recv(2048)
+
+        self.connected = True
+        return True
+
+    # Ask the server to use the framed protocol. Returns True if it agreed.
+    def start_framing(self):
+        self.sock.settimeout(HANDSHAKE_TIMEOUT)
+        try:
+            self.sock.send(wire.HELLO_BYTES)
+            agreed = self.sock.recv(len(wire.HELLO_BYTES)) == wire.HELLO_BYTES
+        except OSError:
+            agreed = False
+        finally:
+            self.sock.settimeout(None)
+        if agreed:
+            self.reader = wire.MessageReader(framed=True)
+        return agreed
+
+    # Get the next message from the server, as ASCII text. With the framed
+    # protocol this is exactly one frame, however TCP chopped it up. With the
+    # ASCII protocol it's the next 2048 bytes (overkill). Raises
+    # ConnectionError if the server hung up.
+    def receive(self):
+        if self.reader is None:
+            data = self.sock.recv(2048).decode(CODEC)
+            if not data:
+                raise ConnectionError("server closed the connection")
+        else:
+            # Frames are received straight into the reader's buffer. Keep
+            # going until at least one whole frame has arrived.
+            while True:
+                while not self.pending_replies:
+                    nbytes = self.sock.recv_into(self.reader.free_space())
+                    if not nbytes:
+                        raise ConnectionError("server closed the connection")
+                    self.last_heard = time.monotonic()
+                    self.pending_replies.extend(self.reader.received(nbytes))
+                data = wire.reply_text(self.pending_replies.popleft())
+                # Answers to pings are only there to show the server is up.
+                if data != "pong":
+                    break
+                self.answers_pings = True
+        # print("Received data: \"{}\"".format(data))
+        return data
+
+    # Read whatever the server has sent, with a single recv(), and return the
+    # messages it completed (maybe none) as ASCII text. Only for callers that
+    # know there's something to read (see net_events.py): unlike receive(),
+    # this never waits for the rest of a message. Raises ConnectionError if
+    # the server hung up.
+    def poll(self):
+        if self.reader is None:
+            data = self.sock.recv(2048).decode(CODEC)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            return [data]
+        nbytes = self.sock.recv_into(self.reader.free_space())
+        if not nbytes:
+            raise ConnectionError("server closed the connection")
+        self.last_heard = time.monotonic()
+        self.pending_replies.extend(self.reader.received(nbytes))
+        messages = []
+        while self.pending_replies:
+            data = wire.reply_text(self.pending_replies.popleft())
+            if data == "pong":
+                self.answers_pings = True
+            else:
+                messages.append(data)
+        return messages
+
+    # Send data to the server. data is always written the ASCII way, and
+    # turned into a frame if we're using the framed protocol.
+    def send(self, data):
+        # print("Sent data: \"{}\"".format(data))
+        if self.reader is None:
+            self.sock.send(data.encode(CODEC))
+        else:
+            self.sock.send(wire.encode_request(wire.parse_ascii(data)))
+
+    # Send a message and return the server's reply.
+    def request(self, data):
+        self.send(data)
+        return self.receive()
+
+    # Wait for the server to push us a message. While we wait, tick is called
+    # once a second with the number of seconds waited so far (to keep the
+    # "..." on the screen moving, say). Returns the message. Raises
+    # ConnectionError if the server stops answering pings.
+    def wait_for_push(self, tick=None):
+        seconds_waited = 0
+        self.last_heard = self.last_ping = time.monotonic()
+        self.sock.settimeout(1)
+        try:
+            while True:
+                try:
+                    return self.receive()
+                except socket.timeout:
+                    seconds_waited += 1
+                    print('.', end='', flush=True)
+                    if tick is not None:
+                        tick(seconds_waited)
+                    self.heartbeat()
+        finally:
+            self.sock.settimeout(None)
+
+    # Ping the server every HEARTBEAT_INTERVAL seconds, and give up on it if
+    # it has stopped answering. Call this every so often while waiting for
+    # a reply. Only the framed protocol has pings.
+    def heartbeat(self):
+        if self.reader is None:
+            return
+        now = time.monotonic()
+        if self.answers_pings and now - self.last_heard > HEARTBEAT_TIMEOUT:
+            raise ConnectionError("server stopped answering")
+        if now - self.last_ping >= HEARTBEAT_INTERVAL:
+            self.last_ping = now
+            self.send("ping")
+
+    # Ask for the token that gets us back into the game we're playing if the
+    # connection drops. Only works once the game has started. Returns the
+    # token, or None.
+    def request_token(self):
+        reply = self.request("token")
+        if reply.startswith("token "):
+            self.token = reply.split(' ')[1]
+        else:
+            self.token = None
+        return self.token
+
+    # Connect to the same server again, trying a few times. Returns True if
+    # it worked.
+    def connect_again(self):
+        self.close()
+        for attempt in range(RECONNECT_ATTEMPTS):
+            if self.connect(*self.address):
+                return True
+            time.sleep(RECONNECT_DELAY)
+        return False
+
+    # The connection dropped. Connect again and get back into our game.
+    # Returns (our piece, every column played so far), or None if we
+    # couldn't connect or the game is over.
+    def reconnect(self):
+        if self.token is None or not self.connect_again():
+            return None
+        try:
+            reply = self.request("resume {}".format(self.token))
+        except OSError:
+            return None
+        if not reply.startswith("resumed "):
+            self.token = None
+            return None
+        piece, columns = reply.split(' ')[1].split(':')
+        return int(piece), [int(col, 36) for col in columns]
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.connected = False
@@ -0,0 +1,128 @@
+# Talking to the server without stopping the game.
+#
+# connect-4.py used to call the server and wait for the answer: while it
+# waited for the other player's move, for the server to agree to a turn, or
+# for the connection to come back, nothing else happened and the Pi's screen
+# froze. Now a NetworkThread owns the ServerConnection (see net_client.py)
+# and does all of the waiting on a thread of its own. The game asks it to
+# connect or to send something, which returns straight away, and everything
+# the server sends back is posted into pygame's event queue as a
+# NETWORK_EVENT, the same way gpio_input.py posts button presses. The game
+# handles those in its event loop along with clicks and key presses.
+#
+# A NETWORK_EVENT has a kind, and data that depends on it:
+#
+#   "connected"  data is True if connecting (or reconnecting) worked
+#   "message"    data is a message from the server, as ASCII text
+#   "lost"       the connection dropped; data is None
+
+import queue
+import select
+import socket
+import threading
+import time
+
+import pygame
+
+# The pygame event type posted for everything that happens on the network.
+NETWORK_EVENT = pygame.USEREVENT + 2
+
+# How often the thread wakes up when nothing is happening (seconds), to keep
+# the heartbeat going.
+IDLE_WAKEUP = 1.0
+
+
+class NetworkThread:
+
+    # connection is the ServerConnection to use. Only this thread touches it
+    # from now on.
+    def __init__(self, connection):
+        self.connection = connection
+        # Whether the connection is up, as far as the game needs to know.
+        self.connected = False
+        # What the game has asked for, as (kind, argument) pairs. Writing a
+        # byte to wake_writer wakes the thread up to look.
+        self.requests = queue.Queue()
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        # How many replies we're still waiting for. The server is only pinged
+        # while there are some (see lifecycle.py).
+        self.expected = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Connect to a server. A "connected" event says whether it worked.
+    def connect(self, server_ip, port):
+        self.ask("connect", (server_ip, port))
+
+    # Connect to the same server again after losing it. A "connected" event
+    # says whether it worked.
+    def reconnect(self):
+        self.ask("reconnect", None)
+
+    # Send a message (written the ASCII way) to the server. The reply, if
+    # there is one, arrives as a "message" event.
+    def send(self, data):
+        self.ask("send", data)
+
+    def ask(self, kind, argument):
+        self.requests.put((kind, argument))
+        self.wake_writer.send(b"!")
+
+    def post(self, kind, data=None):
+        pygame.event.post(pygame.event.Event(NETWORK_EVENT, kind=kind, data=data))
+
+    def run(self):
+        while True:
+            sockets = [self.wake_reader]
+            if self.connection.connected:
+                sockets.append(self.connection.sock)
+            readable = select.select(sockets, [], [], IDLE_WAKEUP)[0]
+            if self.wake_reader in readable:
+                self.wake_reader.recv(4096)
+            try:
+                self.handle_requests()
+                if self.connection.connected and self.connection.sock in readable:
+                    self.receive()
+                if self.connection.connected and self.expected:
+                    self.connection.heartbeat()
+            except OSError as e:
+                # ConnectionError (the server hung up, or stopped answering)
+                # is an OSError too.
+                print("\nLost the connection to the server: {}".format(e))
+                self.connection.close()
+                self.connected = False
+                self.expected = 0
+                self.post("lost")
+
+    # Do whatever the game has asked for since we last looked.
+    def handle_requests(self):
+        while True:
+            try:
+                kind, argument = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if kind == "send":
+                if not self.connection.connected:
+                    # The game finds out from the "lost" event.
+                    continue
+                if not self.expected:
+                    # Start the heartbeat's clocks from when we start
+                    # waiting.
+                    self.connection.last_heard = self.connection.last_ping = time.monotonic()
+                self.connection.send(argument)
+                self.expected += 1
+                continue
+            if kind == "connect":
+                connected = self.connection.connect(*argument)
+            else:
+                connected = self.connection.connect_again()
+            self.connected = connected
+            self.expected = 0
+            self.post("connected", connected)
+
+    # Pass on everything the server has sent. One recv() can bring several
+    # framed messages, or none yet.
+    def receive(self):
+        for message in self.connection.poll():
+            self.post("message", message)
+            self.expected = max(0, self.expected - 1)
@@ -0,0 +1,174 @@
+# An opening book for the computer opponent.
+#
+# Early in the game the computer has the most choices and the least time (it
+# only gets about as long as the hovering piece takes to move one column), so
+# that's when its search is weakest. The opening book is worked out ahead of
+# time instead: every position up to some number of moves is searched deeply,
+# once, on a fast computer, and the answers are saved to a file. On the Pi,
+# looking a position up in the file is far quicker than searching it.
+#
+# The file is a header followed by fixed-size records sorted by position key:
+#
+#     header:  magic, version, rows, columns, plies, search depth, record count
+#     record:  canonical key (8 B), score (4 B), best column (1 B), depth (1 B)
+#
+# A position and its mirror image are stored once, under whichever key is
+# smaller (see Bitboard.canonical_key()), with the best column for that
+# orientation. At runtime the file is mmap()ed and binary searched, so opening
+# it doesn't read or parse anything.
+#
+# Build a book:    python3 opening_book.py build <plies> <depth> [file]
+# Look something up: python3 opening_book.py lookup <moves> [file]
+#   where moves is the columns played so far, e.g. 3342
+
+import mmap
+import struct
+import sys
+import time
+from multiprocessing import Pool
+
+import ai
+from bitboard import Bitboard, ROW_COUNT, COLUMN_COUNT, CONNECT
+
+BOOK_FILE = "opening_book.bin"
+
+MAGIC = b"C4BK"
+VERSION = 1
+HEADER = struct.Struct(">4sBBBBBI")
+RECORD = struct.Struct(">QiBB")
+
+# Defaults for building a book: every position with up to BUILD_PLIES chips
+# on the board, each searched BUILD_DEPTH moves deep.
+BUILD_PLIES = 6
+BUILD_DEPTH = 12
+
+
+class OpeningBook:
+
+    def __init__(self, path=BOOK_FILE):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.rows, self.columns, self.plies, self.depth, self.count = \
+            HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("{} isn't an opening book this version can read".format(path))
+
+    # Find the board's position in the book. Returns (best column, score for
+    # the player about to move), or None if it isn't there. Books are only
+    # built for CONNECT in a row.
+    def lookup(self, board):
+        if board.rows != self.rows or board.columns != self.columns or board.connect != CONNECT or \
+                len(board.moves) > self.plies:
+            return None
+        key, mirrored = board.canonical_key()
+
+        # Binary search the records.
+        low = 0
+        high = self.count - 1
+        while low <= high:
+            middle = (low + high) // 2
+            record_key, score, column, depth = RECORD.unpack_from(self.map, HEADER.size + middle * RECORD.size)
+            if record_key < key:
+                low = middle + 1
+            elif record_key > key:
+                high = middle - 1
+            else:
+                if mirrored:
+                    column = self.columns - 1 - column
+                return column, score
+        return None
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+# Every position with up to plies chips in it that can come up in a game
+# (so none after someone has won), as a dict of canonical key -> list of moves
+# that reaches it.
+def enumerate_positions(plies):
+    positions = {}
+    board = Bitboard(ROW_COUNT, COLUMN_COUNT)
+
+    def visit(piece):
+        key = board.canonical_key()[0]
+        if key in positions:
+            return
+        positions[key] = board.moves[:]
+        if len(board.moves) == plies:
+            return
+        for col in range(board.columns):
+            if board.can_play(col):
+                row = board.play(col, piece)
+                if not board.winning_cells(row, col):
+                    visit(3 - piece)
+                board.undo()
+
+    visit(1)
+    return positions
+
+
+# Search one position. Run in a worker process. Returns a record's fields.
+def search_position(job):
+    moves, depth = job
+    board = Bitboard(ROW_COUNT, COLUMN_COUNT)
+    piece = 1
+    for col in moves:
+        board.play(col, piece)
+        piece = 3 - piece
+    key, mirrored = board.canonical_key()
+    # Plenty of time: the depth is what limits the search. Each worker keeps
+    # its transposition table from one position to the next, since nearby
+    # positions share a lot of their search.
+    result = ai.best_move(board, piece, 10 ** 9, max_depth=depth)
+    column = result.column
+    if mirrored:
+        column = COLUMN_COUNT - 1 - column
+    return key, result.score, column, result.depth
+
+
+# Search every position up to plies deep and write the book to path.
+def build(plies, depth, path=BOOK_FILE):
+    start = time.time()
+    positions = enumerate_positions(plies)
+    # Full boards have nothing to search, but a position with plies chips
+    # always has a move left on a normal board.
+    jobs = [(moves, depth) for moves in positions.values()]
+    print("Searching {} positions {} moves deep...".format(len(jobs), depth))
+
+    records = []
+    with Pool() as pool:
+        for record in pool.imap_unordered(search_position, jobs, chunksize=16):
+            records.append(record)
+            if len(records) % 1000 == 0:
+                print("{}/{} positions searched.".format(len(records), len(jobs)))
+    records.sort()
+
+    with open(path, "wb") as book:
+        book.write(HEADER.pack(MAGIC, VERSION, ROW_COUNT, COLUMN_COUNT, plies, depth, len(records)))
+        for record in records:
+            book.write(RECORD.pack(*record))
+    print("Wrote {} positions to {} in {:.0f} seconds.".format(len(records), path, time.time() - start))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "build":
+        plies = int(sys.argv[2]) if len(sys.argv) >= 3 else BUILD_PLIES
+        depth = int(sys.argv[3]) if len(sys.argv) >= 4 else BUILD_DEPTH
+        path = sys.argv[4] if len(sys.argv) >= 5 else BOOK_FILE
+        build(plies, depth, path)
+    elif len(sys.argv) >= 2 and sys.argv[1] == "lookup":
+        moves = sys.argv[2] if len(sys.argv) >= 3 else ""
+        path = sys.argv[3] if len(sys.argv) >= 4 else BOOK_FILE
+        book = OpeningBook(path)
+        board = Bitboard(book.rows, book.columns)
+        piece = 1
+        for col in moves:
+            board.play(int(col), piece)
+            piece = 3 - piece
+        print(book.lookup(board))
+        book.close()
+    else:
+        print("Usage: python3 opening_book.py build <plies> <depth> [file]")
+        print("       python3 opening_book.py lookup <moves> [file]")
@@ -0,0 +1,109 @@
+# Drawing the board without redrawing the whole screen every time.
+#
+# The original draw_board() drew all 42 blue squares and circles, then updated
+# the whole display, every time anything changed. On the Pi that is most of
+# the time spent on each frame. A BoardRenderer draws the empty board once
+# into a Surface, and makes one small Surface ("sprite") per kind of space.
+# After that, a move only needs one sprite copied to the screen, and only the
+# squares that actually changed are sent to pygame.display.update().
+
+import pygame
+
+
+class BoardRenderer:
+
+    # piece_colors maps each piece (1, 2) to its color.
+    def __init__(self, screen, rows, columns, square_size, circle_radius,
+                 board_color, empty_color, piece_colors):
+        self.screen = screen
+        self.rows = rows
+        self.columns = columns
+        self.square_size = square_size
+        self.circle_radius = circle_radius
+        self.empty_color = empty_color
+        # The column the hovering piece was last drawn over, so it can be
+        # erased when it moves.
+        self.hover_col = None
+
+        # One square of the board with a hole of the given color in it.
+        def make_square(color):
+            square = pygame.Surface((square_size, square_size)).convert()
+            square.fill(board_color)
+            pygame.draw.circle(square, color, (square_size // 2, square_size // 2), circle_radius)
+            return square
+
+        # The sprites for empty spaces and for each piece.
+        self.cells = {0: make_square(empty_color)}
+        for piece, color in piece_colors.items():
+            self.cells[piece] = make_square(color)
+
+        # The sprites for a piece hovering in the top row, one per color.
+        # These are filled in as they are needed.
+        self.hovers = {}
+
+        # The whole empty board, below the top row.
+        self.background = pygame.Surface((columns * square_size, rows * square_size)).convert()
+        for c in range(columns):
+            for r in range(rows):
+                self.background.blit(self.cells[0], (c * square_size, r * square_size))
+
+    # The rectangle on the screen that a space of the board takes up. Row 0
+    # is at the bottom of the board, and the top row of the screen is for
+    # text and the hovering piece.
+    def cell_rect(self, row, col):
+        return pygame.Rect(col * self.square_size, (self.rows - row) * self.square_size,
+                           self.square_size, self.square_size)
+
+    # The rectangle of the text/hover row at the top of the screen.
+    def top_row_rect(self):
+        return pygame.Rect(0, 0, self.columns * self.square_size, self.square_size)
+
+    # Draw the whole board from scratch and update the whole display. Only
+    # needed when the board appears or is reset.
+    def draw_board(self, board):
+        self.screen.blit(self.background, (0, self.square_size))
+        for c in range(self.columns):
+            for r in range(self.rows):
+                piece = board.piece_at(r, c)
+                if piece != 0:
+                    self.screen.blit(self.cells[piece], self.cell_rect(r, c))
+        pygame.display.update()
+
+    # Draw one space of the board (usually the one just played in). Returns
+    # the rectangle that changed.
+    def draw_cell(self, board, row, col):
+        rect = self.cell_rect(row, col)
+        self.screen.blit(self.cells[board.piece_at(row, col)], rect)
+        return rect
+
+    # Move the hovering piece to col. Returns the rectangles that changed.
+    def draw_hover(self, col, color):
+        dirty = []
+        if self.hover_col is not None and self.hover_col != col:
+            dirty.append(self.clear_hover())
+        if color not in self.hovers:
+            sprite = pygame.Surface((self.square_size, self.square_size)).convert()
+            sprite.fill(self.empty_color)
+            pygame.draw.circle(sprite, color, (self.square_size // 2, self.square_size // 2), self.circle_radius)
+            self.hovers[color] = sprite
+        rect = pygame.Rect(col * self.square_size, 0, self.square_size, self.square_size)
+        self.screen.blit(self.hovers[color], rect)
+        self.hover_col = col
+        dirty.append(rect)
+        return dirty
+
+    # Erase the hovering piece. Returns the rectangle that changed.
+    def clear_hover(self):
+        if self.hover_col is None:
+            return pygame.Rect(0, 0, 0, 0)
+        rect = pygame.Rect(self.hover_col * self.square_size, 0, self.square_size, self.square_size)
+        self.screen.fill(self.empty_color, rect)
+        self.hover_col = None
+        return rect
+
+    # Blank out the whole top row. Returns the rectangle that changed.
+    def clear_top_row(self):
+        rect = self.top_row_rect()
+        self.screen.fill(self.empty_color, rect)
+        self.hover_col = None
+        return rect
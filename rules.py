@@ -0,0 +1,90 @@
+# The rules of the game, with nothing else attached.
+#
+# connect-4.py used to do all of its work as it was imported: reading the
+# arguments, starting pygame, opening the window, loading fonts and making a
+# socket. None of its functions could be used without all of that, so a bot,
+# a test or the server couldn't borrow them. The rules now live here, the
+# connection to the server in net_client.py and the display in ui.py.
+#
+# This module only needs bitboard.py, so it imports in a few milliseconds.
+#
+# The board's size and how many in a row win can be changed from the command
+# line, for the game and the server alike: "size=9x10 connect=5" plays
+# connect 5 on a board 9 rows high and 10 columns wide.
+
+from bitboard import Bitboard, ROW_COUNT, COLUMN_COUNT, CONNECT, PLAYER_1_PIECE, PLAYER_2_PIECE, check_size
+
+
+# Function which creates an empty "board". The board is a Bitboard (see
+# bitboard.py), which keeps each player's pieces in a single integer. The
+# functions below are thin wrappers around it.
+def create_board(rows=ROW_COUNT, columns=COLUMN_COUNT, connect=CONNECT):
+    board = Bitboard(rows, columns, connect)
+    return board
+
+# Take the board settings ("size=<rows>x<columns>" and "connect=<n>") out of
+# a list of command line arguments. Returns the other arguments, and the
+# rows, columns and connect to play with. Raises ValueError if the settings
+# can't be played.
+def parse_board_args(args):
+    rows, columns, connect = ROW_COUNT, COLUMN_COUNT, CONNECT
+    others = []
+    for arg in args:
+        if arg.lower().startswith("size="):
+            rows, columns = [int(part) for part in arg[5:].lower().split('x')]
+        elif arg.lower().startswith("connect="):
+            connect = int(arg[8:])
+        else:
+            others.append(arg)
+    check_size(rows, columns, connect)
+    return others, rows, columns, connect
+
+# Function which drops a piece into the board at a given row and column. The
+# Bitboard knows how tall every column is, so the row is always the one that
+# get_next_open_row() gave us.
+def drop_piece(board, row, col, piece):
+    board.play(col, piece)
+
+# Function to determine if a chip can be dropped in the given column.
+def is_valid_location(board, col):
+    return board.can_play(col)
+
+# The below function is run when a user selects a column to drop a chip into.
+# It returns the lowest row available. In real life, gravity does this.
+def get_next_open_row(board, col):
+    return board.next_open_row(col)
+
+# A function which takes in a board and a piece. Returns True if piece has won
+# the game, or False if piece has not won the game.
+def winning_move(board, piece):
+    return board.is_win(piece)
+
+# Did the piece just dropped at row, col win the game? Unlike winning_move(),
+# this only checks the lines going through that one space. Returns the list of
+# winning (row, col) spaces, or None.
+def winning_move_at(board, row, col):
+    return board.winning_cells(row, col)
+
+# Is every space on the board taken? If nobody has won by then, it's a tie.
+def board_full(board):
+    return board.is_full()
+
+# Whose piece is played on a turn. Player 1 plays the odd turns.
+def piece_for_turn(turn_num):
+    return PLAYER_1_PIECE if turn_num % 2 == 1 else PLAYER_2_PIECE
+
+# Change the orientation of the board so it looks nice when printing,
+# then print the board.
+def print_board(board):
+    # Only needed for debugging, so numpy isn't imported until it's used.
+    import numpy as np
+    # flip the board over the 0 axis (x)
+    print(np.flip(np.array(board.to_grid()), 0))
+
+# How long the piece hovers over each column on a given turn (ms). This time
+# starts off at 500ms, then goes down by 25ms for each turn until it reaches
+# 100ms. It then stays there for the rest of the game.
+def get_position_change_delay(turn_num):
+    if turn_num <= 17:
+        return 500 - (25 * (turn_num - 1))
+    return 100
@@ -1,105 +1,202 @@
 import os
+import signal
 import socket
 import sys
+import threading
 import time
+import traceback
 from _thread import *
 
+import wire
+from analysis import Analyzer
+from async_server import run_async_server
+from dispatch import BACKLOG, GREETING, Client, client_disconnected, handle_message
+from game_log import LOG_FILE, GameLog
+from lifecycle import Reaper, enable_keepalive
+from metrics import STATS_PORT, ServerMetrics, start_stats_server
+from rules import parse_board_args
+from sessions import SessionTable
+from sharded_server import run_sharded_server
+
 # The port that we're receiving connections on
 port = 12345
 
-# Thread count
-thread_count = 0
-
-# connection statuses
-p1_connected = False
-p2_connected = False
-
+# Argument processing. By default the server starts one thread per
+# connection. Pass "async" to serve every connection from one asyncio event
+# loop instead (see async_server.py), or "sharded" to spread the games over
+# several processes (see sharded_server.py). A second argument changes the
+# port, and a third the port the stats are served on (see metrics.py). A
+# stats port of 0 turns the stats port off. In sharded mode, a fourth
+# argument sets the number of shards. It defaults to one per CPU.
+#
+# The board's size and how many in a row win ("size=9x10 connect=5") can go
+# anywhere in the arguments (see rules.py). The kiosks have to be given the
+# same.
+try:
+    sys.argv[1:], rows, columns, connect = parse_board_args(sys.argv[1:])
+except ValueError as e:
+    print("Bad board settings: {}".format(e))
+    sys.exit()
+SERVER_MODE = "threaded"
+stats_port = STATS_PORT
+shard_count = os.cpu_count() or 1
+if len(sys.argv) >= 2:
+    SERVER_MODE = sys.argv[1].lower()
+if len(sys.argv) >= 3:
+    port = int(sys.argv[2])
+if len(sys.argv) >= 4:
+    stats_port = int(sys.argv[3])
+if len(sys.argv) >= 5:
+    shard_count = int(sys.argv[4])
 
-def init_move_list():
-    global moves
-    moves = []
-    for i in range(43):
-        moves.append('')
 
 def threaded_client(connection):
 
-    global p1_connected
-    global p2_connected
-    global moves
+    # Everything this client sends is received into this. See wire.py.
+    reader = wire.MessageReader()
 
-    # send the initial greeting
-    connection.send("Welcome to the server!".encode("ascii"))
-    while True:
-        data = connection.recv(2048).decode("ascii")
-        # print("Received message " + data)
+    # Replies to subscriptions are sent by whichever thread handled the
+    # message the client was waiting for, so sending needs a lock.
+    send_lock = allocate_lock()
+
+    # Send a reply tuple, in whichever protocol this client speaks.
+    def send(reply):
+        data = wire.encode_reply(reply, reader.framed)
         if not data:
-            break
-
-        # default reply
-        reply = ''
-
-        # If a player sends us an initial message while both players are
-        # connected, it's likely that the game ended and they want to play
-        # again.
-        if (data == "p=1" or data == "p=2") and p1_connected and p2_connected:
-            # clear the move list
-            init_move_list()
-            print("Someone is trying to start a game after one has already been started! Cleared move list.")
-            p1_connected = False
-            p2_connected = False
-
-        if data == "p=1":
-            p1_connected = True
-            if p2_connected:
-                reply = "start"
-            else:
-                reply = "wait"
-        elif data == "p=2":
-            p2_connected = True
-            if p1_connected:
-                reply = "start"
-            else:
-                reply = "wait"
-
-        elif data == "waited":
-            if p1_connected and p2_connected:
-                reply = "start"
-            else:
-                reply = "wait"
-
-        elif data == "gameover":
-            # The game is over. Set the status of both players to disconnected,
-            # and clear the movelist.
-            p1_connected = False
-            p2_connected = False
-            init_move_list()
-            reply = "affirm"
-
-        elif data.startswith("turn"):
-            # This is turn data. Very important.
-            # Format of turn data: "turn x:y" where x=turn and y=column
-            turn_num = int(data.split(' ')[1].split(':')[0])
-            column = data.split(' ')[1].split(':')[1]
-            moves[turn_num] = column
-            print("Turn num: {}. Column: {}".format(turn_num, column))
-            reply = "affirm"
-
-        elif data.startswith("waiting"):
-            turn_requested = int(data.split(' ')[1])
-            if moves[turn_requested] == '':
-                reply = "wait"
-            else:
-                reply = moves[turn_requested]
-
-        connection.sendall(reply.encode("ascii"))
-
-    connection.close()
-
-
-# The list of moves! A list of strings, each containing a number 0-6.
-# These, in order, represent all of the moves of the game so far.
-moves = []
-init_move_list()
+            return
+        with send_lock:
+            try:
+                connection.sendall(data)
+            except OSError:
+                # The client has gone. Its own thread will notice and clean up.
+                return
+        metrics.sent(len(data))
+
+    # Push something to this client as a spectator. This is called by the
+    # threads of the players it's watching, so it must never block: if the
+    # bytes can't all be written straight away, the client is dropped.
+    def push(encodings):
+        data = encodings[1 if reader.framed else 0]
+        if not send_lock.acquire(False):
+            sent = 0
+        else:
+            try:
+                sent = connection.send(data, socket.MSG_DONTWAIT)
+            except OSError:
+                sent = 0
+            finally:
+                send_lock.release()
+        if sent < len(data):
+            # This wakes up the client's own thread, which cleans up.
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return False
+        metrics.sent(sent)
+        return True
+
+    # Hang up on the client, from any thread. Its own thread notices and
+    # cleans up.
+    def close():
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    client = Client(sessions, send, push, analyzer)
+    metrics.connection_opened()
+    enable_keepalive(connection)
+    reaper.watch(client, close)
+
+    try:
+        # send the initial greeting
+        connection.send(GREETING)
+        metrics.sent(len(GREETING))
+        while True:
+            try:
+                nbytes = connection.recv_into(reader.free_space())
+            except OSError:
+                break
+            if not nbytes:
+                break
+            metrics.received(nbytes)
+
+            try:
+                messages = reader.received(nbytes)
+            except ValueError:
+                # Not something we can understand. Hang up.
+                break
+            for message in messages:
+                start = time.perf_counter()
+                reply = handle_message(client, message)
+                metrics.message_handled(message[0], reply, time.perf_counter() - start)
+                if reply is not None:
+                    send(reply)
+    except OSError:
+        # The connection failed before we could greet the client.
+        pass
+    except Exception:
+        # A bug in handling something the client sent. Hang up on it rather
+        # than leave it waiting for a reply that will never come, and make
+        # sure the game and the connection are still cleaned up.
+        print("Met an exception handling a message. Hanging up on the client.")
+        traceback.print_exc()
+    finally:
+        session = client.session
+        client_disconnected(client)
+        reaper.forget(client, session)
+        connection.close()
+        metrics.connection_closed()
+
+
+# Print the stats. Called on SIGUSR1. The signal can arrive while this thread
+# holds the metrics lock, so the printing is done on another thread.
+def dump_stats(signum, frame):
+    threading.Thread(target=lambda: print(render_stats(), flush=True)).start()
+
+
+def render_stats():
+    return metrics.render(sessions.count(), analyzer.stats())
+
+
+# Works out hints, on processes of its own (see analysis.py). The pool is
+# forked from this process, so it starts before anything else does.
+analyzer = Analyzer(rows, columns, connect)
+
+# Every game that finishes is saved here. See game_log.py.
+game_log = GameLog(LOG_FILE, rows, columns, connect)
+
+if SERVER_MODE == "sharded":
+    try:
+        run_sharded_server(port, stats_port, shard_count, game_log, analyzer, rows, columns, connect)
+    except KeyboardInterrupt:
+        print("Keyboard interrupt received. Closing.")
+    game_log.close()
+    sys.exit()
+
+# Every game being played on the server. See sessions.py.
+sessions = SessionTable(game_log, rows, columns, connect)
+
+# What the server has been doing. See metrics.py.
+metrics = ServerMetrics()
+# Closes idle connections and ends abandoned games. See lifecycle.py.
+reaper = Reaper(sessions, metrics)
+if stats_port:
+    start_stats_server(render_stats, stats_port)
+if hasattr(signal, "SIGUSR1"):
+    signal.signal(signal.SIGUSR1, dump_stats)
+
+if SERVER_MODE == "async":
+    print("Running the asyncio server.")
+    try:
+        run_async_server(sessions, port, metrics, reaper, analyzer)
+    except KeyboardInterrupt:
+        print("Keyboard interrupt received. Closing.")
+    game_log.close()
+    sys.exit()
+
+reaper.start_thread()
 
 # create a socket object
 server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -109,24 +206,25 @@ try:
     # bind to port
     server_socket.bind(('', port))
 
-    # queue up to 5 requests
+    # queue up to BACKLOG requests
     print("Waiting for a connection...")
-    server_socket.listen(5)
+    server_socket.listen(BACKLOG)
 
     while True:
         # establish connection
         client_socket, addr = server_socket.accept()
         print("Connected to {}:{}".format(addr[0], addr[1]), end=', ')
         start_new_thread(threaded_client, (client_socket, ))
-        thread_count += 1
-        print("Thread number: {}.".format(thread_count))
+        print("Connections: {}.".format(metrics.connections + 1))
 
 except KeyboardInterrupt:
     print("Keyboard interrupt received. Closing.")
     server_socket.close()
+    game_log.close()
     sys.exit()
 
 except Exception as e:
     print("Met an exception. Closing server.")
     print(e)
     server_socket.close()
+    game_log.close()
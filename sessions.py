@@ -0,0 +1,420 @@
+# Game sessions for server.py.
+#
+# The server used to keep one global list of moves and two booleans saying
+# whether player 1 and player 2 were connected, so it could only ever host one
+# game. Now every game gets its own Session, and the SessionTable keeps track
+# of all of them and pairs up players as they connect.
+#
+# The server doesn't take the kiosks' word for anything. Each Session keeps
+# the game's board, as two integers laid out like a Bitboard's (see
+# bitboard.py), and every move is checked against it: it has to be the next
+# turn, by the player whose turn it is, in a column that exists and isn't
+# full. The server sees for itself when a move wins or fills the board, and
+# ends the game there and then. The lines a move could complete are worked
+# out once per board size and shared by every game, so a Session only holds
+# what's different about its game, and the lot fits in a few hundred bytes.
+
+import itertools
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+
+import wire
+from bitboard import ROW_COUNT, COLUMN_COUNT, CONNECT, PLAYER_1_PIECE, PLAYER_2_PIECE, winning_lines
+from lifecycle import ABANDON_TIMEOUT
+from rules import piece_for_turn
+
+# How many slots each game's move list has on a board of a given size. Turns
+# start at 1, so slot 0 is never used and the last turn is rows * columns.
+def move_slots(rows, columns):
+    return rows * columns + 1
+
+# Bits of Session.players. A game has started once both bits are set.
+PLAYER_1_BIT = 1
+PLAYER_2_BIT = 2
+BOTH_PLAYERS = PLAYER_1_BIT | PLAYER_2_BIT
+
+# What SessionTable.record_move() made of a move.
+MOVE_PLAYED = 0     # it was played, and the game goes on
+MOVE_WON = 1        # it was played, and won the game
+MOVE_DRAWN = 2      # it was played, and filled the board without anyone winning
+MOVE_REPEATED = 3   # it had already been played (the player sent it again)
+MOVE_REFUSED = 4    # it isn't allowed, and wasn't played
+
+
+# Which bit of Session.players belongs to a piece (1 or 2).
+def player_bit(piece):
+    return 1 << (piece - 1)
+
+
+# The ID of the game a resume token belongs to (see
+# SessionTable.issue_token()).
+def token_game(token):
+    return token >> 32
+
+
+class Session:
+
+    __slots__ = ("id", "moves", "players", "finished", "waiters", "start_time", "spectators", "tokens", "red",
+                 "occupied", "turns")
+
+    def __init__(self, session_id, slots=move_slots(ROW_COUNT, COLUMN_COUNT)):
+        self.id = session_id
+        # moves[turn] is the column played on that turn, plus one. 0 means
+        # that turn hasn't been played yet. A bytearray keeps this to a
+        # single byte per turn.
+        self.moves = bytearray(slots)
+        # Which players are connected. See PLAYER_1_BIT and PLAYER_2_BIT.
+        self.players = 0
+        self.finished = False
+        # Clients waiting to be told about something, as (turn, client)
+        # pairs. Turn 0 means they're waiting for the game to start. There
+        # are only ever a couple of these, so a list is plenty. Until there
+        # are any it's an empty tuple, which every game shares.
+        self.waiters = ()
+        # When both players had joined, as a Unix timestamp. For the game log.
+        self.start_time = 0
+        # Clients watching the game, or None until there are any. Most games
+        # never have any, so they don't get a list.
+        self.spectators = None
+        # The resume token of each piece (see SessionTable.issue_token()), or
+        # None until a player asks for one.
+        self.tokens = None
+        # The board: the spaces player 1 (red) has a chip in, and the spaces
+        # anyone has, one bit per space as in bitboard.py. The height of each
+        # column can be read off occupied, so it isn't stored.
+        self.red = 0
+        self.occupied = 0
+        # How many turns have been played.
+        self.turns = 0
+
+    # Have both players connected?
+    def started(self):
+        return self.players == BOTH_PLAYERS
+
+    # Store the column played on a turn, and the space it landed in (a bit
+    # number, see bitboard.py).
+    def record_move(self, turn_num, column, space, piece):
+        self.moves[turn_num] = column + 1
+        bit = 1 << space
+        self.occupied |= bit
+        if piece == PLAYER_1_PIECE:
+            self.red |= bit
+        self.turns = turn_num
+
+    # Is there a turn turn_num in this game? Turns start at 1, and the last
+    # one fills the board.
+    def has_turn(self, turn_num):
+        return 0 < turn_num < len(self.moves)
+
+    # The column played on a turn, or None if it hasn't been played yet.
+    # turn_num has to be one of the game's turns (see has_turn()).
+    def get_move(self, turn_num):
+        move = self.moves[turn_num]
+        if move == 0:
+            return None
+        return move - 1
+
+    # Every column played so far, in order.
+    def columns(self):
+        end = self.moves.find(0, 1)
+        if end == -1:
+            end = len(self.moves)
+        return bytes(col - 1 for col in self.moves[1:end])
+
+    # Take out every client waiting on the given turn (0 for the start of the
+    # game) and return them.
+    def take_waiters(self, turn_num):
+        waiting = [client for turn, client in self.waiters if turn == turn_num]
+        if waiting:
+            self.waiters = [(turn, client) for turn, client in self.waiters if turn != turn_num]
+        return waiting
+
+
+class SessionTable:
+
+    # game_log is a GameLog (see game_log.py) to record finished games in, or
+    # None to forget them. rows and columns are the size of the board, and
+    # connect how many in a row win.
+    def __init__(self, game_log=None, rows=ROW_COUNT, columns=COLUMN_COUNT, connect=CONNECT):
+        # Connection threads all share the table, so everything that changes
+        # it happens while holding this lock.
+        self.lock = threading.Lock()
+        # Every game that hasn't finished yet, by ID.
+        self.sessions = {}
+        # Games that are waiting for a player. waiting[piece] holds the games
+        # that still need someone to play that piece, oldest first.
+        self.waiting = {1: deque(), 2: deque()}
+        # Clients that asked to be matched with anyone, oldest first. An
+        # OrderedDict, so that both taking the oldest and removing one that
+        # gave up are O(1).
+        self.match_queue = OrderedDict()
+        self.next_id = itertools.count(1)
+        self.slots = move_slots(rows, columns)
+        # The board's shape, for checking moves. lines is shared with every
+        # Bitboard of the same size.
+        self.rows = rows
+        self.columns = columns
+        self.column_bits = rows + 1
+        self.column_mask = (1 << self.column_bits) - 1
+        self.lines = winning_lines(rows, columns, connect)
+        self.game_log = game_log
+        # Resume tokens. tokens[token] is [game, piece, client], where client
+        # is the connection playing that piece now.
+        self.tokens = {}
+        # The tokens of games that were won or drawn, as (when they expire,
+        # tokens) pairs, oldest first. A player who was away when their game
+        # ended can still resume it for ABANDON_TIMEOUT seconds, to see how
+        # it ended.
+        self.ended_tokens = deque()
+
+    # A player wants to play a game as the given piece. Put them in the oldest
+    # game that is missing that piece, or start a new game if there isn't one.
+    # Returns the game and the clients that were waiting for it to start.
+    def join(self, piece):
+        with self.lock:
+            waiting = self.waiting[piece]
+            if waiting:
+                session = waiting.popleft()
+            else:
+                session = Session(next(self.next_id), self.slots)
+                self.sessions[session.id] = session
+                self.waiting[3 - piece].append(session)
+            session.players |= player_bit(piece)
+            if session.started():
+                session.start_time = int(time.time())
+                return session, session.take_waiters(0)
+            return session, []
+
+    # A client wants to play anyone, as either piece. If someone is already
+    # waiting, start a game between them: the one who waited plays piece 1
+    # and moves first, and this client plays piece 2. Both clients' session
+    # and piece are set, and the waiting client is returned so it can be
+    # told. Otherwise the client joins the queue and this returns None.
+    def match(self, client):
+        with self.lock:
+            if not self.match_queue:
+                self.match_queue[client] = True
+                return None
+            opponent = self.match_queue.popitem(last=False)[0]
+            session = Session(next(self.next_id), self.slots)
+            session.players = BOTH_PLAYERS
+            session.start_time = int(time.time())
+            self.sessions[session.id] = session
+            opponent.session = session
+            opponent.piece = PLAYER_1_PIECE
+            client.session = session
+            client.piece = PLAYER_2_PIECE
+            return opponent
+
+    # Take a client out of the match queue, if it's in it.
+    def unmatch(self, client):
+        with self.lock:
+            self.match_queue.pop(client, None)
+
+    # A player wants to be able to get back into their game if their
+    # connection drops. Returns the token that does it. The top 32 bits are
+    # the game's ID, so the sharded server knows which shard to send it to,
+    # and the rest are random, so another player can't just use the next
+    # number to take over someone else's game.
+    def issue_token(self, session, piece, client):
+        with self.lock:
+            if session.tokens is None:
+                session.tokens = {}
+            token = session.tokens.get(piece)
+            if token is None:
+                token = (session.id << 32) | secrets.randbits(32)
+                session.tokens[piece] = token
+            self.tokens[token] = [session, piece, client]
+            return token
+
+    # A player has reconnected and wants back into their game. The client
+    # takes over the piece from whichever connection had it before. Returns
+    # (game, piece), or None if the token is wrong or has expired. The game
+    # may be over, if it was won or drawn while the player was away.
+    def resume(self, token, client):
+        with self.lock:
+            self._expire_tokens()
+            entry = self.tokens.get(token)
+            if entry is None:
+                return None
+            session, piece, old_client = entry
+            if session.finished:
+                return session, piece
+            entry[2] = client
+            session.players |= player_bit(piece)
+            # The old connection won't be told anything now.
+            session.waiters = [(turn, waiter) for turn, waiter in session.waiters if waiter is not old_client]
+            return session, piece
+
+    # Add a game that started somewhere else (see sharded_server.py), with
+    # both players already in it. moves is the game's moves so far. Returns
+    # the game.
+    def add_started(self, session_id, moves):
+        with self.lock:
+            session = Session(session_id, self.slots)
+            for turn_num, move in enumerate(moves[1:], 1):
+                if move == 0:
+                    break
+                column = move - 1
+                session.record_move(turn_num, column, self._next_space(session, column), piece_for_turn(turn_num))
+            session.players = BOTH_PLAYERS
+            session.start_time = int(time.time())
+            self.sessions[session_id] = session
+            return session
+
+    # piece wants to play column on turn turn_num. Check that it's allowed,
+    # and play it if it is. A move that wins the game or fills the board
+    # ends the game. Returns one of the MOVE_ results above, and the clients
+    # that were waiting for that turn, so they can be sent the move.
+    def record_move(self, session, piece, turn_num, column):
+        with self.lock:
+            if 0 < turn_num <= session.turns and session.moves[turn_num] == column + 1:
+                # A player that didn't hear back about a move sends it again.
+                return MOVE_REPEATED, []
+            if session.finished or not session.start_time or turn_num != session.turns + 1 or \
+                    piece != piece_for_turn(turn_num) or not 0 <= column < self.columns:
+                return MOVE_REFUSED, []
+            space = self._next_space(session, column)
+            if space is None:
+                return MOVE_REFUSED, []
+            session.record_move(turn_num, column, space, piece)
+            if session.spectators:
+                self._push(session, wire.encode_played(turn_num, column))
+            waiters = session.take_waiters(turn_num)
+
+            # Only the lines through the new chip can have been completed.
+            mine = session.red if piece == PLAYER_1_PIECE else session.occupied & ~session.red
+            masks = self.lines.masks
+            if any(mine & masks[line] == masks[line] for line in self.lines.by_space[space]):
+                result = MOVE_WON
+            elif turn_num == self.rows * self.columns:
+                result = MOVE_DRAWN
+            else:
+                return MOVE_PLAYED, waiters
+            self._free(session, keep_tokens=True)
+            return result, waiters
+
+    # A client wants to watch the game with the given ID. It's sent every
+    # move so far, then each new move as it's played, then ENDED when the
+    # game is over. Returns False if there's no such game.
+    #
+    # Pushes to spectators happen while holding the lock, so a spectator
+    # can't see a new move before the moves that came before it. That's
+    # fine because pushing never waits (see Client.push in dispatch.py).
+    def watch(self, session_id, client):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return False
+            if client.push(wire.encode_watching(session.moves)):
+                if session.spectators is None:
+                    session.spectators = []
+                session.spectators.append(client)
+                client.watching = session
+            return True
+
+    # A client has stopped watching a game.
+    def unwatch(self, session, client):
+        with self.lock:
+            if session.spectators and client in session.spectators:
+                session.spectators.remove(client)
+
+    # A client wants to know the column played on a turn (or, for turn 0,
+    # when the game starts) as soon as it happens. If it already has, this
+    # returns True. Otherwise the client is remembered until it does, and
+    # this returns False.
+    def subscribe(self, session, turn_num, client):
+        with self.lock:
+            if turn_num == 0:
+                ready = session.started()
+            else:
+                ready = session.get_move(turn_num) is not None
+            if not ready:
+                if not session.waiters:
+                    session.waiters = []
+                session.waiters.append((turn_num, client))
+            return ready
+
+    # A player has left a game, either by starting a new one or by
+    # disconnecting. If nobody is left in the game, it is freed.
+    def leave(self, session, piece, client=None):
+        with self.lock:
+            # If the piece has been taken over by a player who resumed the
+            # game on another connection, the player is still here.
+            entry = session.tokens and self.tokens.get(session.tokens.get(piece))
+            if not entry or client is None or entry[2] is client:
+                session.players &= ~player_bit(piece)
+            session.waiters = [(turn, waiter) for turn, waiter in session.waiters if waiter is not client]
+            if session.players == 0:
+                self._free(session)
+
+    # A player left a game that had started, and hasn't come back (see
+    # lifecycle.py). If the game is still missing a player, free it and
+    # return the clients that were waiting for something to happen in it, so
+    # they can be told. Otherwise return None.
+    def abandon(self, session):
+        with self.lock:
+            if session.finished or not session.start_time or session.players == BOTH_PLAYERS:
+                return None
+            waiters = [client for turn, client in session.waiters]
+            session.waiters = ()
+            self._free(session)
+            return waiters
+
+    # The game is over. Free it.
+    def finish(self, session):
+        with self.lock:
+            self._free(session)
+
+    # How many games haven't finished yet.
+    def count(self):
+        return len(self.sessions)
+
+    # The bit number of the space a chip dropped in column would land in, or
+    # None if the column is full.
+    def _next_space(self, session, column):
+        shift = column * self.column_bits
+        height = ((session.occupied >> shift) & self.column_mask).bit_length()
+        if height == self.rows:
+            return None
+        return shift + height
+
+    # Remove a game from the table. Its resume tokens stop working, straight
+    # away or (if keep_tokens) once the players have had time to come back and
+    # see how it ended. The lock must already be held.
+    def _free(self, session, keep_tokens=False):
+        if session.finished:
+            return
+        session.finished = True
+        self.sessions.pop(session.id, None)
+        if session.spectators:
+            self._push(session, wire.ENDED_PUSH)
+        session.spectators = None
+        if session.tokens:
+            if keep_tokens:
+                self.ended_tokens.append((time.monotonic() + ABANDON_TIMEOUT, tuple(session.tokens.values())))
+            else:
+                for token in session.tokens.values():
+                    self.tokens.pop(token, None)
+        self._expire_tokens()
+        # Games where nobody moved aren't worth keeping.
+        if self.game_log is not None and session.moves[1]:
+            self.game_log.append(session.start_time, session.moves)
+        for waiting in self.waiting.values():
+            if session in waiting:
+                waiting.remove(session)
+
+    # Forget the tokens of ended games that have been kept long enough. The
+    # lock must already be held.
+    def _expire_tokens(self):
+        now = time.monotonic()
+        while self.ended_tokens and self.ended_tokens[0][0] <= now:
+            for token in self.ended_tokens.popleft()[1]:
+                self.tokens.pop(token, None)
+
+    # Push the same bytes to every spectator of a game. Spectators that
+    # can't keep up are dropped. The lock must already be held.
+    def _push(self, session, data):
+        session.spectators = [client for client in session.spectators if client.push(data)]
@@ -0,0 +1,527 @@
+# A server that spreads its games over several processes.
+#
+# Both server.py cores run in one process, so however many cores the server
+# box has, Python's GIL lets the server use one of them. In sharded mode,
+# server.py starts a supervisor and some worker processes ("shards"):
+#
+#   - The supervisor owns the listening port. New connections join its
+#     "lobby", where players are paired up exactly as before (see
+#     sessions.py). The lobby only ever sees the first few messages of a game.
+#   - As soon as a game has both its players, the supervisor hands both
+#     connections to shard (game ID % number of shards), passing the sockets
+#     themselves over a Unix socket (send_fds). From then on that shard alone
+#     talks to both players, so a game never spans two processes.
+#   - If a player sends "p=" or "match" again to play another game, its shard
+#     hands the connection back to the lobby to be paired again.
+#   - Spectators ("watch x") are handed to game x's shard. Games are only on
+#     a shard once both players are there, so a game that's still waiting
+#     for its second player can't be watched yet.
+#   - A player who reconnects ("resume x") is handed to the shard of the game
+#     its token belongs to.
+#   - Hints ("analyze", see analysis.py) are worked out by the supervisor's
+#     Analyzer, so there's one cache of answers for every game on every
+#     shard. A shard forwards the question over its control socket, and
+#     sends the answer on when it comes back.
+#   - Shards send their stats and finished games to the supervisor every
+#     STATS_INTERVAL seconds. The supervisor adds the stats up for the stats
+#     port and SIGUSR1, and writes the games to the game log.
+#   - If a shard dies, the supervisor starts a new one in its place. The games
+#     that were on it are lost (their players are disconnected), but every
+#     other game carries on.
+#
+# Run it with "python3 server.py sharded [port] [stats port] [shards]".
+
+import asyncio
+import os
+import pickle
+import signal
+import socket
+import subprocess
+import sys
+import threading
+
+import wire
+from async_server import ClientProtocol
+from dispatch import BACKLOG, Client
+from lifecycle import Reaper
+from metrics import ServerMetrics, start_stats_server
+from sessions import SessionTable, token_game
+
+# How often shards report to the supervisor, and how often the supervisor
+# checks that they're still alive (seconds).
+STATS_INTERVAL = 1.0
+WATCH_INTERVAL = 0.5
+
+# The biggest message on a control socket, and the most sockets sent at once.
+CONTROL_BUFFER = 1 << 16
+MAX_FDS = 2
+
+# How many finished games a shard sends the supervisor in one message. Each
+# is about 60 bytes pickled, so this keeps messages well under
+# CONTROL_BUFFER however busy the shard is.
+GAMES_PER_MESSAGE = 500
+
+
+# Send a message (any picklable value), and optionally some file
+# descriptors, over a control socket. Raises ValueError if the message is
+# too big for the other end to receive.
+def send_control(control, message, fds=()):
+    data = pickle.dumps(message)
+    if len(data) > CONTROL_BUFFER:
+        raise ValueError("control message of {} bytes is too long".format(len(data)))
+    socket.send_fds(control, [data], list(fds))
+
+
+# Receive a message and any file descriptors sent with it. Returns (None, [])
+# if the other end has gone. Raises ValueError (after closing any file
+# descriptors that came with it) if the message was cut short or can't be
+# read.
+def receive_control(control):
+    data, fds, flags, address = socket.recv_fds(control, CONTROL_BUFFER, MAX_FDS)
+    if not data:
+        return None, fds
+    try:
+        if flags & socket.MSG_TRUNC:
+            raise ValueError("control message longer than {} bytes".format(CONTROL_BUFFER))
+        try:
+            return pickle.loads(data), fds
+        except Exception as e:
+            raise ValueError("bad control message: {}".format(e))
+    except ValueError:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+
+# Take a connection away from this process so it can be sent to another one.
+# Returns a duplicate of its file descriptor and the state the other process
+# needs to carry on: (piece, framed, messages not handled yet, bytes not
+# parsed yet, turns the client is waiting to hear about).
+def detach(protocol, messages):
+    client = protocol.client
+    turns = []
+    if client.session is not None:
+        turns = [turn for turn, waiter in client.session.waiters if waiter is client]
+    state = (client.piece, protocol.reader.framed, list(messages), protocol.reader.unparsed(), turns)
+    fd = os.dup(protocol.transport.get_extra_info("socket").fileno())
+    # Closing the transport only closes this process's copy of the socket.
+    # The duplicate keeps the connection open.
+    protocol.transport.close()
+    return fd, state
+
+
+# Start serving a connection that was handed to this process.
+async def adopt(fd, protocol_factory):
+    connection = socket.socket(fileno=fd)
+    connection.setblocking(False)
+    await asyncio.get_running_loop().connect_accepted_socket(protocol_factory, connection)
+
+
+# The game a message is about, if it has to be handled on that game's shard
+# (WATCH and RESUME), or None.
+def message_game(message):
+    if message[0] == wire.WATCH:
+        return message[1]
+    if message[0] == wire.RESUME:
+        return token_game(message[1])
+    return None
+
+
+# Take over a handed-over connection: restore its state and handle whatever
+# it had already sent. Used by connection_made() in the protocols below.
+def resume(protocol, transport, state):
+    piece, framed, messages, unparsed, turns = state
+    protocol.transport = transport
+    protocol.client.piece = piece
+    protocol.reader.framed = framed
+    protocol.metrics.connection_opened(new=False)
+    # Keepalive is already on: it's a setting of the socket, which came with
+    # the connection.
+    protocol.reaper.watch(protocol.client, transport.abort)
+    return messages + protocol.reader.load(unparsed)
+
+
+# A connection in the supervisor's lobby, waiting to be paired up.
+class LobbyProtocol(ClientProtocol):
+
+    def __init__(self, supervisor, state=None):
+        super().__init__(supervisor.sessions, supervisor.metrics, supervisor.reaper, supervisor.analyzer)
+        self.supervisor = supervisor
+        # Set if the connection was handed back by a shard.
+        self.state = state
+
+    def connection_made(self, transport):
+        if self.state is None:
+            super().connection_made(transport)
+            self.supervisor.lobby.add(self)
+            return
+        self.client = Client(self.sessions, self.send, self.push, self.analyzer)
+        messages = resume(self, transport, self.state)
+        self.supervisor.lobby.add(self)
+        self.dispatch(messages)
+
+    def dispatch(self, messages):
+        for i, message in enumerate(messages):
+            # Games are only played (and so only watched or resumed) on the
+            # shards.
+            game_id = message_game(message)
+            if game_id is not None:
+                self.supervisor.send_to_game(self, game_id, messages[i:])
+                return
+            super().dispatch([message])
+            session = self.client.session
+            if session is not None and session.started():
+                self.supervisor.start_game(session, self, messages[i + 1:])
+                return
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self.supervisor.lobby.discard(self)
+
+
+# A connection whose game is being played on this shard.
+class ShardProtocol(ClientProtocol):
+
+    def __init__(self, worker, session, state):
+        super().__init__(worker.sessions, worker.metrics, worker.reaper, worker.analyzer)
+        self.worker = worker
+        self.session = session
+        self.state = state
+
+    def connection_made(self, transport):
+        self.client = Client(self.sessions, self.send, self.push, self.analyzer)
+        self.client.session = self.session
+        messages = resume(self, transport, self.state)
+        # Carry on waiting for whatever the client was waiting for.
+        for turn in self.state[4]:
+            if self.sessions.subscribe(self.session, turn, self.client):
+                self.send(wire.REPLY_START if turn == 0 else (wire.MOVE, self.session.get_move(turn)))
+        self.state = None
+        self.dispatch(messages)
+
+    def dispatch(self, messages):
+        for i, message in enumerate(messages):
+            # A new game has to be paired up by the lobby, and a game on
+            # another shard has to be watched or resumed there.
+            op = message[0]
+            game_id = message_game(message)
+            if op == wire.JOIN or op == wire.MATCH or (game_id is not None and
+                                                       game_id % self.worker.shard_count != self.worker.index):
+                self.worker.hand_back(self, messages[i:])
+                return
+            super().dispatch([message])
+
+
+# Stands in for the GameLog in a shard: finished games are sent to the
+# supervisor, which logs them.
+class ForwardedGameLog:
+
+    def __init__(self):
+        self.games = []
+
+    def append(self, start_time, moves):
+        self.games.append((start_time, bytes(moves)))
+
+    # Every game logged since the last call.
+    def take(self):
+        games = self.games
+        self.games = []
+        return games
+
+
+# Stands in for the Analyzer in a shard: positions are sent to the
+# supervisor's Analyzer, and the answers sent back.
+class ForwardedAnalyzer:
+
+    def __init__(self, control):
+        self.control = control
+        # Request number -> the function to send its answer with.
+        self.replies = {}
+        self.next_request = 0
+
+    # Same as Analyzer.analyze(), except that the answer always comes later.
+    def analyze(self, moves, reply):
+        self.next_request += 1
+        self.replies[self.next_request] = reply
+        send_control(self.control, ("analyze", self.next_request, bytes(moves)))
+        return None
+
+    # The supervisor answered a request.
+    def answered(self, request, result):
+        reply = self.replies.pop(request, None)
+        if reply is not None:
+            reply(result)
+
+
+class Worker:
+
+    # rows and columns are the size of the board, and connect how many in a
+    # row win.
+    def __init__(self, index, shard_count, control, rows, columns, connect):
+        self.index = index
+        self.shard_count = shard_count
+        self.control = control
+        self.game_log = ForwardedGameLog()
+        self.sessions = SessionTable(self.game_log, rows, columns, connect)
+        self.metrics = ServerMetrics()
+        self.reaper = Reaper(self.sessions, self.metrics)
+        self.analyzer = ForwardedAnalyzer(control)
+        self.stopped = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        self.reaper.start_on_loop(loop)
+        loop.add_reader(self.control.fileno(), self.on_control)
+        while not self.stopped.done():
+            await asyncio.wait([self.stopped], timeout=STATS_INTERVAL)
+            try:
+                self.report()
+            except OSError:
+                return
+
+    # Send the supervisor the games that have finished since last time, a
+    # few hundred to a message, then the stats.
+    def report(self):
+        games = self.game_log.take()
+        for start in range(0, len(games), GAMES_PER_MESSAGE):
+            send_control(self.control, ("games", games[start:start + GAMES_PER_MESSAGE]))
+        send_control(self.control, ("stats", self.metrics.snapshot(), self.sessions.count()))
+
+    def on_control(self):
+        try:
+            message, fds = receive_control(self.control)
+        except ValueError as e:
+            print("Shard {} dropped a message from the supervisor: {}".format(self.index, e))
+            return
+        if message is None:
+            # The supervisor has gone. So should we.
+            if not self.stopped.done():
+                self.stopped.set_result(None)
+            return
+        if message[0] == "analysis":
+            self.analyzer.answered(message[1], message[2])
+            return
+        if message[0] == "visit":
+            state = message[1]
+            asyncio.ensure_future(adopt(fds[0], lambda: ShardProtocol(self, None, state)))
+            return
+        kind, session_id, moves, states = message
+        session = self.sessions.add_started(session_id, moves)
+        for fd, state in zip(fds, states):
+            asyncio.ensure_future(adopt(fd, lambda state=state: ShardProtocol(self, session, state)))
+
+    # Send a connection back to the lobby.
+    def hand_back(self, protocol, messages):
+        fd, state = detach(protocol, messages)
+        try:
+            send_control(self.control, ("rejoin", state), [fd])
+        finally:
+            os.close(fd)
+
+
+# The body of a shard's process. control is its end of the control socket.
+def run_worker(index, shard_count, control, rows, columns, connect):
+    # The supervisor handles Ctrl+C and SIGUSR1 for everyone.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    asyncio.run(Worker(index, shard_count, control, rows, columns, connect).run())
+
+
+class Shard:
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.control = None
+        # The latest stats the shard sent, and its number of games.
+        self.snapshot = None
+        self.games = 0
+
+
+class Supervisor:
+
+    def __init__(self, port, shard_count, game_log, analyzer, rows, columns, connect):
+        self.port = port
+        self.game_log = game_log
+        self.analyzer = analyzer
+        self.rows = rows
+        self.columns = columns
+        self.connect = connect
+        # The lobby's games never get played here, so they aren't logged.
+        self.sessions = SessionTable(None, rows, columns, connect)
+        self.metrics = ServerMetrics()
+        self.reaper = Reaper(self.sessions, self.metrics)
+        self.lobby = set()
+        self.shards = [Shard(index) for index in range(shard_count)]
+        self.server = None
+        self.restarts = 0
+        # The stats of shards that died, so the totals don't go backwards.
+        self.retired = []
+        # All the shards' stats added up, for render_stats().
+        self.totals = ServerMetrics()
+        self.totals_lock = threading.Lock()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.reaper.start_on_loop(loop)
+        self.analyzer.start_on_loop(loop)
+        self.server = await loop.create_server(lambda: LobbyProtocol(self), '', self.port, backlog=BACKLOG)
+        for shard in self.shards:
+            self.start_shard(shard)
+        print("Waiting for a connection...")
+        async with self.server:
+            while True:
+                await asyncio.sleep(WATCH_INTERVAL)
+                for shard in self.shards:
+                    if shard.process.poll() is not None:
+                        print("Shard {} died (exit code {}). Restarting it.".format(
+                            shard.index, shard.process.returncode))
+                        self.restarts += 1
+                        self.stop_shard(shard)
+                        self.start_shard(shard)
+
+    # Start a shard in a new interpreter (see the bottom of this file), rather
+    # than a fork of this one. The supervisor has threads of its own, is in
+    # the middle of its event loop, and holds the listening socket and every
+    # lobby connection. A forked shard would have copies of all of them, and
+    # a connection the supervisor closed would stay open in the shard. The
+    # new process gets its end of the control socket and nothing else.
+    def start_shard(self, shard):
+        control, worker_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        fd = worker_control.fileno()
+        shard.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "worker", str(shard.index), str(len(self.shards)), str(fd),
+             str(self.rows), str(self.columns), str(self.connect)],
+            pass_fds=[fd])
+        worker_control.close()
+        shard.control = control
+        asyncio.get_running_loop().add_reader(control.fileno(), self.on_control, shard)
+
+    def stop_shard(self, shard):
+        asyncio.get_running_loop().remove_reader(shard.control.fileno())
+        shard.control.close()
+        shard.control = None
+        if shard.snapshot is not None:
+            # Its connections are closed, but everything it counted happened.
+            shard.snapshot["connections"] = 0
+            self.retired.append(shard.snapshot)
+        shard.snapshot = None
+        shard.games = 0
+
+    def on_control(self, shard):
+        try:
+            message, fds = receive_control(shard.control)
+        except OSError:
+            return
+        except ValueError as e:
+            print("Dropped a message from shard {}: {}".format(shard.index, e))
+            return
+        if message is None:
+            # The shard is exiting. The watchdog will restart it.
+            asyncio.get_running_loop().remove_reader(shard.control.fileno())
+            return
+        if message[0] == "stats":
+            kind, snapshot, games = message
+            shard.snapshot = snapshot
+            shard.games = games
+        elif message[0] == "games":
+            for start_time, moves in message[1]:
+                self.game_log.append(start_time, moves)
+        elif message[0] == "rejoin":
+            state = message[1]
+            asyncio.ensure_future(adopt(fds[0], lambda: LobbyProtocol(self, state)))
+        elif message[0] == "analyze":
+            kind, request, moves = message
+            control = shard.control
+
+            def answer(result):
+                try:
+                    send_control(control, ("analysis", request, result))
+                except OSError:
+                    # The shard has gone, and the client with it.
+                    pass
+            result = self.analyzer.analyze(moves, answer)
+            if result is not None:
+                answer(result)
+
+    # Both players of session are here. Send the game to its shard.
+    # protocol is the connection that just joined, and messages whatever else
+    # it has sent that hasn't been handled.
+    def start_game(self, session, protocol, messages):
+        players = [player for player in self.lobby if player.client.session is session]
+        fds = []
+        states = []
+        for player in players:
+            fd, state = detach(player, messages if player is protocol else [])
+            fds.append(fd)
+            states.append(state)
+        shard = self.shards[session.id % len(self.shards)]
+        try:
+            send_control(shard.control, ("game", session.id, bytes(session.moves), states), fds)
+        except (OSError, AttributeError):
+            print("Couldn't send game {} to shard {}.".format(session.id, shard.index))
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    # A client wants to watch or resume a game. Send it to the game's shard.
+    # messages starts with the message that asked.
+    def send_to_game(self, protocol, game_id, messages):
+        shard = self.shards[game_id % len(self.shards)]
+        fd, state = detach(protocol, messages)
+        try:
+            send_control(shard.control, ("visit", state), [fd])
+        except (OSError, AttributeError):
+            print("Couldn't send a connection to shard {}.".format(shard.index))
+        finally:
+            os.close(fd)
+
+    # Everything, added up over the lobby and the shards, in the Prometheus
+    # text format. Called on the stats thread.
+    def render_stats(self):
+        shards = self.shards
+        snapshots = [self.metrics.snapshot()] + self.retired
+        snapshots += [shard.snapshot for shard in shards if shard.snapshot is not None]
+        alive = sum(1 for shard in shards if shard.process is not None and shard.process.poll() is None)
+        with self.totals_lock:
+            self.totals.load(snapshots)
+            return self.totals.render(
+                self.sessions.count() + sum(shard.games for shard in shards),
+                [("shards", "gauge", "Shard processes running.", alive),
+                 ("shard_restarts_total", "counter", "Shards restarted after dying.", self.restarts)] +
+                self.analyzer.stats())
+
+
+# Run the supervisor and shard_count shards. Doesn't return until the
+# supervisor is interrupted. stats_port is the port for the stats (0 for
+# none), game_log the GameLog to save finished games in, analyzer the
+# Analyzer that works out hints, rows and columns the size of the board, and
+# connect how many in a row win.
+def run_sharded_server(port, stats_port, shard_count, game_log, analyzer, rows, columns, connect):
+    supervisor = Supervisor(port, shard_count, game_log, analyzer, rows, columns, connect)
+    if stats_port:
+        start_stats_server(supervisor.render_stats, stats_port)
+
+    def dump_stats(signum, frame):
+        threading.Thread(target=lambda: print(supervisor.render_stats(), flush=True)).start()
+    signal.signal(signal.SIGUSR1, dump_stats)
+
+    print("Running the sharded server with {} shards.".format(shard_count))
+    try:
+        asyncio.run(supervisor.run())
+    finally:
+        for shard in supervisor.shards:
+            if shard.process is not None:
+                shard.process.terminate()
+
+
+# A shard's process runs this file:
+#     python3 sharded_server.py worker <index> <shards> <control fd> <rows> <columns> <connect>
+# See Supervisor.start_shard().
+if __name__ == "__main__":
+    if len(sys.argv) != 8 or sys.argv[1] != "worker":
+        print("sharded_server.py is started by \"python3 server.py sharded\".")
+        sys.exit(1)
+    index, shard_count, fd, rows, columns, connect = (int(arg) for arg in sys.argv[2:])
+    run_worker(index, shard_count, socket.socket(fileno=fd), rows, columns, connect)
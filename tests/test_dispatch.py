@@ -0,0 +1,280 @@
+# Tests for dispatch.handle_message(), with clients that collect what they're
+# sent instead of writing to a socket.
+
+import pytest
+
+import wire
+from bitboard import Bitboard
+from dispatch import Client, client_disconnected, handle_message
+from lifecycle import Reaper
+from metrics import ServerMetrics
+from net_client import subscribe_reply
+from sessions import SessionTable
+
+# A 4x4 game (four in a row wins) that fills the board without anyone
+# winning. The rows go red red yellow yellow, then yellow yellow red red.
+DRAWN_4X4 = [0, 2, 1, 3, 2, 0, 3, 1, 0, 2, 1, 3, 2, 0, 3, 1]
+
+
+class FakeClient(Client):
+
+    __slots__ = ("sent", "pushed")
+
+    def __init__(self, sessions):
+        super().__init__(sessions, self.collect, self.collect_push)
+        # Replies pushed with send(), and (ASCII, framed) spectator pushes.
+        self.sent = []
+        self.pushed = []
+
+    def collect(self, reply):
+        self.sent.append(reply)
+
+    def collect_push(self, encodings):
+        self.pushed.append(encodings[0])
+        return True
+
+
+# Handle a message written the ASCII way.
+def ask(client, text):
+    return handle_message(client, wire.parse_ascii(text))
+
+
+@pytest.fixture
+def sessions():
+    return SessionTable()
+
+
+# Two clients in a game that has started.
+@pytest.fixture
+def players(sessions):
+    red = FakeClient(sessions)
+    yellow = FakeClient(sessions)
+    assert ask(red, "p=1") == wire.REPLY_WAIT
+    assert ask(yellow, "p=2") == wire.REPLY_START
+    return red, yellow
+
+
+# Play columns in turn, starting at turn first, and check every move is
+# affirmed.
+def play(red, yellow, columns, first=1):
+    for turn_num, col in enumerate(columns, first):
+        player = red if turn_num % 2 else yellow
+        assert ask(player, "turn {}:{}".format(turn_num, col)) == wire.REPLY_AFFIRM
+
+
+def test_join_pairs_players_and_tells_the_one_waiting(sessions):
+    red = FakeClient(sessions)
+    assert ask(red, "p=1") == wire.REPLY_WAIT
+    assert ask(red, "waited") == wire.REPLY_WAIT
+    assert ask(red, "waitstart") is None
+    yellow = FakeClient(sessions)
+    assert ask(yellow, "p=2") == wire.REPLY_START
+    assert red.sent == [wire.REPLY_START]
+    assert ask(red, "waited") == wire.REPLY_START
+    assert red.session is yellow.session
+    assert sessions.count() == 1
+
+
+def test_match_pairs_anyone(sessions):
+    first = FakeClient(sessions)
+    second = FakeClient(sessions)
+    assert ask(first, "match") is None
+    assert ask(second, "match") == (wire.MATCHED, 2)
+    assert first.sent == [(wire.MATCHED, 1)]
+
+
+def test_turn_is_passed_to_the_opponent(players):
+    red, yellow = players
+    assert ask(yellow, "waiting 1") == wire.REPLY_WAIT
+    assert ask(yellow, "subscribe 1") is None
+    assert ask(red, "turn 1:3") == wire.REPLY_AFFIRM
+    assert yellow.sent == [(wire.MOVE, 3)]
+    assert ask(yellow, "waiting 1") == (wire.MOVE, 3)
+    assert ask(yellow, "subscribe 1") == (wire.MOVE, 3)
+
+
+def test_resent_turn_is_affirmed_again(players):
+    red, yellow = players
+    assert ask(red, "turn 1:3") == wire.REPLY_AFFIRM
+    assert ask(red, "turn 1:3") == wire.REPLY_AFFIRM
+    # But a different column for the same turn isn't.
+    assert ask(red, "turn 1:4") == wire.REPLY_REFUSED
+    assert ask(yellow, "waiting 1") == (wire.MOVE, 3)
+
+
+@pytest.mark.parametrize("text", ["waiting 3", "waiting -1", "waiting 200"])
+def test_waiting_before_joining(sessions, text):
+    assert ask(FakeClient(sessions), text) == wire.REPLY_WAIT
+
+
+@pytest.mark.parametrize("text", ["subscribe 3", "waitstart", "turn 1:3", "turn 200:3"])
+def test_refused_before_joining(sessions, text):
+    assert ask(FakeClient(sessions), text) == wire.REPLY_REFUSED
+
+
+@pytest.mark.parametrize("text", ["waiting 0", "waiting -1", "waiting 43", "waiting 200",
+                                  "subscribe 0", "subscribe -5", "subscribe 43", "subscribe 200"])
+def test_turns_the_game_does_not_have_are_refused(players, text):
+    red, yellow = players
+    assert ask(yellow, text) == wire.REPLY_REFUSED
+
+
+def test_last_turn_of_the_game_can_be_asked_about(players):
+    red, yellow = players
+    assert ask(yellow, "waiting 42") == wire.REPLY_WAIT
+    assert ask(yellow, "subscribe 42") is None
+
+
+@pytest.mark.parametrize("player, text", [
+    (1, "turn 1:3"),   # yellow going first
+    (0, "turn 2:3"),   # skipping a turn
+    (0, "turn 0:3"),
+    (0, "turn -1:3"),
+    (0, "turn 65535:3"),
+    (0, "turn 1:7"),   # no column 7
+    (0, "turn 1:-1"),
+])
+def test_bad_turns_are_refused(players, player, text):
+    assert ask(players[player], text) == wire.REPLY_REFUSED
+    # Nothing was played.
+    assert ask(players[1], "waiting 1") == wire.REPLY_WAIT
+
+
+def test_full_column_is_refused(players):
+    red, yellow = players
+    play(red, yellow, [2] * 6)
+    assert ask(red, "turn 7:2") == wire.REPLY_REFUSED
+    assert ask(red, "turn 7:3") == wire.REPLY_AFFIRM
+
+
+def test_win_ends_the_game(sessions, players):
+    red, yellow = players
+    spectator = FakeClient(sessions)
+    assert ask(spectator, "watch {}".format(red.session.id)) is None
+    assert ask(yellow, "subscribe 7") is None
+    play(red, yellow, [0, 1, 0, 1, 0, 1, 0])
+    assert red.session.finished
+    assert sessions.count() == 0
+    assert yellow.sent == [(wire.MOVE, 0)]
+    assert spectator.pushed[-1] == b"ended\n"
+    # No more moves, and saying it's over is still fine.
+    assert ask(yellow, "turn 8:1") == wire.REPLY_REFUSED
+    assert ask(red, "gameover") == wire.REPLY_AFFIRM
+    assert ask(yellow, "gameover") == wire.REPLY_AFFIRM
+    assert red.session is None
+
+
+def test_full_board_is_a_draw():
+    sessions = SessionTable(rows=4, columns=4, connect=4)
+    red = FakeClient(sessions)
+    yellow = FakeClient(sessions)
+    ask(red, "p=1")
+    ask(yellow, "p=2")
+    session = red.session
+    play(red, yellow, DRAWN_4X4[:-1])
+    assert not session.finished
+    play(red, yellow, DRAWN_4X4[-1:], first=len(DRAWN_4X4))
+    assert session.finished
+    assert sessions.count() == 0
+
+
+def test_gameover_frees_an_unfinished_game(sessions, players):
+    red, yellow = players
+    play(red, yellow, [3, 3])
+    assert ask(red, "gameover") == wire.REPLY_AFFIRM
+    assert sessions.count() == 0
+    assert ask(yellow, "turn 3:3") == wire.REPLY_REFUSED
+
+
+# The resume token of a player, from the reply to "token".
+def token_of(client):
+    reply = ask(client, "token")
+    assert reply[0] == wire.SESSION_TOKEN
+    return reply[1]
+
+
+def test_token_waits_for_the_game_to_start(sessions):
+    red = FakeClient(sessions)
+    assert ask(red, "token") == wire.REPLY_WAIT
+    ask(red, "p=1")
+    assert ask(red, "token") == wire.REPLY_WAIT
+
+
+def test_resume_after_disconnecting(sessions, players):
+    red, yellow = players
+    token = token_of(red)
+    # Asking again gives the same token.
+    assert token_of(red) == token
+    play(red, yellow, [3, 4])
+    client_disconnected(red)
+
+    back = FakeClient(sessions)
+    assert ask(back, "resume {:x}".format(token)) == (wire.RESUMED, 1, bytes((3, 4)))
+    assert ask(back, "turn 3:3") == wire.REPLY_AFFIRM
+    assert ask(yellow, "waiting 3") == (wire.MOVE, 3)
+
+    # The same token moves the player to yet another connection, and the
+    # last one is no longer in the game.
+    again = FakeClient(sessions)
+    assert ask(again, "resume {:x}".format(token)) == (wire.RESUMED, 1, bytes((3, 4, 3)))
+    client_disconnected(back)
+    assert again.session.players == 3
+    assert ask(yellow, "turn 4:4") == wire.REPLY_AFFIRM
+    assert ask(again, "turn 5:3") == wire.REPLY_AFFIRM
+
+
+def test_resume_with_a_wrong_token(sessions, players):
+    red, yellow = players
+    token = token_of(red)
+    assert ask(FakeClient(sessions), "resume {:x}".format(token ^ 1)) == wire.REPLY_ENDED
+    assert ask(FakeClient(sessions), "resume 0") == wire.REPLY_ENDED
+
+
+def test_resume_a_game_won_while_away(sessions, players):
+    red, yellow = players
+    token = token_of(red)
+    play(red, yellow, [0, 1, 0, 1, 5, 1, 6])
+    client_disconnected(red)
+    assert ask(yellow, "turn 8:1") == wire.REPLY_AFFIRM
+    assert yellow.session.finished
+    assert ask(yellow, "token") == wire.REPLY_ENDED
+
+    back = FakeClient(sessions)
+    assert ask(back, "resume {:x}".format(token)) == (wire.RESUMED, 1, bytes((0, 1, 0, 1, 5, 1, 6, 1)))
+    assert ask(back, "turn 9:2") == wire.REPLY_REFUSED
+
+
+def test_abandoned_game_cannot_be_resumed(sessions, players):
+    red, yellow = players
+    token = token_of(red)
+    play(red, yellow, [3])
+    client_disconnected(red)
+    assert sessions.abandon(yellow.session) == []
+    assert ask(FakeClient(sessions), "resume {:x}".format(token)) == wire.REPLY_ENDED
+
+
+# The player still in an abandoned game is told it's over, in words the
+# kiosk waiting for the opponent's move understands (see net_client.py).
+@pytest.mark.parametrize("framed", [False, True])
+def test_abandoned_game_tells_the_opponent(sessions, players, framed):
+    red, yellow = players
+    session = red.session
+    play(red, yellow, [3])
+    assert ask(red, "subscribe 2") is None
+    assert ask(yellow, "subscribe 3") is None
+    client_disconnected(yellow)
+    Reaper(sessions, ServerMetrics()).abandon(session)
+    assert red.sent == [wire.REPLY_ENDED]
+    if framed:
+        (reply,) = wire.MessageReader(framed=True).load(wire.encode_reply(red.sent[0], True))
+        text = wire.reply_text(reply)
+    else:
+        text = wire.encode_reply(red.sent[0], False).decode(wire.CODEC)
+    assert subscribe_reply(text, Bitboard()) == ("ended", None)
+
+
+def test_ping_and_unknown(sessions):
+    client = FakeClient(sessions)
+    assert ask(client, "ping") == wire.REPLY_PONG
+    assert ask(client, "what") == wire.REPLY_NOTHING
+    assert ask(client, "analyze 3") == wire.REPLY_NO_ANALYSIS
@@ -0,0 +1,42 @@
+# Tests for how the kiosk reads the server's replies (net_client.py).
+
+import pytest
+
+import wire
+from bitboard import Bitboard
+from net_client import subscribe_reply
+
+
+# The text the kiosk gets for a reply, with the ASCII protocol or the framed
+# one.
+def reply_as_text(reply, framed):
+    if not framed:
+        return wire.encode_reply(reply, False).decode(wire.CODEC)
+    (parsed,) = wire.MessageReader(framed=True).load(wire.encode_reply(reply, True))
+    return wire.reply_text(parsed)
+
+
+@pytest.mark.parametrize("framed", [False, True])
+@pytest.mark.parametrize("reply, meaning", [
+    ((wire.MOVE, 0), ("moved", 0)),
+    ((wire.MOVE, 6), ("moved", 6)),
+    # There's no column 7, and column 2 is full (see below).
+    ((wire.MOVE, 7), ("lost", None)),
+    ((wire.MOVE, 2), ("lost", None)),
+    (wire.REPLY_ENDED, ("ended", None)),
+    (wire.REPLY_REFUSED, ("lost", None)),
+    (wire.REPLY_AFFIRM, ("other", None)),
+    (wire.REPLY_WAIT, ("other", None)),
+    (wire.REPLY_START, ("other", None)),
+    ((wire.MATCHED, 1), ("other", None)),
+])
+def test_subscribe_reply(reply, meaning, framed):
+    board = Bitboard()
+    for i in range(board.rows):
+        board.play(2, 1 + i % 2)
+    assert subscribe_reply(reply_as_text(reply, framed), board) == meaning
+
+
+@pytest.mark.parametrize("text", ["", "-1", "3 ", "x", "ended now", "\n"])
+def test_subscribe_reply_ignores_anything_else(text):
+    assert subscribe_reply(text, Bitboard()) == ("other", None)
@@ -0,0 +1,85 @@
+# Tests for the server's own boards in sessions.py, checked against Bitboard.
+
+import random
+
+import pytest
+
+import sessions as sessions_module
+from bitboard import Bitboard
+from sessions import MOVE_DRAWN, MOVE_PLAYED, MOVE_REFUSED, MOVE_REPEATED, MOVE_WON, SessionTable
+
+
+class ListLog:
+
+    def __init__(self):
+        self.games = []
+
+    def append(self, start_time, moves):
+        self.games.append(bytes(moves))
+
+
+# Random games, played on a SessionTable and on a Bitboard side by side. The
+# table has to agree about every win and draw, refuse every move that can't
+# be played, and log each game when it ends.
+@pytest.mark.parametrize("rows, columns, connect", [(6, 7, 4), (4, 4, 4), (5, 6, 3), (9, 10, 5)])
+def test_record_move_agrees_with_bitboard(rows, columns, connect):
+    rng = random.Random(rows * 100 + columns * 10 + connect)
+    log = ListLog()
+    table = SessionTable(log, rows, columns, connect)
+    for game in range(200):
+        session, _ = table.join(1)
+        table.join(2)
+        board = Bitboard(rows, columns, connect)
+        turn_num = 1
+        while True:
+            piece = 1 if turn_num % 2 else 2
+            assert table.record_move(session, 3 - piece, turn_num, 0)[0] == MOVE_REFUSED
+            assert table.record_move(session, piece, turn_num + 1, 0)[0] == MOVE_REFUSED
+            assert table.record_move(session, piece, turn_num, columns)[0] == MOVE_REFUSED
+            for col in range(columns):
+                if not board.can_play(col):
+                    assert table.record_move(session, piece, turn_num, col)[0] == MOVE_REFUSED
+            col = rng.choice(board.valid_columns())
+            row = board.play(col, piece)
+            result, waiters = table.record_move(session, piece, turn_num, col)
+            assert table.record_move(session, piece, turn_num, col)[0] == MOVE_REPEATED
+            if board.winning_cells(row, col):
+                assert result == MOVE_WON
+                break
+            if board.is_full():
+                assert result == MOVE_DRAWN
+                break
+            assert result == MOVE_PLAYED
+            turn_num += 1
+        assert session.finished
+        assert session.red == board.pieces[0]
+        assert session.occupied == board.pieces[0] | board.pieces[1]
+        assert table.record_move(session, 3 - piece, turn_num + 1, 0)[0] == MOVE_REFUSED
+        assert table.count() == 0
+    assert len(log.games) == 200
+
+
+# A game handed to another table (as the sharded server does) gets the same
+# board.
+def test_add_started_rebuilds_the_board():
+    table = SessionTable()
+    session, _ = table.join(1)
+    table.join(2)
+    for turn_num, col in enumerate([3, 3, 4, 2, 5], 1):
+        table.record_move(session, 2 - turn_num % 2, turn_num, col)
+    copy = SessionTable().add_started(session.id, session.moves)
+    assert (copy.red, copy.occupied, copy.turns) == (session.red, session.occupied, session.turns)
+    assert copy.columns() == session.columns()
+
+
+def test_tokens_of_ended_games_expire(monkeypatch):
+    monkeypatch.setattr(sessions_module, "ABANDON_TIMEOUT", 0)
+    table = SessionTable()
+    session, _ = table.join(1)
+    table.join(2)
+    token = table.issue_token(session, 1, None)
+    for turn_num, col in enumerate([0, 1, 0, 1, 0, 1, 0], 1):
+        table.record_move(session, 2 - turn_num % 2, turn_num, col)
+    assert session.finished
+    assert table.resume(token, None) is None
+    assert not table.tokens and not table.ended_tokens
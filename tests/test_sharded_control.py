@@ -0,0 +1,65 @@
+# Tests for the messages between the sharded server's supervisor and its
+# shards, over a socket pair like the one Supervisor.start_shard() makes.
+
+import pickle
+import socket
+
+import pytest
+
+import sharded_server
+from sharded_server import CONTROL_BUFFER, Worker, receive_control, send_control
+
+
+@pytest.fixture
+def control():
+    supervisor_end, shard_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    yield supervisor_end, shard_end
+    supervisor_end.close()
+    shard_end.close()
+
+
+# Read every message waiting on a control socket.
+def receive_all(control):
+    control.setblocking(False)
+    messages = []
+    while True:
+        try:
+            message, fds = receive_control(control)
+        except BlockingIOError:
+            return messages
+        messages.append(message)
+
+
+# A busy shard has far more finished games than fit in one message. They're
+# sent a few hundred at a time, and every one arrives.
+def test_report_splits_finished_games(control):
+    supervisor_end, shard_end = control
+    worker = Worker(0, 1, shard_end, 6, 7, 4)
+    for i in range(5000):
+        worker.game_log.append(float(i), bytes(range(42)))
+    worker.report()
+    messages = receive_all(supervisor_end)
+    assert messages[-1][0] == "stats"
+    games = [game for kind, chunk in messages[:-1] for game in chunk]
+    assert [start_time for start_time, moves in games] == [float(i) for i in range(5000)]
+    assert len(messages) - 1 == 5000 // sharded_server.GAMES_PER_MESSAGE
+    # Nothing is left to send next time.
+    worker.report()
+    assert [kind for kind, *rest in receive_all(supervisor_end)] == ["stats"]
+
+
+def test_message_too_long_to_receive_is_not_sent(control):
+    supervisor_end, shard_end = control
+    with pytest.raises(ValueError, match="too long"):
+        send_control(shard_end, ("games", [(0.0, bytes(CONTROL_BUFFER))]))
+
+
+@pytest.mark.parametrize("data, error", [
+    (pickle.dumps(bytes(CONTROL_BUFFER * 2)), "longer than"),
+    (b"not a pickle", "bad control message"),
+])
+def test_bad_messages_raise(control, data, error):
+    supervisor_end, shard_end = control
+    shard_end.send(data)
+    with pytest.raises(ValueError, match=error):
+        receive_control(supervisor_end)
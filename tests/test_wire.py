@@ -0,0 +1,184 @@
+# Tests for wire.py: framing, the handshake and the ASCII parser.
+
+import pytest
+
+import wire
+from wire import MessageReader
+
+
+# Feed bytes to a reader as if recv_into() had received them, and return the
+# messages they complete.
+def feed(reader, data):
+    space = reader.free_space()
+    space[:len(data)] = data
+    return reader.received(len(data))
+
+
+REQUESTS = [
+    (wire.JOIN, 2, 0),
+    (wire.TURN, 17, 6),
+    (wire.TURN, 65535, 255),
+    (wire.WAITING, 42, 0),
+    (wire.SUBSCRIBE, 3, 0),
+    (wire.WATCH, 0xDEADBEEF, 0),
+    (wire.RESUME, 0x0123456789ABCDEF, 0),
+    (wire.ANALYZE, 0, bytes((3, 3, 4, 2))),
+    (wire.ANALYZE, 0, b''),
+    (wire.WAITED, 0, 0),
+    (wire.WAITSTART, 0, 0),
+    (wire.GAMEOVER, 0, 0),
+    (wire.MATCH, 0, 0),
+    (wire.TOKEN, 0, 0),
+    (wire.PING, 0, 0),
+]
+
+
+@pytest.mark.parametrize("request_tuple", REQUESTS)
+def test_framed_request_round_trip(request_tuple):
+    reader = MessageReader(framed=True)
+    assert feed(reader, wire.encode_request(request_tuple)) == [request_tuple]
+
+
+def test_handshake_switches_to_framed():
+    reader = MessageReader()
+    data = wire.HELLO_BYTES + wire.encode_request((wire.JOIN, 1, 0))
+    assert feed(reader, data) == [(wire.HELLO, wire.VERSION, 0), (wire.JOIN, 1, 0)]
+    assert reader.framed is True
+
+
+def test_handshake_split_across_receives():
+    reader = MessageReader()
+    assert feed(reader, wire.HELLO_BYTES[:1]) == []
+    assert reader.framed is None
+    assert feed(reader, wire.HELLO_BYTES[1:]) == [(wire.HELLO, wire.VERSION, 0)]
+
+
+def test_frames_split_and_glued_together():
+    data = b"".join(wire.encode_request(request) for request in REQUESTS)
+    reader = MessageReader(framed=True)
+    messages = []
+    for i in range(len(data)):
+        messages += feed(reader, data[i:i + 1])
+    assert messages == REQUESTS
+    assert reader.unparsed() == b''
+
+
+# A small buffer fills up with part of a frame, which has to be moved to the
+# front to make room for the rest.
+def test_partial_frame_moved_to_front():
+    reader = MessageReader(framed=True, size=16)
+    frame = wire.encode_request((wire.TURN, 5, 3))
+    messages = []
+    for _ in range(10):
+        messages += feed(reader, frame[:3])
+        messages += feed(reader, frame[3:])
+    assert messages == [(wire.TURN, 5, 3)] * 10
+
+
+def test_unparsed_bytes_can_be_loaded_into_another_reader():
+    frame = wire.encode_request((wire.SUBSCRIBE, 9, 0))
+    first = MessageReader(framed=True)
+    assert feed(first, frame[:2]) == []
+    second = MessageReader(framed=True)
+    assert second.load(first.unparsed()) == []
+    assert feed(second, frame[2:]) == [(wire.SUBSCRIBE, 9, 0)]
+
+
+@pytest.mark.parametrize("data, error", [
+    (wire.HEADER.pack(0, wire.TURN), "empty frame"),
+    (wire.HEADER.pack(2, wire.TURN) + b"\x00", "frame too short"),
+])
+def test_bad_frames_raise(data, error):
+    with pytest.raises(ValueError, match=error):
+        feed(MessageReader(framed=True), data)
+
+
+def test_frame_longer_than_buffer_raises():
+    reader = MessageReader(framed=True, size=16)
+    with pytest.raises(ValueError, match="frame too long"):
+        feed(reader, wire.HEADER.pack(100, wire.ANALYZE) + bytes(13))
+
+
+REPLIES = [
+    wire.REPLY_WAIT,
+    wire.REPLY_START,
+    wire.REPLY_AFFIRM,
+    wire.REPLY_ENDED,
+    wire.REPLY_PONG,
+    wire.REPLY_REFUSED,
+    (wire.MOVE, 0),
+    (wire.MOVE, 6),
+    (wire.MATCHED, 2),
+    (wire.SESSION_TOKEN, 0x00000001ABCDEF12),
+    (wire.RESUMED, 1, bytes((3, 3, 4, 11))),
+    (wire.ANALYSIS, 3, (-2, 5, None, 0, 1, -7, 2)),
+    wire.REPLY_NO_ANALYSIS,
+]
+
+
+# The client parses framed replies with a MessageReader too. Replies without
+# a second value come out with zeros filling in the unused numbers.
+@pytest.mark.parametrize("reply", REPLIES)
+def test_framed_reply_round_trip(reply):
+    reader = MessageReader(framed=True)
+    (parsed,) = feed(reader, wire.encode_reply(reply, True))
+    assert parsed[:len(reply)] == reply
+    # And back into the text the old protocol would have sent.
+    assert wire.reply_text(parsed) == wire.encode_reply(reply, False).decode(wire.CODEC)
+
+
+def test_played_push_round_trip():
+    ascii_played, framed_played = wire.encode_played(12, 4)
+    assert ascii_played == b"played 12:4\n"
+    reader = MessageReader(framed=True)
+    (parsed,) = feed(reader, framed_played)
+    assert parsed == (wire.PLAYED, 12, 4)
+    assert wire.reply_text(parsed) == "played 12:4\n"
+
+
+def test_watching_push_lists_every_move():
+    moves = bytearray(43)
+    moves[1:4] = bytes((4, 5, 4))
+    ascii_watching, framed_watching = wire.encode_watching(moves)
+    assert ascii_watching == b"watching\nplayed 1:3\nplayed 2:4\nplayed 3:3\n"
+    reader = MessageReader(framed=True)
+    assert feed(reader, framed_watching) == [(wire.WATCHING, 0, 0), (wire.PLAYED, 1, 3),
+                                            (wire.PLAYED, 2, 4), (wire.PLAYED, 3, 3)]
+
+
+@pytest.mark.parametrize("text, request_tuple", [
+    ("p=1", (wire.JOIN, 1, 0)),
+    ("p=2", (wire.JOIN, 2, 0)),
+    ("p=3", (wire.UNKNOWN, 0, 0)),
+    ("waited", (wire.WAITED, 0, 0)),
+    ("waitstart", (wire.WAITSTART, 0, 0)),
+    ("match", (wire.MATCH, 0, 0)),
+    ("ping", (wire.PING, 0, 0)),
+    ("token", (wire.TOKEN, 0, 0)),
+    ("gameover", (wire.GAMEOVER, 0, 0)),
+    ("turn 3:4", (wire.TURN, 3, 4)),
+    ("turn 3", (wire.UNKNOWN, 0, 0)),
+    ("turn x:4", (wire.UNKNOWN, 0, 0)),
+    ("waiting 7", (wire.WAITING, 7, 0)),
+    # Out of range numbers get through the parser. dispatch.py checks them.
+    ("waiting -1", (wire.WAITING, -1, 0)),
+    ("waiting", (wire.UNKNOWN, 0, 0)),
+    ("subscribe 2", (wire.SUBSCRIBE, 2, 0)),
+    ("watch 12", (wire.WATCH, 12, 0)),
+    ("resume 00000001abcdef12", (wire.RESUME, 0x00000001ABCDEF12, 0)),
+    ("resume zz", (wire.UNKNOWN, 0, 0)),
+    ("analyze", (wire.ANALYZE, 0, b'')),
+    ("analyze 33a", (wire.ANALYZE, 0, bytes((3, 3, 10)))),
+    ("hello there", (wire.UNKNOWN, 0, 0)),
+    ("", (wire.UNKNOWN, 0, 0)),
+])
+def test_parse_ascii(text, request_tuple):
+    assert wire.parse_ascii(text) == request_tuple
+
+
+def test_ascii_reader_takes_each_receive_as_one_message():
+    reader = MessageReader()
+    assert feed(reader, b"turn 1:3") == [(wire.TURN, 1, 3)]
+    assert reader.framed is False
+    assert feed(reader, b"waiting 2") == [(wire.WAITING, 2, 0)]
+    assert feed(reader, b"\xff\xfe") == [(wire.UNKNOWN, 0, 0)]
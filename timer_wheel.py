@@ -0,0 +1,109 @@
+# A hashed timer wheel, for keeping track of lots of timeouts at once.
+#
+# The server wants a timeout for every connection, and one for every game a
+# player has walked out of. Almost all of them are cancelled or pushed back
+# before they go off, so what matters is that scheduling and cancelling are
+# cheap. A heap makes both O(log n), and cancelling either leaves dead
+# entries behind or needs a search.
+#
+# A timer wheel is a ring of SLOTS buckets, each covering one tick of time.
+# A timer goes in the bucket for the tick it expires on (modulo the number of
+# buckets), so scheduling and cancelling are one set operation each, O(1)
+# however many timers there are. Every tick, advance() looks at the bucket
+# for that tick and fires the timers in it that are due. A timer more than one
+# turn of the wheel away stays in its bucket until the wheel comes round to
+# it the right number of times.
+#
+# Times are only as precise as the tick, which is fine for timeouts measured
+# in seconds or minutes.
+
+import threading
+import time
+
+# The length of one tick (seconds), and the number of buckets. One turn of
+# the wheel is TICK * SLOTS seconds.
+TICK = 1.0
+SLOTS = 512
+
+
+class Timer:
+
+    __slots__ = ("tick", "callback", "slot")
+
+    def __init__(self, tick, callback, slot):
+        # The tick the timer goes off on, counted from when the wheel was
+        # made.
+        self.tick = tick
+        self.callback = callback
+        # The bucket it's in, or None once it has gone off or been cancelled.
+        self.slot = slot
+
+
+class TimerWheel:
+
+    def __init__(self, tick=TICK, slots=SLOTS, clock=time.monotonic):
+        self.tick_length = tick
+        self.clock = clock
+        self.start = clock()
+        # Each bucket is a set, so a timer can be taken out of it in O(1).
+        self.slots = [set() for i in range(slots)]
+        # The last tick advance() has dealt with.
+        self.current = 0
+        # The threaded server schedules timers from every connection's
+        # thread.
+        self.lock = threading.Lock()
+        self.count = 0
+
+    # The tick a time (from clock()) falls in.
+    def tick_at(self, when):
+        return int((when - self.start) / self.tick_length)
+
+    # Call callback (with no arguments) in delay seconds, give or take a
+    # tick. Returns the Timer, which can be passed to cancel().
+    def schedule(self, delay, callback):
+        # Round up, so a timer never goes off early.
+        tick = self.tick_at(self.clock()) + max(1, -int(-delay // self.tick_length))
+        with self.lock:
+            # A timer for a tick the wheel has already passed goes off on the
+            # next one.
+            tick = max(tick, self.current + 1)
+            slot = self.slots[tick % len(self.slots)]
+            timer = Timer(tick, callback, slot)
+            slot.add(timer)
+            self.count += 1
+        return timer
+
+    # Stop a timer from going off. Does nothing if it already has.
+    def cancel(self, timer):
+        with self.lock:
+            if timer.slot is not None:
+                timer.slot.discard(timer)
+                timer.slot = None
+                self.count -= 1
+
+    # How many timers are waiting to go off.
+    def __len__(self):
+        return self.count
+
+    # Fire every timer that is due by now. Call this at least once a tick.
+    # The callbacks are called without the lock held, so they can schedule
+    # and cancel timers. Returns how many went off.
+    def advance(self):
+        now = self.tick_at(self.clock())
+        due = []
+        with self.lock:
+            while self.current < now:
+                self.current += 1
+                slot = self.slots[self.current % len(self.slots)]
+                if not slot:
+                    continue
+                # Timers a turn or more away share the bucket. Leave them.
+                expired = [timer for timer in slot if timer.tick <= self.current]
+                for timer in expired:
+                    slot.discard(timer)
+                    timer.slot = None
+                self.count -= len(expired)
+                due.extend(expired)
+        for timer in due:
+            timer.callback()
+        return len(due)
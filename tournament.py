@@ -0,0 +1,360 @@
+# Bot tournaments: which way of picking moves is strongest?
+#
+# A strategy is a function that picks a move: given the board (a Bitboard,
+# see bitboard.py), the piece to play and a random.Random, it returns a
+# column, and leaves the board as it found it. A few are built in (see
+# STRATEGIES), and any function with that signature can be entered by its
+# module and name, e.g. "mybots.pick".
+#
+# Games are played with the rules the kiosks use (rules.py), on a pool of
+# worker processes, one per core by default, so every core is kept busy.
+# Every pair of strategies plays the same number of games, taking turns at
+# being red (who moves first). A strategy that returns a column it can't play,
+# or raises an exception, loses that game.
+#
+#   roundrobin  every strategy plays every other one
+#   gauntlet    the first strategy plays each of the others, who don't play
+#               each other
+#
+# Each game is written to the results file as a line of JSON as soon as it
+# finishes, so a long tournament can be watched (or stopped) as it goes:
+#
+#   {"game": 12, "red": "ai", "yellow": "greedy", "winner": "red",
+#    "moves": "3342...", "seconds": 0.84}
+#
+# winner is "red", "yellow" or "draw". A game lost by a bad move also has
+# "forfeit", saying what went wrong.
+#
+# At the end (or for any results file, with "ratings"), every strategy is
+# given an Elo rating, with a 95% confidence interval. The ratings are the
+# ones that make the results most likely (the Bradley-Terry model, where a
+# strategy rated 400 points higher is expected to score 10 times as many
+# points), with draws counting half a point each way.
+#
+# Usage:
+#   python3 tournament.py roundrobin <games per pair> <strategy> <strategy> ...
+#   python3 tournament.py gauntlet <games per pair> <challenger> <opponent> ...
+#   python3 tournament.py ratings [file]
+# with any of out=<file> (default tournament.jsonl), workers=<n>, seed=<n>
+# and the board settings ("size=9x10 connect=5", see rules.py) added to the
+# first two.
+
+import importlib
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+from multiprocessing import get_context
+
+from rules import (create_board, drop_piece, get_next_open_row, winning_move_at, board_full, piece_for_turn,
+                   parse_board_args)
+from wire import COLUMN_DIGITS
+
+RESULTS_FILE = "tournament.jsonl"
+
+# How long the "ai" strategy thinks per move (ms), unless it's given a time
+# ("ai:200").
+AI_TIME_MS = 50
+
+# Ratings are relative, so they're shifted to average this.
+ELO_BASE = 1500
+# Everyone starts the rating calculation with this many draws against each
+# strategy they played. Without them, a strategy that won (or lost) every
+# game would be rated infinitely high (or low).
+PRIOR_DRAWS = 1
+# How close the ratings have to settle (Elo points) before the calculation
+# stops.
+ELO_TOLERANCE = 0.01
+# How many standard errors either side of a rating its confidence interval
+# covers. 1.96 makes it 95%.
+CONFIDENCE_Z = 1.96
+
+# How often to print how it's going (games).
+PROGRESS_INTERVAL = 1000
+
+
+# Pick any column that can be played.
+def random_move(board, piece, rng):
+    return rng.choice(board.valid_columns())
+
+
+# Play as near the middle as possible. The middle columns are part of the
+# most lines.
+def center_move(board, piece, rng):
+    middle = (board.columns - 1) / 2
+    columns = board.valid_columns()
+    nearest = min(abs(col - middle) for col in columns)
+    return rng.choice([col for col in columns if abs(col - middle) == nearest])
+
+
+# The column that would complete a line for piece right now, or None.
+def winning_column(board, piece):
+    for col in board.valid_columns():
+        row = get_next_open_row(board, col)
+        drop_piece(board, row, col, piece)
+        won = winning_move_at(board, row, col)
+        board.undo()
+        if won:
+            return col
+    return None
+
+
+# Win if we can, stop the opponent winning if we must, and otherwise play
+# anywhere.
+def greedy_move(board, piece, rng):
+    col = winning_column(board, piece)
+    if col is None:
+        col = winning_column(board, 3 - piece)
+    if col is None:
+        col = random_move(board, piece, rng)
+    return col
+
+
+# The computer opponent (see ai.py), thinking for time_ms per move. Each one
+# gets its own transposition table, so two of them in a game don't share what
+# they've learned.
+def make_ai(time_ms=AI_TIME_MS):
+    import ai
+    table = ai.TranspositionTable()
+
+    def ai_move(board, piece, rng):
+        return ai.best_move(board, piece, time_ms, table=table).column
+    return ai_move
+
+
+# The built-in strategies, by name. Each makes a move function.
+STRATEGIES = {
+    "random": lambda: random_move,
+    "center": lambda: center_move,
+    "greedy": lambda: greedy_move,
+    "ai": make_ai,
+}
+
+
+# Make the move function a strategy's name stands for: a built-in one, "ai:"
+# followed by a time in ms, or a function's module and name ("mybots.pick").
+# Raises ValueError if there's no such strategy.
+def load_strategy(name):
+    if name in STRATEGIES:
+        return STRATEGIES[name]()
+    if name.startswith("ai:"):
+        return make_ai(int(name[3:]))
+    module_name, dot, function_name = name.rpartition(".")
+    if not dot:
+        raise ValueError("no strategy called {}".format(name))
+    try:
+        return getattr(importlib.import_module(module_name), function_name)
+    except (ImportError, AttributeError) as e:
+        raise ValueError("can't load strategy {}: {}".format(name, e))
+
+
+# The move functions made so far in this worker process. Making the "ai"
+# ones allocates their tables, so each is only made once per process.
+loaded_strategies = {}
+
+
+# Play one game in a worker process. job is (game number, red's strategy,
+# yellow's strategy, seed, rows, columns, connect). Returns the game's
+# result, as written to the results file.
+def play_game(job):
+    game_number, red, yellow, seed, rows, columns, connect = job
+    start = time.perf_counter()
+    rng = random.Random(seed)
+    names = (red, yellow)
+    players = []
+    for name in names:
+        if name not in loaded_strategies:
+            loaded_strategies[name] = load_strategy(name)
+        players.append(loaded_strategies[name])
+
+    board = create_board(rows, columns, connect)
+    result = {"game": game_number, "red": red, "yellow": yellow, "winner": "draw"}
+    turn_num = 1
+    while not board_full(board):
+        piece = piece_for_turn(turn_num)
+        color = "red" if piece == 1 else "yellow"
+        try:
+            col = players[piece - 1](board, piece, rng)
+            if col not in board.valid_columns():
+                raise ValueError("played column {!r}".format(col))
+            col = int(col)
+        except Exception as e:
+            result["winner"] = "yellow" if piece == 1 else "red"
+            result["forfeit"] = "{} {}".format(color, e)
+            break
+        row = get_next_open_row(board, col)
+        drop_piece(board, row, col, piece)
+        if winning_move_at(board, row, col):
+            result["winner"] = color
+            break
+        turn_num += 1
+
+    result["moves"] = "".join(COLUMN_DIGITS[col] for col in board.moves)
+    result["seconds"] = round(time.perf_counter() - start, 4)
+    return result
+
+
+# Every game of a tournament, as (red, yellow) pairs. Each pair of strategies
+# plays games_per_pair games, swapping colors every game.
+def pairings(mode, strategies, games_per_pair):
+    if mode == "gauntlet":
+        pairs = [(strategies[0], opponent) for opponent in strategies[1:]]
+    else:
+        pairs = list(itertools.combinations(strategies, 2))
+    for first, second in pairs:
+        for game in range(games_per_pair):
+            yield (first, second) if game % 2 == 0 else (second, first)
+
+
+# Play a tournament and write every game to path as it finishes. Returns the
+# results.
+def run(mode, strategies, games_per_pair, path=RESULTS_FILE, workers=None, seed=None,
+        rows=None, columns=None, connect=None):
+    workers = workers or os.cpu_count() or 1
+    if seed is None:
+        seed = random.randrange(1 << 32)
+    games = list(pairings(mode, strategies, games_per_pair))
+    jobs = [(number, red, yellow, seed + number, rows, columns, connect)
+            for number, (red, yellow) in enumerate(games, 1)]
+    # Big enough batches that handing out games doesn't cost more than
+    # playing the quick ones, small enough that every worker has work until
+    # near the end.
+    chunksize = max(1, min(64, len(jobs) // (workers * 16)))
+    print("Playing {} games on {} workers (seed {}).".format(len(jobs), workers, seed))
+
+    results = []
+    start = time.perf_counter()
+    with open(path, "w") as out, get_context("fork").Pool(workers) as pool:
+        for result in pool.imap_unordered(play_game, jobs, chunksize=chunksize):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            results.append(result)
+            if len(results) % PROGRESS_INTERVAL == 0:
+                print("{}/{} games, {:.0f} games/sec.".format(
+                    len(results), len(jobs), len(results) / (time.perf_counter() - start)))
+    elapsed = time.perf_counter() - start
+    print("Played {} games in {:.1f} seconds ({:.0f} games/sec). Results are in {}.".format(
+        len(results), elapsed, len(results) / max(elapsed, 1e-9), path))
+    return results
+
+
+# The results in a results file.
+def read_results(path=RESULTS_FILE):
+    with open(path) as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+
+# Work out everyone's Elo rating from a list of results. Returns a dict of
+# name -> (rating, confidence interval (+/-), games, wins, draws, losses).
+def ratings(results):
+    # points[a][b] is how many points a scored against b, and games[a][b] how
+    # many games they played.
+    points = {}
+    games = {}
+    for result in results:
+        red, yellow = result["red"], result["yellow"]
+        red_points = {"red": 1, "yellow": 0, "draw": 0.5}[result["winner"]]
+        for me, them, score in ((red, yellow, red_points), (yellow, red, 1 - red_points)):
+            points.setdefault(me, {}).setdefault(them, 0)
+            games.setdefault(me, {}).setdefault(them, 0)
+            points[me][them] += score
+            games[me][them] += 1
+    for me in games:
+        for them in games[me]:
+            points[me][them] += PRIOR_DRAWS * 0.5
+            games[me][them] += PRIOR_DRAWS
+
+    # Find the strengths (10 ** (rating / 400)) that make the results most
+    # likely. Each round moves every strength to the one that would be
+    # right if everyone else's were; this always heads towards the answer.
+    strength = {name: 1.0 for name in games}
+    while True:
+        new = {}
+        for me in games:
+            expected = sum(games[me][them] / (strength[me] + strength[them]) for them in games[me])
+            new[me] = sum(points[me].values()) / expected
+        # Only differences matter, so keep the average where it is.
+        scale = math.exp(sum(math.log(s) for s in new.values()) / len(new))
+        new = {name: s / scale for name, s in new.items()}
+        change = max(abs(math.log10(new[name] / strength[name])) * 400 for name in new)
+        strength = new
+        if change < ELO_TOLERANCE:
+            break
+
+    # The standard error of each rating, from how much each game says about
+    # it: a game that could easily have gone either way says the most.
+    table = {}
+    for me in games:
+        information = 0
+        for them in games[me]:
+            expected = strength[me] / (strength[me] + strength[them])
+            information += games[me][them] * expected * (1 - expected)
+        error = 400 / math.log(10) / math.sqrt(information)
+        real_games = [result for result in results if me in (result["red"], result["yellow"])]
+        wins = sum(1 for result in real_games if result["winner"] != "draw" and result[result["winner"]] == me)
+        draws = sum(1 for result in real_games if result["winner"] == "draw")
+        table[me] = (ELO_BASE + 400 * math.log10(strength[me]), CONFIDENCE_Z * error,
+                     len(real_games), wins, draws, len(real_games) - wins - draws)
+    return table
+
+
+# Print the ratings, best first, and how often red (moving first) won.
+def print_ratings(results):
+    if not results:
+        print("No games to rate.")
+        return
+    table = ratings(results)
+    print("{:<24} {:>6} {:>6} {:>7} {:>7} {:>7} {:>7} {:>6}".format(
+        "Strategy", "Elo", "+/-", "Games", "Won", "Drawn", "Lost", "Score"))
+    for name, (rating, interval, played, wins, draws, losses) in sorted(table.items(), key=lambda item: -item[1][0]):
+        print("{:<24} {:>6.0f} {:>6.0f} {:>7} {:>7} {:>7} {:>7} {:>5.1f}%".format(
+            name, rating, interval, played, wins, draws, losses, 100 * (wins + draws / 2) / played))
+    red_wins = sum(1 for result in results if result["winner"] == "red")
+    draws = sum(1 for result in results if result["winner"] == "draw")
+    print("Red won {:.1f}% of games, yellow {:.1f}%, and {:.1f}% were drawn.".format(
+        100 * red_wins / len(results), 100 * (len(results) - red_wins - draws) / len(results),
+        100 * draws / len(results)))
+
+
+if __name__ == "__main__":
+    # Strategies can be loaded from wherever this is run, as well as from
+    # here.
+    sys.path.append(os.getcwd())
+    try:
+        args, rows, columns, connect = parse_board_args(sys.argv[1:])
+    except ValueError as e:
+        print("Bad board settings: {}".format(e))
+        sys.exit(1)
+    options = {}
+    for arg in args[:]:
+        name, equals, value = arg.partition("=")
+        if equals and name in ("out", "workers", "seed"):
+            options[name] = value
+            args.remove(arg)
+
+    if len(args) >= 1 and args[0] == "ratings":
+        print_ratings(read_results(args[1] if len(args) >= 2 else RESULTS_FILE))
+    elif len(args) >= 4 and args[0] in ("roundrobin", "gauntlet"):
+        strategies = args[2:]
+        if len(set(strategies)) != len(strategies):
+            print("Each strategy can only be entered once.")
+            sys.exit(1)
+        try:
+            for name in strategies:
+                load_strategy(name)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        results = run(args[0], strategies, int(args[1]), options.get("out", RESULTS_FILE),
+                      int(options["workers"]) if "workers" in options else None,
+                      int(options["seed"]) if "seed" in options else None, rows, columns, connect)
+        print_ratings(results)
+    else:
+        print("Usage: python3 tournament.py roundrobin <games per pair> <strategy> <strategy> ...")
+        print("       python3 tournament.py gauntlet <games per pair> <challenger> <opponent> ...")
+        print("       python3 tournament.py ratings [file]")
+        print("Strategies: {}, ai:<ms>, or <module>.<function>.".format(", ".join(STRATEGIES)))
+        print("Options: out=<file> workers=<n> seed=<n> size=<rows>x<columns> connect=<n>")
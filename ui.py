@@ -0,0 +1,211 @@
+# The display, the buttons and the LED.
+#
+# Importing this module imports pygame, but nothing else happens until
+# open_display() is called: that's when pygame starts, the window opens, the
+# font is loaded and (in kiosk mode) the GPIO library is imported and set up.
+# Nothing that only needs the rules (rules.py) or the server (net_client.py)
+# pays for any of it.
+
+import sys
+
+import pygame
+
+from gpio_input import BUTTON_EVENT, start_button_events, stop_button_events
+from renderer import BoardRenderer
+from rules import ROW_COUNT, COLUMN_COUNT, PLAYER_1_PIECE, PLAYER_2_PIECE
+
+# Colors
+BLUE = (0,0,255)
+BLACK = (0,0,0)
+RED = (255,0,0)
+YELLOW = (255,255,0)
+WHITE = (255,255,255)
+
+# Spacing of GUI features
+SQUARE_SIZE = 68
+CIRCLE_RADIUS = (SQUARE_SIZE // 2) - 4
+LABEL_POS = (40, 10)
+TEXT_SIZE = 48
+TEXT_FONT = "monospace"
+# The Raspi screens are 800x480 pixels. Bigger boards get smaller squares so
+# they still fit.
+SCREEN_WIDTH = 800
+SCREEN_HEIGHT = 480
+
+# The pins connected to the button and LED
+BUTTON_PIN = 24
+LED_PIN = 23
+# Button presses closer together than this (ms) count as one press.
+BUTTON_DEBOUNCE = 200
+
+# Set up by open_display().
+screen = None
+text_font = None
+renderer = None
+# The GPIO module (RPi.GPIO, or fake_gpio in fake kiosk mode), or None if
+# we're not a kiosk.
+GPIO = None
+fake_gpio = False
+
+
+# Start pygame and open the window (full screen on a real kiosk). In kiosk
+# mode, also import and set up the GPIO library; with fake_gpio, the GPIO
+# pins are simulated by fake_gpio.py and the B key presses the button.
+def open_display(kiosk_mode=False, fake=False, rows=ROW_COUNT, columns=COLUMN_COUNT):
+    global screen, text_font, renderer, GPIO, fake_gpio
+
+    # initialize pygame
+    pygame.init()
+
+    # The normal board fits the screen at SQUARE_SIZE. Bigger ones are
+    # shrunk until they do too.
+    square_size = min(SQUARE_SIZE, SCREEN_WIDTH // columns, SCREEN_HEIGHT // (rows + 1))
+
+    # Determine screen width and height. The height gets an extra square added
+    # for the space that holds the text and the piece to be dropped.
+    screen_size = (columns * square_size, (rows + 1) * square_size)
+
+    # Depending on whether or not we're in kiosk mode, activate fullscreen.
+    if kiosk_mode and not fake:
+        screen = pygame.display.set_mode(screen_size, pygame.FULLSCREEN)
+    else:
+        screen = pygame.display.set_mode(screen_size)
+
+    text_font = pygame.font.SysFont(TEXT_FONT, TEXT_SIZE * square_size // SQUARE_SIZE)
+
+    # Pre-draws the board and pieces so that each move only redraws what changed.
+    renderer = BoardRenderer(screen, rows, columns, square_size, CIRCLE_RADIUS * square_size // SQUARE_SIZE,
+                             BLUE, BLACK, {PLAYER_1_PIECE: RED, PLAYER_2_PIECE: YELLOW})
+
+    if kiosk_mode:
+        fake_gpio = fake
+        if fake:
+            import fake_gpio as gpio_module
+        else:
+            import RPi.GPIO as gpio_module
+        GPIO = gpio_module
+        setupGPIO()
+
+# Set up all the GPIO stuff. Lots of things that don't need changing here.
+def setupGPIO():
+    # Set pin mode
+    GPIO.setmode(GPIO.BCM)
+
+    # Set up our one input pin. Presses arrive as BUTTON_EVENTs in the
+    # pygame event queue (see gpio_input.py).
+    GPIO.setup(BUTTON_PIN, GPIO.IN)
+    start_button_events(GPIO, BUTTON_PIN, BUTTON_DEBOUNCE)
+
+    # Set up our one LED pin.
+    GPIO.setup(LED_PIN, GPIO.OUT)
+
+# Turn the kiosk's LED on or off. Does nothing if we're not a kiosk.
+def set_led(on):
+    if GPIO is not None:
+        GPIO.output(LED_PIN, GPIO.HIGH if on else GPIO.LOW)
+
+# Close down Pygame and then exit the program.
+def exit_all():
+    if GPIO is not None:
+        stop_button_events(GPIO, BUTTON_PIN)
+        GPIO.cleanup()
+    pygame.display.quit()
+    pygame.quit()
+    sys.exit()
+
+# Fill the top row of the screen (where text is placed) with a
+# BLACK rectangle. Returns the rectangle, to be passed to
+# pygame.display.update().
+def draw_top_row():
+    return renderer.clear_top_row()
+
+# Remove any text from the top of the screen.
+def clear_text():
+    pygame.display.update(draw_top_row())
+
+# The function which translates the board into a pretty picture for
+# us to look at! This redraws the whole board, so it's only used when the
+# board first appears. See renderer.py.
+def draw_board(board):
+    renderer.draw_board(board)
+
+# Show a piece that was just dropped at row, col. Only that space and the top
+# row (where the piece was hovering) are redrawn.
+def draw_move(board, row, col):
+    pygame.display.update([renderer.clear_hover(), renderer.draw_cell(board, row, col)])
+
+# Show the piece hovering over col, ready to be dropped. Only the square it
+# left and the square it moved to are redrawn.
+def draw_hover(col, color):
+    pygame.display.update(renderer.draw_hover(col, color))
+
+# Draw a ring around each of the given (row, col) spaces so the players can
+# see which four (or more) chips won the game.
+def highlight_cells(cells):
+    dirty = []
+    for row, col in cells:
+        rect = renderer.cell_rect(row, col)
+        pygame.draw.circle(screen, WHITE, rect.center, renderer.circle_radius, 4)
+        dirty.append(rect)
+    pygame.display.update(dirty)
+
+# Generic function to show text on the top of the screen.
+def show_text(text, color):
+    # Remove anything that was on the screen before
+    top_row = draw_top_row()
+    # Create the label and display it
+    label = text_font.render(text, 1, color)
+    # Display the label
+    screen.blit(label, LABEL_POS)
+    pygame.display.update(top_row)
+
+# Deal with one pygame event. Returns True if it's an important event (like
+# the mouse button being clicked or the GPIO button being pressed). Exits the
+# game if it's the QUIT signal.
+def handle_event(event):
+
+    # If the user has quit the game, terminate immediately.
+    if event.type == pygame.QUIT:
+        exit_all()
+
+    # Also exit if the user pressed Q.
+    elif event.type == pygame.KEYDOWN:
+        if event.key == pygame.K_q:
+            exit_all()
+        if event.key == pygame.K_SPACE:
+            return True
+        # With the fake GPIO backend, B stands in for the real button. The
+        # press goes through the same callback as a real one would.
+        if fake_gpio and event.key == pygame.K_b:
+            GPIO.press(BUTTON_PIN)
+            GPIO.release(BUTTON_PIN)
+
+    # If the user clicked the mouse or button, return true.
+    elif event.type == pygame.MOUSEBUTTONDOWN or event.type == BUTTON_EVENT:
+        return True
+
+    # We didn't find anything worth writing home about. Return False.
+    return False
+
+# Did the player ask for a hint? That's the H key.
+def is_hint_request(event):
+    return event.type == pygame.KEYDOWN and event.key == pygame.K_h
+
+# Forget any clicks and presses in the queue, so ones made before now don't
+# count. Anything else (like messages from the server, see net_events.py) is
+# left alone.
+def clear_events():
+    pygame.event.clear([pygame.MOUSEBUTTONDOWN, pygame.KEYDOWN, BUTTON_EVENT])
+
+# Wait a maximum time for some interesting event (mouse click, button press).
+# Sleeps until an event arrives instead of checking over and over, and returns
+# as soon as an important one does.
+def wait_for_event(millis_to_wait):
+    deadline = pygame.time.get_ticks() + millis_to_wait
+    while True:
+        remaining = deadline - pygame.time.get_ticks()
+        if remaining <= 0:
+            return False
+        event = pygame.event.wait(remaining)
+        if event.type != pygame.NOEVENT and handle_event(event):
+            return True
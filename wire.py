@@ -0,0 +1,397 @@
+# How messages are sent between connect-4.py and server.py.
+#
+# The original protocol sends plain ASCII text ("p=1", "turn 3:4", "wait",
+# ...) and assumes every recv() returns exactly one message. That holds when
+# the network is quiet, but TCP is free to glue two messages together or split
+# one in half, and then the text can't be parsed.
+#
+# The framed protocol fixes that. Each message is a frame:
+#
+#     +----------------+--------+-----------------+
+#     | length (2 B)   | opcode | payload         |
+#     +----------------+--------+-----------------+
+#
+# where length counts the opcode and payload bytes. A client asks for the
+# framed protocol by sending the two bytes MAGIC, VERSION as its first
+# message, and the server answers with the same two bytes. A client that
+# doesn't do this (like the Pis already out there) gets the ASCII protocol,
+# so old and new clients can use the same server.
+#
+# Either way, messages are turned into the same tuples, so the server only
+# has to understand one thing. Requests are (opcode, a, b) and replies are
+# (opcode, value), or (opcode, value, more) for the few that carry two things
+# (PLAYED, RESUMED, ANALYSIS). Unused numbers are 0.
+
+import struct
+
+CODEC = "ascii"
+
+# The handshake. MAGIC can't be the first byte of an ASCII message.
+MAGIC = 0xC4
+VERSION = 1
+HELLO_BYTES = bytes((MAGIC, VERSION))
+
+# Request opcodes, and their ASCII versions.
+HELLO = 0       # (HELLO, version, 0) - the handshake, never sent as a frame
+JOIN = 1        # (JOIN, piece, 0)    - "p=1" / "p=2"
+WAITED = 2      # (WAITED, 0, 0)      - "waited"
+WAITSTART = 3   # (WAITSTART, 0, 0)   - "waitstart"
+TURN = 4        # (TURN, turn, col)   - "turn x:y", answered with AFFIRM, or
+                # REFUSED if the move isn't allowed
+WAITING = 5     # (WAITING, turn, 0)  - "waiting x"
+SUBSCRIBE = 6   # (SUBSCRIBE, turn, 0) - "subscribe x"
+GAMEOVER = 7    # (GAMEOVER, 0, 0)    - "gameover"
+WATCH = 8       # (WATCH, game, 0)    - "watch x"
+MATCH = 9       # (MATCH, 0, 0)       - "match"
+TOKEN = 10      # (TOKEN, 0, 0)       - "token"
+RESUME = 11     # (RESUME, token, 0)  - "resume x", x in hex
+PING = 12       # (PING, 0, 0)        - "ping"
+ANALYZE = 13    # (ANALYZE, 0, columns) - "analyze 3342", every column played
+                # so far, written like RESUMED's
+UNKNOWN = 63    # anything we couldn't make sense of
+
+# Reply opcodes, and their ASCII versions.
+WAIT = 64       # "wait"
+START = 65      # "start"
+AFFIRM = 66     # "affirm"
+MOVE = 67       # (MOVE, col) - the column as a number, e.g. "4"
+# Sent to spectators. In ASCII, each of these ends with a newline, since
+# several can arrive together.
+WATCHING = 68   # "watching" - now watching the game
+PLAYED = 69     # (PLAYED, turn, col) - "played x:y"
+ENDED = 70      # "ended" - the game is over (or there's no such game)
+MATCHED = 71    # (MATCHED, piece) - "start 1" / "start 2", the reply to MATCH
+SESSION_TOKEN = 72  # (SESSION_TOKEN, token) - "token x", x in hex
+RESUMED = 73    # (RESUMED, piece, columns) - "resumed 1:3342", the piece and
+                # every column played so far, in order, one base-36 digit
+                # each (so columns past 9 are a, b, ...)
+PONG = 74       # "pong" - the reply to PING
+ANALYSIS = 75   # (ANALYSIS, best, scores) - "analysis 3:-2,5,x,...", the best
+                # column and the score of every column (None, "x", if it's
+                # full). Just "analysis" (best and scores None) if the
+                # position can't be analyzed.
+REFUSED = 76    # "refused" - the move wasn't allowed, and wasn't played
+NOTHING = 127   # no reply at all
+
+# How columns are written in the ASCII RESUMED reply.
+COLUMN_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+# What a framed ANALYSIS has for the best column when there isn't one, and
+# for the score of a full column.
+NO_COLUMN = 255
+NO_SCORE = -0x80000000
+
+# The replies that don't carry a value. Making these once means sending them
+# doesn't allocate anything.
+REPLY_WAIT = (WAIT, 0)
+REPLY_START = (START, 0)
+REPLY_AFFIRM = (AFFIRM, 0)
+REPLY_NOTHING = (NOTHING, 0)
+REPLY_HELLO = (HELLO, VERSION)
+REPLY_ENDED = (ENDED, 0)
+REPLY_PONG = (PONG, 0)
+REPLY_REFUSED = (REFUSED, 0)
+REPLY_NO_ANALYSIS = (ANALYSIS, None, None)
+
+# The frame header: length, then opcode.
+HEADER = struct.Struct(">HB")
+HEADER_SIZE = HEADER.size
+# Payloads.
+TURN_PAYLOAD = struct.Struct(">HB")
+TURN_NUM_PAYLOAD = struct.Struct(">H")
+GAME_PAYLOAD = struct.Struct(">I")
+TOKEN_PAYLOAD = struct.Struct(">Q")
+SCORE_PAYLOAD = struct.Struct(">i")
+# How many payload bytes each opcode needs at least.
+PAYLOAD_SIZES = {
+    JOIN: 1,
+    TURN: TURN_PAYLOAD.size,
+    WAITING: TURN_NUM_PAYLOAD.size,
+    SUBSCRIBE: TURN_NUM_PAYLOAD.size,
+    WATCH: GAME_PAYLOAD.size,
+    RESUME: TOKEN_PAYLOAD.size,
+    MOVE: 1,
+    MATCHED: 1,
+    SESSION_TOKEN: TOKEN_PAYLOAD.size,
+    RESUMED: 1,
+    PLAYED: TURN_PAYLOAD.size,
+    ANALYSIS: 1,
+}
+
+# How big each connection's receive buffer is. Frames are tiny, so this holds
+# plenty of them.
+BUFFER_SIZE = 4096
+
+
+# Make a frame out of an opcode and payload.
+def encode_frame(op, payload=b''):
+    return HEADER.pack(len(payload) + 1, op) + payload
+
+
+# Every reply, already encoded both ways. MOVE has one entry per column.
+FRAMED_REPLIES = {
+    WAIT: encode_frame(WAIT),
+    START: encode_frame(START),
+    AFFIRM: encode_frame(AFFIRM),
+    WATCHING: encode_frame(WATCHING),
+    ENDED: encode_frame(ENDED),
+    PONG: encode_frame(PONG),
+    REFUSED: encode_frame(REFUSED),
+    HELLO: HELLO_BYTES,
+    NOTHING: b'',
+}
+ASCII_REPLIES = {
+    WAIT: b"wait",
+    START: b"start",
+    AFFIRM: b"affirm",
+    WATCHING: b"watching\n",
+    ENDED: b"ended\n",
+    PONG: b"pong",
+    REFUSED: b"refused",
+    HELLO: HELLO_BYTES,
+    NOTHING: b'',
+}
+FRAMED_MOVES = [encode_frame(MOVE, bytes((col,))) for col in range(256)]
+ASCII_MOVES = [str(col).encode(CODEC) for col in range(256)]
+FRAMED_MATCHED = {piece: encode_frame(MATCHED, bytes((piece,))) for piece in (1, 2)}
+ASCII_MATCHED = {piece: "start {}".format(piece).encode(CODEC) for piece in (1, 2)}
+
+# What gets pushed to spectators is encoded once, both ways, as an (ASCII,
+# framed) pair, and the same bytes are written to every spectator.
+ENDED_PUSH = (ASCII_REPLIES[ENDED], FRAMED_REPLIES[ENDED])
+
+
+# A move, for pushing to spectators.
+def encode_played(turn_num, col):
+    return ("played {}:{}\n".format(turn_num, col).encode(CODEC),
+            encode_frame(PLAYED, TURN_PAYLOAD.pack(turn_num, col)))
+
+
+# The first thing pushed to a new spectator: WATCHING, then every move so far.
+# moves is a game's moves as stored in a Session (see sessions.py).
+def encode_watching(moves):
+    ascii_parts = [ASCII_REPLIES[WATCHING]]
+    framed_parts = [FRAMED_REPLIES[WATCHING]]
+    for turn_num in range(1, len(moves)):
+        if moves[turn_num] == 0:
+            break
+        ascii_move, framed_move = encode_played(turn_num, moves[turn_num] - 1)
+        ascii_parts.append(ascii_move)
+        framed_parts.append(framed_move)
+    return b"".join(ascii_parts), b"".join(framed_parts)
+
+
+# Encode a reply tuple for a connection using the framed protocol (framed is
+# True) or the ASCII one.
+def encode_reply(reply, framed):
+    op = reply[0]
+    value = reply[1]
+    if op == MOVE:
+        if framed:
+            return FRAMED_MOVES[value]
+        return ASCII_MOVES[value]
+    if op == MATCHED:
+        if framed:
+            return FRAMED_MATCHED[value]
+        return ASCII_MATCHED[value]
+    if op == SESSION_TOKEN:
+        if framed:
+            return encode_frame(op, TOKEN_PAYLOAD.pack(value))
+        return "token {:016x}".format(value).encode(CODEC)
+    if op == RESUMED:
+        # The whole game in one message, so a client that lost its
+        # connection can catch up in one round trip.
+        columns = reply[2]
+        if framed:
+            return encode_frame(op, bytes((value,)) + columns)
+        return "resumed {}:{}".format(value, "".join(COLUMN_DIGITS[col] for col in columns)).encode(CODEC)
+    if op == ANALYSIS:
+        scores = reply[2]
+        if framed:
+            if value is None:
+                return encode_frame(op, bytes((NO_COLUMN,)))
+            return encode_frame(op, bytes((value,)) + b"".join(
+                SCORE_PAYLOAD.pack(NO_SCORE if score is None else score) for score in scores))
+        if value is None:
+            return b"analysis"
+        return "analysis {}:{}".format(value, ",".join("x" if score is None else str(score)
+                                                       for score in scores)).encode(CODEC)
+    if framed:
+        return FRAMED_REPLIES[op]
+    return ASCII_REPLIES[op]
+
+
+# Encode a request tuple as a frame.
+def encode_request(message):
+    op, a, b = message
+    if op == JOIN:
+        return encode_frame(op, bytes((a,)))
+    if op == TURN:
+        return encode_frame(op, TURN_PAYLOAD.pack(a, b))
+    if op == WAITING or op == SUBSCRIBE:
+        return encode_frame(op, TURN_NUM_PAYLOAD.pack(a))
+    if op == WATCH:
+        return encode_frame(op, GAME_PAYLOAD.pack(a))
+    if op == RESUME:
+        return encode_frame(op, TOKEN_PAYLOAD.pack(a))
+    if op == ANALYZE:
+        return encode_frame(op, b)
+    return encode_frame(op)
+
+
+# Turn one ASCII request ("turn 3:4") into a request tuple.
+def parse_ascii(data):
+    try:
+        if data == "p=1" or data == "p=2":
+            return (JOIN, int(data[2]), 0)
+        if data == "waited":
+            return (WAITED, 0, 0)
+        if data == "match":
+            return (MATCH, 0, 0)
+        if data == "ping":
+            return (PING, 0, 0)
+        if data == "token":
+            return (TOKEN, 0, 0)
+        if data == "analyze" or data.startswith("analyze "):
+            return (ANALYZE, 0, bytes(int(col, 36) for col in data[8:]))
+        if data.startswith("resume"):
+            return (RESUME, int(data.split(' ')[1], 16), 0)
+        if data == "waitstart":
+            return (WAITSTART, 0, 0)
+        if data == "gameover":
+            return (GAMEOVER, 0, 0)
+        if data.startswith("turn"):
+            # Format of turn data: "turn x:y" where x=turn and y=column
+            turn_num, column = data.split(' ')[1].split(':')
+            return (TURN, int(turn_num), int(column))
+        if data.startswith("waiting"):
+            return (WAITING, int(data.split(' ')[1]), 0)
+        if data.startswith("subscribe"):
+            return (SUBSCRIBE, int(data.split(' ')[1]), 0)
+        if data.startswith("watch"):
+            return (WATCH, int(data.split(' ')[1]), 0)
+    except (IndexError, ValueError):
+        pass
+    return (UNKNOWN, 0, 0)
+
+
+# Turn a reply (as parsed by a MessageReader on the client) back into the
+# ASCII text the old protocol would have sent.
+def reply_text(reply):
+    if reply[0] == PLAYED:
+        return encode_played(reply[1], reply[2])[0].decode(CODEC)
+    return encode_reply(reply, False).decode(CODEC)
+
+
+class MessageReader:
+
+    __slots__ = ("buffer", "view", "start", "end", "framed")
+
+    # framed is True or False if we already know which protocol the other end
+    # speaks, or None to work it out from the first bytes received.
+    def __init__(self, framed=None, size=BUFFER_SIZE):
+        # Everything is received straight into this one buffer, and frames
+        # are parsed out of it in place, so receiving doesn't allocate.
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # The bytes from start to end have been received but not parsed yet.
+        self.start = 0
+        self.end = 0
+        self.framed = framed
+
+    # The part of the buffer that the next recv_into() should fill.
+    def free_space(self):
+        return self.view[self.end:]
+
+    # Bytes that have been received but aren't a whole message yet.
+    def unparsed(self):
+        return bytes(self.view[self.start:self.end])
+
+    # Put bytes another reader received but didn't parse (see unparsed())
+    # into this one. Returns the messages they complete.
+    def load(self, data):
+        if not data:
+            return []
+        self.free_space()[:len(data)] = data
+        return self.received(len(data))
+
+    # nbytes have just been received into free_space(). Returns the list of
+    # messages that are now complete. Raises ValueError if the other end sent
+    # something that can't be a frame.
+    def received(self, nbytes):
+        self.end += nbytes
+        messages = []
+
+        # The first message tells us which protocol is being spoken.
+        if self.framed is None:
+            if self.buffer[self.start] != MAGIC:
+                self.framed = False
+            elif self.end - self.start >= len(HELLO_BYTES):
+                self.framed = True
+                messages.append((HELLO, self.buffer[self.start + 1], 0))
+                self.start += len(HELLO_BYTES)
+            else:
+                return messages
+
+        if not self.framed:
+            # The old protocol: whatever arrived is one message.
+            data = str(self.view[self.start:self.end], CODEC, "replace")
+            self.start = self.end = 0
+            messages.append(parse_ascii(data))
+            return messages
+
+        buffer = self.buffer
+        start = self.start
+        while self.end - start >= HEADER_SIZE:
+            length, op = HEADER.unpack_from(buffer, start)
+            if length == 0:
+                raise ValueError("empty frame")
+            if self.end - start - 2 < length:
+                # The rest of this frame hasn't arrived yet.
+                break
+            if length - 1 < PAYLOAD_SIZES.get(op, 0):
+                raise ValueError("frame too short")
+            payload = start + HEADER_SIZE
+            if op == TURN or op == PLAYED:
+                turn_num, column = TURN_PAYLOAD.unpack_from(buffer, payload)
+                messages.append((op, turn_num, column))
+            elif op == WAITING or op == SUBSCRIBE:
+                messages.append((op, TURN_NUM_PAYLOAD.unpack_from(buffer, payload)[0], 0))
+            elif op == WATCH:
+                messages.append((op, GAME_PAYLOAD.unpack_from(buffer, payload)[0], 0))
+            elif op == RESUME or op == SESSION_TOKEN:
+                messages.append((op, TOKEN_PAYLOAD.unpack_from(buffer, payload)[0], 0))
+            elif op == RESUMED:
+                messages.append((op, buffer[payload], bytes(buffer[payload + 1:start + 2 + length])))
+            elif op == ANALYZE:
+                messages.append((op, 0, bytes(buffer[payload:start + 2 + length])))
+            elif op == ANALYSIS:
+                best = buffer[payload]
+                if best == NO_COLUMN:
+                    messages.append(REPLY_NO_ANALYSIS)
+                elif (length - 2) % SCORE_PAYLOAD.size:
+                    raise ValueError("bad analysis")
+                else:
+                    scores = tuple(None if score == NO_SCORE else score for (score,) in
+                                   SCORE_PAYLOAD.iter_unpack(buffer[payload + 1:start + 2 + length]))
+                    messages.append((op, best, scores))
+            elif op == JOIN or op == MOVE or op == MATCHED:
+                messages.append((op, buffer[payload], 0))
+            else:
+                messages.append((op, 0, 0))
+            start += 2 + length
+        self.start = start
+
+        if self.start == self.end:
+            # Everything has been parsed. Start again at the front.
+            self.start = self.end = 0
+        elif self.end == len(buffer):
+            # The buffer is full, and ends with part of a frame. Move that
+            # part to the front to make room for the rest of it.
+            if self.start == 0:
+                raise ValueError("frame too long")
+            leftover = self.end - self.start
+            buffer[:leftover] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = leftover
+        return messages